@@ -1,45 +1,497 @@
+import json
+import os
 import sys
+from typing import TYPE_CHECKING
 
 import click
 
-from manager.images import ImagesDB
-from manager.jolpica import JolpicaDB
+# Only light modules are imported here, each command imports the ones it uses so it does not pay for the others
+from manager import defaults
+from manager.cache import ResponseCache
+from manager.profiling import StageProfiler, set_profiler
+
+if TYPE_CHECKING:
+    from manager.jolpica import JolpicaAPI, JolpicaDB
 
 
 @click.group("manager")
-def cli():
+@click.option("--cache-dir", help="Directory of the Jolpica responses cache", default=defaults.CACHE_DIRECTORY, show_default=True)
+@click.option("--no-cache", is_flag=True, help="Do not read or write the Jolpica responses cache")
+@click.option("--offline", is_flag=True, help="Serve Jolpica responses only from the cache, without network access")
+@click.option("--storage", type=click.Choice(defaults.STORAGES), default="csv", show_default=True, help="Storage backend of the database directory")
+@click.option(
+    "--parser",
+    type=click.Choice(defaults.PARSER_MODES),
+    default="schema",
+    show_default=True,
+    help="Read responses with the table schemas (schema) or with pandas json_normalize (pandas)",
+)
+@click.option(
+    "--dtypes",
+    type=click.Choice(defaults.DTYPES),
+    default="standard",
+    show_default=True,
+    help="Keep the tables in memory with the stored dtypes (standard) or with shared categoricals and narrow integers (compact)",
+)
+@click.option("--metrics-out", help="Write the wall time, calls, bytes, retries and rows of every stage to this JSON file")
+@click.option("--profile", help="Write a cProfile dump of the slowest stage to this file")
+@click.pass_context
+def cli(ctx: click.Context, cache_dir: str, no_cache: bool, offline: bool, storage: str, parser: str, dtypes: str, metrics_out: str, profile: str):
     """Database management CLI"""
-    pass
+    if no_cache and offline:
+        raise click.UsageError("--offline requires the cache, it can not be used with --no-cache.")
+
+    cache = None if no_cache else ResponseCache(cache_dir, offline=offline)
+    ctx.obj = {"cache": cache, "storage": storage, "parser": parser, "dtypes": dtypes}
+
+    if metrics_out or profile:
+        profiler = StageProfiler(cprofile=profile is not None)
+        set_profiler(profiler)
+        ctx.call_on_close(lambda: write_profile(profiler, ctx.invoked_subcommand, metrics_out, profile))
+
+
+def write_profile(profiler: StageProfiler, command: str, metrics_out: str, profile: str):
+    set_profiler(None)
+    if metrics_out:
+        profiler.write(metrics_out, command)
+        click.echo(f"Stage metrics written to {metrics_out}", err=True)
+    if profile:
+        stage = profiler.dump_slowest(profile)
+        if stage is not None:
+            click.echo(f"cProfile of the slowest stage, {stage}, written to {profile}", err=True)
+
+
+def get_jolpica_api(obj: dict) -> "JolpicaAPI":
+    from manager.jolpica import JolpicaAPI
+
+    if "jolpica_api" not in obj:
+        obj["jolpica_api"] = JolpicaAPI(cache=obj["cache"])
+    return obj["jolpica_api"]
+
+
+def get_jolpica_db(obj: dict, directory: str) -> "JolpicaDB":
+    from manager.jolpica import JolpicaDB
+    from manager.storage import STORAGES
+
+    storage = STORAGES[obj["storage"]](directory)
+    return JolpicaDB(directory, get_jolpica_api(obj), storage, parser_mode=obj["parser"], dtypes=obj["dtypes"])
 
 
 @cli.command("update")
 @click.option("--directory", "-d", help="Directory of database", required=True)
-def update_db(directory: str):
-    jolpica_db = JolpicaDB(directory)
-    jolpica_db.update()
+@click.option(
+    "--standings-source",
+    type=click.Choice(["api", "local"]),
+    default="api",
+    show_default=True,
+    help="Fetch standings round by round (api) or compute them from the season results (local)",
+)
+@click.option("--force", is_flag=True, help="Update even when the probe finds nothing new upstream")
+@click.option("--summary-out", help="Also write the JSON summary of the update to this file")
+@click.pass_obj
+def update_db(obj: dict, directory: str, standings_source: str, force: bool, summary_out: str):
+    jolpica_db = get_jolpica_db(obj, directory)
+    summary = jolpica_db.update(standings_source=standings_source, force=force)
+
+    # The summary is the last line of the output, with changed false when no table was written
+    click.echo(json.dumps(summary))
+    if summary_out:
+        os.makedirs(os.path.dirname(summary_out) or ".", exist_ok=True)
+        with open(summary_out, "w") as file:
+            json.dump(summary, file, indent=2)
+
+
+@cli.command("verify-standings")
+@click.option("--directory", "-d", help="Directory of database", required=True)
+@click.option("--start-season", type=int, help="First season to verify", default=1950, show_default=True)
+@click.option("--end-season", type=int, help="Last season to verify, defaults to the last season with standings")
+@click.pass_obj
+def verify_standings(obj: dict, directory: str, start_season: int, end_season: int):
+    jolpica_db = get_jolpica_db(obj, directory)
+    jolpica_db._load_db()
+    if end_season is None:
+        end_season = jolpica_db.db["drivers_standings"]["season"].max()
+
+    reports = jolpica_db.verify_local_standings(list(range(start_season, end_season + 1)))
+    different = False
+    for table, report in reports.items():
+        report = report.set_index("season")
+        mismatches = report[report.sum(axis=1) > 0]
+        click.echo(f"{table}: {len(report) - len(mismatches)}/{len(report)} seasons match")
+        if not mismatches.empty:
+            different = True
+            click.echo(mismatches.to_string())
+
+    if different:
+        raise click.ClickException("Local standings differ from the stored standings.")
 
 
 @cli.command("update-images")
 @click.option("--images-directory", "-di", help="Directory of images", required=True)
 @click.option("--data-directory", "-dd", help="Directory of database", required=True)
-def update_images_db(images_directory: str, data_directory: str):
-    jolpica_db = JolpicaDB(data_directory)
-    images_manager = ImagesDB(images_directory)
+@click.option("--jobs", "-j", type=int, help="Number of images processed in parallel", default=defaults.IMAGES_MAX_WORKERS, show_default=True)
+@click.option("--host-limit", type=int, help="Concurrent requests to the same host", default=defaults.IMAGES_HOST_LIMIT, show_default=True)
+@click.option("--processes", type=int, help="Processes encoding the WebP/AVIF variants, defaults to the number of CPUs")
+@click.option("--refresh", is_flag=True, help="Check every image upstream now, instead of only the ones not checked recently")
+@click.pass_obj
+def update_images_db(obj: dict, images_directory: str, data_directory: str, jobs: int, host_limit: int, processes: int, refresh: bool):
+    from manager.images import ImagesDB
+
+    jolpica_db = get_jolpica_db(obj, data_directory)
+    images_manager = ImagesDB(images_directory, max_workers=jobs, host_limit=host_limit)
 
     # update drivers
     drivers = jolpica_db.get_drivers()
-    images_manager.update_images_drivers(drivers)
+    images_manager.update_images_drivers(drivers, refresh=refresh)
 
     # update constructors
     constructors = jolpica_db.get_constructors()
-    images_manager.update_images_constructors(constructors)
+    images_manager.update_images_constructors(constructors, refresh=refresh)
+    images_manager.close()
+
+    for subdirectory in [ImagesDB.drivers_subdirectory, ImagesDB.constructors_subdirectory]:
+        images_manager.build_variants(subdirectory, processes=processes)
+
+
+@cli.command("build-sprites")
+@click.option("--images-directory", "-di", help="Directory of images", required=True)
+@click.option("--data-directory", "-dd", help="Directory of database", required=True)
+@click.option("--start-season", type=int, help="First season with sprites", default=defaults.START_SEASON, show_default=True)
+@click.option("--size", type=int, help="Side of each entity in the sprites", default=defaults.SPRITE_SIZE, show_default=True)
+@click.option("--processes", type=int, help="Processes building the sprites, defaults to the number of CPUs")
+@click.pass_obj
+def build_sprites(obj: dict, images_directory: str, data_directory: str, start_season: int, size: int, processes: int):
+    from manager.images import ImagesDB
+
+    jolpica_db = get_jolpica_db(obj, data_directory)
+    images_manager = ImagesDB(images_directory)
+    for subdirectory, table in [(ImagesDB.drivers_subdirectory, "drivers_standings"), (ImagesDB.constructors_subdirectory, "constructors_standings")]:
+        seasons = jolpica_db.get_season_entities(table, start_season)
+        built = images_manager.build_sprites(subdirectory, seasons, size=size, processes=processes)
+        click.echo(f"Sprites of {subdirectory}: {len(built)} built, {len(seasons) - len(built)} unchanged")
 
 
 @cli.command("create")
-@click.option("--directory", "-d", help="Directory of database")
-def create_db(directory: str):
-    jolpica_db = JolpicaDB(directory)
-    jolpica_db.create()
+@click.option("--directory", "-d", help="Directory of database", required=True)
+@click.option("--start-season", type=int, help="First season to create", default=1950, show_default=True)
+@click.option("--end-season", type=int, help="Last season to create, defaults to the current year")
+@click.option("--jobs", "-j", type=int, help="Number of seasons processed in parallel", default=1, show_default=True)
+@click.option(
+    "--standings-source",
+    type=click.Choice(["api", "local"]),
+    default="api",
+    show_default=True,
+    help="Fetch standings round by round (api) or compute them from the season results (local)",
+)
+@click.pass_obj
+def create_db(obj: dict, directory: str, start_season: int, end_season: int, jobs: int, standings_source: str):
+    jolpica_db = get_jolpica_db(obj, directory)
+    jolpica_db.create(start_season, end_season, jobs=jobs, standings_source=standings_source)
+
+
+@cli.command("export-csv")
+@click.option("--directory", "-d", help="Directory of database", required=True)
+@click.option("--output-directory", "-o", help="Directory where the CSVs for the frontend are written", required=True)
+@click.pass_obj
+def export_csv(obj: dict, directory: str, output_directory: str):
+    jolpica_db = get_jolpica_db(obj, directory)
+    jolpica_db.export_csv(output_directory)
+
+
+@cli.command("storage-timings")
+@click.option("--directory", "-d", help="Directory of database", required=True)
+@click.option("--repeat", type=int, help="Repetitions of each operation, the best one is reported", default=3, show_default=True)
+@click.pass_obj
+def storage_timings(obj: dict, directory: str, repeat: int):
+    from manager.storage import compare_storages
+
+    jolpica_db = get_jolpica_db(obj, directory)
+    jolpica_db._load_db()
+    tables = {table: jolpica_db.to_storage_dtypes(table, df) for table, df in jolpica_db.db.items() if df is not None}
+    click.echo(compare_storages(tables, repeat=repeat).round(2).to_string(index=False))
+
+
+@cli.command("memory-usage")
+@click.option("--directory", "-d", help="Directory of database", required=True)
+@click.pass_obj
+def memory_usage(obj: dict, directory: str):
+    """Memory of every table with the standard and the compact dtypes"""
+    import pandas as pd
+
+    reports = []
+    for dtypes in defaults.DTYPES:
+        jolpica_db = get_jolpica_db({**obj, "dtypes": dtypes}, directory)
+        # memory_usage only counts the loaded tables, so every table is read first
+        for table in jolpica_db.db:
+            jolpica_db.db[table]
+        reports.append(jolpica_db.memory_usage().set_index("table").rename(columns={"bytes": f"{dtypes}_mb"}))
+
+    report = pd.concat([reports[0], reports[1].drop(columns="rows")], axis=1)
+    report.loc["total"] = report.sum()
+    report["rows"] = report["rows"].astype("Int64")
+    report[[f"{x}_mb" for x in defaults.DTYPES]] /= 1024**2
+    report["ratio"] = report["compact_mb"] / report["standard_mb"]
+    click.echo(report.round(3).to_string())
+
+
+@cli.command("parser-timings")
+@click.option("--repeat", type=int, help="Repetitions of each parse, the best one is reported", default=3, show_default=True)
+@click.pass_obj
+def parser_timings(obj: dict, repeat: int):
+    from manager.jolpica import compare_parsers
+
+    cache = obj["cache"]
+    if cache is None:
+        raise click.UsageError("parser-timings reads the recorded responses of the cache, it can not be used with --no-cache.")
+
+    report = compare_parsers(cache, repeat=repeat)
+    if report.empty:
+        raise click.ClickException(f"No recorded responses in {cache.directory}, run update or create with the cache first.")
+
+    click.echo(report.round(2).to_string(index=False))
+    if not report["equal"].all():
+        raise click.ClickException("Schema parser tables differ from the pandas parser tables.")
+
+
+@cli.command("benchmark")
+@click.option("--data-directory", "-dd", help="Directory of database", default=os.path.join("static", "data"), show_default=True)
+@click.option("--images-directory", "-di", help="Directory of images served as upstream images", default=os.path.join("static", "images"), show_default=True)
+@click.option("--case", "cases", type=click.Choice(defaults.BENCHMARK_CASES), multiple=True, help="Cases to run, all by default")
+@click.option("--repeat", type=int, help="Repetitions of each case, the best one is reported", default=3, show_default=True)
+@click.option("--baseline", help="Baseline the results are compared against", default=defaults.BENCHMARK_BASELINE, show_default=True)
+@click.option("--wall-tolerance", type=float, help="Allowed wall time increase over the baseline", default=defaults.BENCHMARK_WALL_TOLERANCE, show_default=True)
+@click.option("--save-baseline", is_flag=True, help="Write the results as the new baseline instead of comparing them")
+@click.option("--record", is_flag=True, help="Record the Jolpica responses of the update case into the cache, then exit")
+@click.pass_obj
+def benchmark(obj: dict, data_directory: str, images_directory: str, cases: tuple, repeat: int, baseline: str, wall_tolerance: float, save_baseline: bool, record: bool):
+    from manager.benchmarks import BenchmarkSuite
+
+    # Jolpica responses are replayed from the cache directory by a local server, so runs are offline and comparable
+    cache = obj["cache"]
+    if cache is None:
+        raise click.UsageError("benchmark replays the recorded responses of the cache, it can not be used with --no-cache.")
+
+    suite = BenchmarkSuite(data_directory, images_directory, cache.directory, parser_mode=obj["parser"])
+    suite.tolerances = {**suite.tolerances, "wall_s": wall_tolerance}
+    if record:
+        if cache.offline:
+            raise click.UsageError("--record fetches the responses from Jolpica, it can not be used with --offline.")
+        click.echo(f"{suite.record(get_jolpica_api(obj))} responses recorded in {cache.directory}")
+        return
+
+    report = suite.run(list(cases), repeat=repeat)
+    if save_baseline:
+        suite.save_baseline(report, baseline)
+        click.echo(report.round(3).to_string(index=False))
+        click.echo(f"Baseline written to {baseline}")
+        return
+
+    if not os.path.exists(baseline):
+        raise click.ClickException(f"No baseline in {baseline}, write one with --save-baseline.")
+    baseline_rows = suite.load_baseline(baseline)
+    missing = [x for x in report["row"] if x not in baseline_rows]
+    if missing:
+        raise click.ClickException(f"Rows {', '.join(missing)} are not in the baseline {baseline}, add them with --save-baseline.")
+    report, regressions = suite.compare(report, baseline_rows)
+    click.echo(report.round(3).to_string(index=False))
+    if regressions:
+        raise click.ClickException("Regressions against the baseline:\n" + "\n".join(regressions))
+
+
+@cli.group("query")
+@click.option("--directory", "-d", help="Directory of database", required=True)
+@click.option("--mode", type=click.Choice(defaults.QUERY_MODES), default="driver", show_default=True, help="Query drivers or constructors")
+@click.pass_obj
+def query(obj: dict, directory: str, mode: str):
+    """Indexed lookups over the standings"""
+    obj["jolpica_db"] = get_jolpica_db(obj, directory)
+    obj["query"] = obj["jolpica_db"].query
+    obj["mode"] = mode
+
+
+@query.command("standings")
+@click.option("--season", type=int, help="Season of the standings", required=True)
+@click.option("--round", "round", type=int, help="Round of the standings, defaults to the last one of the season")
+@click.pass_obj
+def query_standings(obj: dict, season: int, round: int):
+    click.echo(obj["query"].standings(obj["mode"], season, round).to_string(index=False))
+
+
+@query.command("trajectory")
+@click.argument("id")
+@click.option("--season", type=int, help="Only this season, defaults to every season")
+@click.pass_obj
+def query_trajectory(obj: dict, id: str, season: int):
+    click.echo(obj["query"].trajectory(obj["mode"], id, season).to_string(index=False))
+
+
+@query.command("head-to-head")
+@click.argument("a")
+@click.argument("b")
+@click.option("--season", type=int, help="Only this season, defaults to every season")
+@click.pass_obj
+def query_head_to_head(obj: dict, a: str, b: str, season: int):
+    df = obj["query"].head_to_head(obj["mode"], a, b, season)
+    click.echo(df.to_string(index=False))
+    ahead = int((df[f"position_{a}"] < df[f"position_{b}"]).sum())
+    click.echo(f"{a} ahead of {b} after {ahead} of {len(df)} rounds")
+
+
+@query.command("championship")
+@click.option("--season", type=int, help="Season of the championship", required=True)
+@click.option("--round", "round", type=int, help="Round after which the championship is seen, defaults to the last one with standings")
+@click.option("--tensor-cache", help="Directory of the cached points tensors", default=defaults.CHAMPIONSHIP_CACHE, show_default=True)
+@click.pass_obj
+def query_championship(obj: dict, season: int, round: int, tensor_cache: str):
+    from manager.championship import ChampionshipOutlook
+
+    outlook = ChampionshipOutlook(obj["jolpica_db"], None, cache_directory=tensor_cache)
+    df = outlook.season_outlook(obj["mode"], season, round)
+    click.echo(df.to_string(index=False))
+    click.echo(f"{int(df['alive'].sum())} of {len(df)} still in contention")
+
+
+@cli.command("build-shards")
+@click.option("--directory", "-d", help="Directory of database", required=True)
+@click.option("--output-directory", "-o", help="Directory of the shards, defaults to <directory>/shards")
+@click.option("--start-season", type=int, help="First season with shards", default=defaults.START_SEASON, show_default=True)
+@click.pass_obj
+def build_shards(obj: dict, directory: str, output_directory: str, start_season: int):
+    from manager.shards import ShardsBuilder
+
+    jolpica_db = get_jolpica_db(obj, directory)
+    shards_builder = ShardsBuilder(jolpica_db, output_directory or os.path.join(directory, "shards"))
+    index = shards_builder.build(start_season)
+    click.echo(f"Shards written for {len(index['seasons'])} seasons to {shards_builder.directory}")
+
+
+@cli.command("update-laps")
+@click.option("--directory", "-d", help="Directory of database", required=True)
+@click.option("--output-directory", "-o", help="Directory of the per race shards of the frontend, defaults to <directory>/race_shards")
+@click.option("--start-season", type=int, help="First season with laps", default=defaults.START_SEASON, show_default=True)
+@click.option("--end-season", type=int, help="Last season with laps, defaults to the last one held")
+@click.option("--window", type=int, help="Races fetched and kept in memory at once", default=8, show_default=True)
+@click.option("--max-races", type=int, help="Most races fetched in this run, newest first, the others are left for the next runs")
+@click.option("--rebuild", is_flag=True, help="Derive the positions and shards of every stored race again")
+@click.pass_obj
+def update_laps(obj: dict, directory: str, output_directory: str, start_season: int, end_season: int, window: int, max_races: int, rebuild: bool):
+    from manager.laps import LapsDB
+
+    jolpica_db = get_jolpica_db(obj, directory)
+    laps_db = LapsDB(jolpica_db, directory, output_directory or os.path.join(directory, "race_shards"))
+    summary = laps_db.update(start_season, end_season, window=window, max_races=max_races, rebuild=rebuild)
+    click.echo(json.dumps(summary))
+
+
+@cli.command("build-metrics")
+@click.option("--directory", "-d", help="Directory of database", required=True)
+@click.option("--output", "-o", help=f"Path of the metrics file, defaults to <directory>/{defaults.VARIATION_FILE}")
+@click.option("--incremental", is_flag=True, help="Only compute seasons whose standings changed since the last build")
+@click.pass_obj
+def build_metrics(obj: dict, directory: str, output: str, incremental: bool):
+    from manager.variation import VariationMetrics
+
+    jolpica_db = get_jolpica_db(obj, directory)
+    variation_metrics = VariationMetrics(jolpica_db, output or os.path.join(directory, VariationMetrics.default_file))
+    variation_metrics.build(incremental=incremental)
+
+
+@cli.command("build-championship")
+@click.option("--directory", "-d", help="Directory of database", required=True)
+@click.option("--output", "-o", help=f"Path of the championship outlook file, defaults to <directory>/{defaults.CHAMPIONSHIP_FILE}")
+@click.option("--tensor-cache", help="Directory of the cached points tensors", default=defaults.CHAMPIONSHIP_CACHE, show_default=True)
+@click.pass_obj
+def build_championship(obj: dict, directory: str, output: str, tensor_cache: str):
+    from manager.championship import ChampionshipOutlook
+
+    jolpica_db = get_jolpica_db(obj, directory)
+    outlook = ChampionshipOutlook(jolpica_db, output or os.path.join(directory, ChampionshipOutlook.default_file), cache_directory=tensor_cache)
+    outlook.build()
+
+
+@cli.group("schedule")
+@click.option("--directory", "-d", help="Directory of database", required=True)
+@click.option("--images-directory", "-di", help="Directory of images of the bundle", default=os.path.join("static", "images"), show_default=True)
+@click.option("--bundle-directory", help="Directory of the bundle", default=os.path.join("static", "bundle"), show_default=True)
+@click.pass_obj
+def schedule(obj: dict, directory: str, images_directory: str, bundle_directory: str):
+    """Refreshes planned from the race calendar"""
+    from manager.scheduler import RefreshScheduler
+
+    # Polls must see the API as it is now, a cached empty response would hide the new standings
+    obj["cache"] = None
+    obj["scheduler"] = RefreshScheduler(get_jolpica_db(obj, directory), directory, images_directory, bundle_directory)
+
+
+def parse_now(now: str):
+    from datetime import datetime, timezone
+
+    if now is None:
+        return datetime.now(timezone.utc)
+    now = datetime.fromisoformat(now)
+    return now if now.tzinfo is not None else now.replace(tzinfo=timezone.utc)
+
+
+@schedule.command("plan")
+@click.option("--count", type=int, help="Number of triggers", default=10, show_default=True)
+@click.option("--format", "output_format", type=click.Choice(["json", "cron"]), default="json", show_default=True, help="JSON lines, or crontab lines running schedule run")
+@click.option("--now", help="Plan from this ISO time instead of now, UTC when it has no offset")
+@click.option("--due", is_flag=True, help="Print the triggers schedule run would run now instead of the next ones, nothing when none is due")
+@click.pass_obj
+def schedule_plan(obj: dict, count: int, output_format: str, now: str, due: bool):
+    scheduler = obj["scheduler"]
+    triggers = scheduler.due(parse_now(now)) if due else scheduler.plan(parse_now(now), count)
+    for trigger in triggers:
+        label = f"{trigger['season']} round {trigger['round']}, {trigger['raceName']}" if trigger["kind"] == "race" else "weekly update"
+        if output_format == "cron":
+            time = trigger["time"]
+            click.echo(f"{time.minute} {time.hour} {time.day} {time.month} * python main.py schedule -d {scheduler.directory} run  # {label}")
+        else:
+            click.echo(json.dumps({**trigger, "time": trigger["time"].isoformat()}))
+
+
+@schedule.command("run")
+@click.option("--window", type=int, help=f"Seconds before now whose triggers are run, defaults to the time since the last run in {defaults.SCHEDULE_STATE_FILE}")
+@click.option("--artifact", "artifacts", type=click.Choice(defaults.SCHEDULE_ARTIFACTS), multiple=True, help="Artifacts rebuilt after new standings, all by default")
+@click.option("--now", help="Run as if at this ISO time instead of now, UTC when it has no offset")
+@click.option("--summary-out", help="Also write the JSON summary of the run to this file")
+@click.pass_obj
+def schedule_run(obj: dict, window: int, artifacts: tuple[str], now: str, summary_out: str):
+    from datetime import timedelta
+
+    summary = obj["scheduler"].run(parse_now(now), None if window is None else timedelta(seconds=window), list(artifacts) or None)
+
+    # The summary is the last line of the output, with changed false when no table was written
+    click.echo(json.dumps(summary))
+    if summary_out:
+        os.makedirs(os.path.dirname(summary_out) or ".", exist_ok=True)
+        with open(summary_out, "w") as file:
+            json.dump(summary, file, indent=2)
+
+
+@schedule.command("watch")
+@click.option("--once", is_flag=True, help="Exit after the first trigger")
+@click.pass_obj
+def schedule_watch(obj: dict, once: bool):
+    obj["scheduler"].watch(once=once)
+
+
+@cli.command("bundle")
+@click.option("--data-directory", "-dd", help="Directory of database", default=os.path.join("static", "data"), show_default=True)
+@click.option("--images-directory", "-di", help="Directory of images", default=os.path.join("static", "images"), show_default=True)
+@click.option("--output-directory", "-o", help="Directory of the hashed files and their manifest", default=os.path.join("static", "bundle"), show_default=True)
+@click.option("--report-out", help="Also write the JSON report of the bytes changed since the previous bundle to this file")
+@click.pass_obj
+def bundle(obj: dict, data_directory: str, images_directory: str, output_directory: str, report_out: str):
+    from manager.bundle import StaticBundle
+
+    static_bundle = StaticBundle({"data": data_directory, "images": images_directory}, output_directory)
+    report = static_bundle.build()
+    click.echo(json.dumps(report))
+    if report_out:
+        os.makedirs(os.path.dirname(report_out) or ".", exist_ok=True)
+        with open(report_out, "w") as file:
+            json.dump(report, file, indent=2)
 
 
 if __name__ == "__main__":
@@ -47,4 +499,4 @@ if __name__ == "__main__":
         sys.exit(cli())
     except Exception as e:
         click.echo(f"Error: {e}", err=True)
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
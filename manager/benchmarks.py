@@ -0,0 +1,480 @@
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import get_context
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import pandas as pd
+from PIL import Image
+
+from manager import defaults
+from manager.cache import CacheMissError, ResponseCache
+from manager.fetch import FetchEngine, RateLimiter
+from manager.images import ImagesDB
+from manager.jolpica import JolpicaAPI, JolpicaDB, JolpicaParser
+
+
+class ReplayServer:
+    # Local stand-in for Jolpica, Wikipedia and seeklogo. Jolpica responses are replayed from a ResponseCache
+    # directory, images are served from an images directory with the same layout as static/images.
+    jolpica_path = "/ergast/f1"
+
+    def __init__(self, responses_directory: str, images_directory: str, drivers: pd.DataFrame, constructors: pd.DataFrame):
+        self.responses = ResponseCache(responses_directory, offline=True)
+        self.images_directory = images_directory
+        # Article title -> driverId and constructor name -> constructorId, as the clients will ask for them
+        self.drivers = {self._title(url): id for id, url in zip(drivers["driverId"], drivers["url"], strict=True) if isinstance(url, str)}
+        self.constructors = dict(zip(constructors["name"], constructors["constructorId"], strict=True))
+        self.counts = {}
+        self._lock = threading.Lock()
+        self._sizes = {}
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        self._thread = threading.Thread(target=self._server.serve_forever, name="replay-server", daemon=True)
+
+    def __enter__(self) -> "ReplayServer":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset(self) -> dict[str, int]:
+        with self._lock:
+            counts, self.counts = self.counts, {}
+        return counts
+
+    def _count(self, kind: str):
+        with self._lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def _title(self, url: str) -> str:
+        return unquote(urlsplit(url).path.removeprefix("/wiki/")).replace("_", " ")
+
+    def _image_path(self, subdirectory: str, id: str) -> str | None:
+        path = os.path.join(self.images_directory, subdirectory, f"{id}.png")
+        if os.path.exists(path):
+            return path
+        # Duplicates only exist as aliases of the image they are equal to
+        aliases_path = os.path.join(self.images_directory, subdirectory, "aliases.json")
+        if os.path.exists(aliases_path):
+            with open(aliases_path) as file:
+                alias = json.load(file).get(id)
+            if alias is not None:
+                return os.path.join(self.images_directory, subdirectory, f"{alias}.png")
+        return None
+
+    def _image_size(self, path: str) -> tuple[int, int]:
+        if path not in self._sizes:
+            with Image.open(path) as image:
+                self._sizes[path] = image.size
+        return self._sizes[path]
+
+    def jolpica(self, path: str, query: dict) -> dict | None:
+        parts = [x for x in path.removeprefix(self.jolpica_path).split("/") if x]
+        if not parts:
+            return None
+        season = parts[0] if len(parts) > 1 else None
+        round = parts[1] if len(parts) > 2 else None
+        limit, offset = query.get("limit", [None])[0], query.get("offset", [None])[0]
+        try:
+            return self.responses.get(parts[-1], season, round, limit, offset)
+        except CacheMissError:
+            return None
+
+    def wikipedia_api(self, query: dict) -> dict:
+        # The pageimages and imageinfo queries of ImagesDB, with the title normalization of MediaWiki
+        titles = query["titles"][0].split("|")
+        normalized = [{"from": x, "to": x.replace("_", " ")} for x in titles if "_" in x]
+        pages = []
+        for title in titles:
+            page = {"title": title.replace("_", " ")}
+            if query["prop"][0] == "pageimages":
+                path = self._image_path(ImagesDB.drivers_subdirectory, self.drivers.get(page["title"], ""))
+                if path is not None:
+                    width, height = self._image_size(path)
+                    page.update(pageimage=os.path.basename(path), original={"width": width, "height": height})
+            else:
+                file_name = title.removeprefix("File:")
+                url = f"{self.url}/images/{ImagesDB.drivers_subdirectory}/{quote(file_name)}"
+                page["imageinfo"] = [{"url": url, "thumburl": url}]
+            pages.append(page)
+        return {"query": {"normalized": normalized, "pages": pages}}
+
+    def _handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def send(self, status: int, body: bytes, content_type: str):
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                query = parse_qs(url.query)
+                if url.path.startswith(server.jolpica_path):
+                    server._count("jolpica")
+                    data = server.jolpica(url.path, query)
+                    if data is None:
+                        server._count("unrecorded")
+                        return self.send(404, b"{}", "application/json")
+                    return self.send(200, json.dumps(data).encode(), "application/json")
+
+                if url.path == ImagesDB.wikipedia_api_path:
+                    server._count("wikipedia_api")
+                    return self.send(200, json.dumps(server.wikipedia_api(query)).encode(), "application/json")
+
+                if url.path.startswith("/wiki/"):
+                    server._count("wikipedia")
+                    id = server.drivers.get(server._title(url.path), "")
+                    body = f'<table class="infobox"><td class="infobox-image"><img src="{server.url}/images/{ImagesDB.drivers_subdirectory}/{id}.png"></td></table>'
+                    return self.send(200, body.encode(), "text/html")
+
+                if url.path == "/search":
+                    server._count("seeklogo")
+                    id = server.constructors.get(query.get("q", [""])[0], "")
+                    body = f'<ul class="logoGroupCt"><li><img class="logoImage" src="{server.url}/images/{ImagesDB.constructors_subdirectory}/{id}.png"></li></ul>'
+                    return self.send(200, body.encode(), "text/html")
+
+                if url.path.startswith("/images/"):
+                    server._count("images")
+                    subdirectory, file_name = unquote(url.path.removeprefix("/images/")).split("/", 1)
+                    path = server._image_path(subdirectory, file_name.removesuffix(".png"))
+                    if path is None:
+                        return self.send(404, b"", "image/png")
+                    with open(path, "rb") as file:
+                        return self.send(200, file.read(), "image/png")
+
+                self.send(404, b"", "text/plain")
+
+        return Handler
+
+
+def prepare_update_directory(data_directory: str, directory: str, trimmed_rounds: int):
+    # Copy of the database without the last rounds of standings, so update has them to fetch again
+    shutil.rmtree(directory, ignore_errors=True)
+    shutil.copytree(data_directory, directory)
+    for table in ["drivers_standings", "constructors_standings"]:
+        path = os.path.join(directory, f"{table}.csv")
+        df = pd.read_csv(path)
+        last_season = df["season"].max()
+        last_round = df.loc[df["season"] == last_season, "round"].max()
+        df[(df["season"] < last_season) | (df["round"] <= last_round - trimmed_rounds)].to_csv(path, index=False)
+
+
+def _best_of(repeat: int, setup: callable, run: callable) -> tuple[float, object]:
+    # Setup is not timed, every repetition starts from a fresh state
+    timings = []
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        result = run(state)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+# Runs main.py and writes the peak RSS of the process on exit. Read from /proc/self/status, since the peak RSS
+# of rusage also counts the memory of the process it was started from.
+_STARTUP_WRAPPER = """
+import atexit, runpy, sys
+path = sys.argv.pop(1)
+def report():
+    with open("/proc/self/status") as status, open(path, "w") as file:
+        file.write(next(line.split()[1] for line in status if line.startswith("VmHWM")))
+atexit.register(report)
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def _bench_startup(options: dict) -> dict[str, dict]:
+    # Cold start of main.py: every run is a fresh interpreter, measured with its own wall time and peak RSS
+    main_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+    peak_path = os.path.join(options["workspace"], "startup.peak")
+    season = int(JolpicaDB(options["data_directory"]).load_table("races", ["season"])["season"].max())
+    rows = {}
+    for name, args in BenchmarkSuite.startup_commands.items():
+        args = [x.format(data=options["data_directory"], workspace=options["workspace"], season=season) for x in args]
+        runs = []
+        for _ in range(options["repeat"]):
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, "-c", _STARTUP_WRAPPER, peak_path, main_path, "--no-cache", *args], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            wall = time.perf_counter() - start
+            if process.returncode != 0:
+                raise RuntimeError(f"main.py {' '.join(args)} failed: {process.stderr.decode(errors='replace').strip()}")
+            with open(peak_path) as file:
+                runs.append((wall, int(file.read()) / 1024))
+        wall, peak_rss = min(runs)
+        rows[f"startup_{name}"] = {"wall_s": wall, "items": 1, "peak_rss_mb": peak_rss}
+    return rows
+
+
+def _update_db(options: dict, trimmed_rounds: int) -> JolpicaDB:
+    directory = os.path.join(options["workspace"], "update")
+    prepare_update_directory(options["data_directory"], directory, trimmed_rounds)
+    jolpica_api = JolpicaAPI(FetchEngine(rate_limiter=RateLimiter([])))
+    jolpica_api.BASE_URL = options["server_url"] + ReplayServer.jolpica_path
+    return JolpicaDB(directory, jolpica_api, parser_mode=options["parser_mode"])
+
+
+def _run_update(jolpica_db: JolpicaDB) -> int:
+    jolpica_db.update()
+    return sum(x["inserted"] + x["updated"] for x in jolpica_db.changes.values())
+
+
+def _bench_update(options: dict) -> dict[str, dict]:
+    # update with the last rounds to fetch again
+    wall, rows = _best_of(options["repeat"], lambda: _update_db(options, BenchmarkSuite.update_trimmed_rounds), _run_update)
+    return {"update": {"wall_s": wall, "items": rows}}
+
+
+def _bench_update_noop(options: dict) -> dict[str, dict]:
+    # update on an up to date copy, where only the probe runs. A case of its own, as the requests are counted per case
+    wall, _ = _best_of(options["repeat"], lambda: _update_db(options, 0), _run_update)
+    return {"update_noop": {"wall_s": wall, "items": 1}}
+
+
+def _bench_parser(options: dict) -> dict[str, dict]:
+    # JolpicaParser.parser + extract_other_tables against the schema parser, over every recorded page
+    responses = {}
+    for entry in ResponseCache(options["responses_directory"]).entries():
+        endpoint = JolpicaAPI.METHODS.get(entry["endpoint"].strip("/").removesuffix(".json"))
+        if endpoint in JolpicaParser.schemas:
+            responses.setdefault(endpoint, []).append(entry["data"])
+
+    rows = {}
+    for mode in JolpicaParser.modes:
+        parser = JolpicaParser(JolpicaDB.parser_dtypes(), mode=mode)
+
+        def run(_, parser: JolpicaParser = parser) -> int:
+            total = 0
+            for endpoint, pages in responses.items():
+                page_parser = parser.page_parser(endpoint)
+                tables = parser.tables(endpoint, pd.concat([page_parser(json_data)[0] for json_data in pages], ignore_index=True))
+                total += len(next(iter(tables.values())))
+            return total
+
+        wall, items = _best_of(options["repeat"], lambda: None, run)
+        rows[f"parser_{mode}"] = {"wall_s": wall, "items": items}
+    return rows
+
+
+def _bench_storage(options: dict) -> dict[str, dict]:
+    directory = os.path.join(options["workspace"], "storage")
+    shutil.rmtree(directory, ignore_errors=True)
+    shutil.copytree(options["data_directory"], directory)
+    jolpica_db = JolpicaDB(directory)
+
+    def load(_) -> int:
+        jolpica_db._load_db()
+        return sum(len(df) for df in jolpica_db.db.values() if df is not None)
+
+    load_wall, items = _best_of(options["repeat"], lambda: None, load)
+    save_wall, _ = _best_of(options["repeat"], lambda: None, lambda _: jolpica_db._save_db(list(jolpica_db.db.loaded())))
+    return {"load_db": {"wall_s": load_wall, "items": items}, "save_db": {"wall_s": save_wall, "items": items}}
+
+
+def _bench_concat(options: dict) -> dict[str, dict]:
+    # Upsert of a refreshed last season plus one new round into drivers_standings, with the history repeated to grow it
+    table = "drivers_standings"
+    jolpica_db = JolpicaDB(options["data_directory"])
+    jolpica_db._load_db()
+    history = jolpica_db.db[table]
+    last_season = history["season"].max()
+    new_data = history[history["season"] == last_season].copy()
+    new_data.loc[new_data.index[::2], "points"] += 1
+    next_round = new_data[new_data["round"] == new_data["round"].max()].assign(round=new_data["round"].max() + 1)
+    new_data = pd.concat([new_data, next_round], ignore_index=True)
+
+    rows = {}
+    span = last_season - history["season"].min() + 1
+    for scale in BenchmarkSuite.concat_scales:
+        # Older copies of the history go before it, so the upserted season stays the last one
+        copies = [history.assign(season=history["season"] - span * i) for i in range(scale - 1, 0, -1)]
+        grown = pd.concat([*copies, history], ignore_index=True)
+
+        def setup(grown=grown) -> JolpicaDB:
+            jolpica_db.db[table] = grown
+            return jolpica_db
+
+        wall, _ = _best_of(options["repeat"], setup, lambda db: db._concat_and_clean(table, new_data))
+        rows[f"concat_x{scale}"] = {"wall_s": wall, "items": len(grown)}
+    return rows
+
+
+def _bench_format_image(options: dict) -> dict[str, dict]:
+    # Stored images are already formatted, they are scaled up to the size of a typical article image first
+    images_db = ImagesDB(os.path.join(options["workspace"], "format_image"))
+    directory = os.path.join(options["images_directory"], ImagesDB.drivers_subdirectory)
+    originals = []
+    for file_name in sorted(os.listdir(directory))[: BenchmarkSuite.format_image_count]:
+        if file_name.endswith(".png"):
+            with Image.open(os.path.join(directory, file_name)) as image:
+                originals.append(image.convert("RGBA").resize(BenchmarkSuite.format_image_original_size))
+
+    wall, _ = _best_of(options["repeat"], lambda: None, lambda _: [images_db._format_image(image) for image in originals])
+    return {"format_image": {"wall_s": wall, "items": len(originals)}}
+
+
+def _bench_images(options: dict) -> dict[str, dict]:
+    jolpica_db = JolpicaDB(options["data_directory"])
+    drivers = jolpica_db.get_drivers()
+    drivers["url"] = [options["server_url"] + urlsplit(url).path if isinstance(url, str) else url for url in drivers["url"]]
+    constructors = jolpica_db.get_constructors()
+
+    def setup() -> ImagesDB:
+        directory = os.path.join(options["workspace"], "images")
+        shutil.rmtree(directory, ignore_errors=True)
+        images_db = ImagesDB(directory)
+        images_db.seeklogo_search_url = options["server_url"] + "/search"
+        return images_db
+
+    def run(images_db: ImagesDB) -> int:
+        changed = images_db.update_images_drivers(drivers)["changed"] + images_db.update_images_constructors(constructors)["changed"]
+        images_db.close()
+        return changed
+
+    wall, changed = _best_of(options["repeat"], setup, run)
+    return {"images": {"wall_s": wall, "items": changed}}
+
+
+def _run_case(name: str, options: dict) -> tuple[dict[str, dict], float]:
+    # Runs in its own process, so the peak RSS is the one of this case only
+    rows = BenchmarkSuite.cases[name](options)
+    return rows, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class BenchmarkSuite:
+    cases = {
+        "startup": _bench_startup,
+        "update": _bench_update,
+        "update_noop": _bench_update_noop,
+        "parser": _bench_parser,
+        "storage": _bench_storage,
+        "concat": _bench_concat,
+        "format_image": _bench_format_image,
+        "images": _bench_images,
+    }
+    default_baseline = defaults.BENCHMARK_BASELINE
+    # Allowed increase over the baseline before a row is a regression, requests must not increase at all
+    tolerances = {"wall_s": defaults.BENCHMARK_WALL_TOLERANCE, "peak_rss_mb": 0.20, "requests": 0.0}
+    # Increases below these are timer and allocator noise, whatever their ratio
+    noise_floors = {"wall_s": 0.05, "peak_rss_mb": 10.0, "requests": 0.0}
+    # Commands whose cold start is measured, with {data}, {workspace} and {season} (last season of data)
+    startup_commands = {
+        "help": ["--help"],
+        "update_images_help": ["update-images", "--help"],
+        "query": ["query", "-d", "{data}", "standings", "--season", "{season}"],
+        "build_shards": ["build-shards", "-d", "{data}", "-o", "{workspace}/shards", "--start-season", "{season}"],
+        "build_metrics": ["build-metrics", "-d", "{data}", "-o", "{workspace}/variation.json"],
+        "export_csv": ["export-csv", "-d", "{data}", "-o", "{workspace}/csv"],
+    }
+    update_trimmed_rounds = 3
+    concat_scales = [1, 4, 16]
+    format_image_count = 60
+    format_image_original_size = (800, 1000)
+
+    def __init__(self, data_directory: str, images_directory: str, responses_directory: str, parser_mode: str = "schema"):
+        self.data_directory = data_directory
+        self.images_directory = images_directory
+        self.responses_directory = responses_directory
+        self.parser_mode = parser_mode
+
+    def record(self, jolpica_api: JolpicaAPI) -> int:
+        # Runs the update of the benchmark once with a caching JolpicaAPI, so its responses can be replayed later
+        if jolpica_api.cache is None or os.path.abspath(jolpica_api.cache.directory) != os.path.abspath(self.responses_directory):
+            raise ValueError(f"Recording needs a JolpicaAPI caching to {self.responses_directory}.")
+        with tempfile.TemporaryDirectory() as workspace:
+            directory = os.path.join(workspace, "update")
+            prepare_update_directory(self.data_directory, directory, self.update_trimmed_rounds)
+            JolpicaDB(directory, jolpica_api, parser_mode=self.parser_mode).update()
+        return len(jolpica_api.cache._entries)
+
+    def run(self, cases: list[str] = None, repeat: int = 3) -> pd.DataFrame:
+        cases = list(self.cases) if not cases else cases
+        jolpica_db = JolpicaDB(self.data_directory)
+        rows = []
+        with (
+            tempfile.TemporaryDirectory() as workspace,
+            ReplayServer(self.responses_directory, self.images_directory, jolpica_db.get_drivers(), jolpica_db.get_constructors()) as server,
+        ):
+            options = {
+                "data_directory": self.data_directory,
+                "images_directory": self.images_directory,
+                "responses_directory": self.responses_directory,
+                "parser_mode": self.parser_mode,
+                "server_url": server.url,
+                "workspace": workspace,
+                "repeat": repeat,
+            }
+            for name in cases:
+                server.reset()
+                with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+                    future = executor.submit(_run_case, name, options)
+                    exception = future.exception()
+                counts = server.reset()
+                if counts.get("unrecorded"):
+                    raise RuntimeError(f"Benchmark {name} asked the replay server for {counts['unrecorded']} unrecorded Jolpica responses, record them first.") from exception
+                case_rows, peak_rss = future.result()
+
+                for row_name, row in case_rows.items():
+                    rows.append(
+                        {
+                            "case": name,
+                            "row": row_name,
+                            "wall_s": row["wall_s"],
+                            "peak_rss_mb": row.get("peak_rss_mb", peak_rss),
+                            # Every repetition makes the same requests
+                            "requests": sum(counts.values()) // repeat,
+                            "items": row["items"],
+                            "items_per_s": row["items"] / row["wall_s"] if row["wall_s"] else None,
+                        }
+                    )
+        return pd.DataFrame(rows)
+
+    def load_baseline(self, path: str) -> dict[str, dict]:
+        with open(path) as file:
+            return json.load(file)["rows"]
+
+    def save_baseline(self, report: pd.DataFrame, path: str):
+        # Rows of the cases not run are kept, so one case can be written again on its own
+        rows = self.load_baseline(path) if os.path.exists(path) else {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        rows.update({row["row"]: {metric: row[metric] for metric in self.tolerances} for row in report.to_dict("records")})
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "rows": rows}, file, indent=2)
+        os.replace(tmp_path, path)
+
+    def compare(self, report: pd.DataFrame, baseline: dict[str, dict]) -> tuple[pd.DataFrame, list[str]]:
+        # Ratio of every metric to the baseline, and the rows over their tolerance
+        report = report.copy()
+        regressions = []
+        for metric, tolerance in self.tolerances.items():
+            ratios = []
+            for row in report.to_dict("records"):
+                expected = baseline.get(row["row"], {}).get(metric)
+                ratios.append(row[metric] / expected if expected else None)
+                if expected is not None and row[metric] > expected * (1 + tolerance) and row[metric] - expected > self.noise_floors[metric]:
+                    regressions.append(f"{row['row']} {metric}: {row[metric]:.3f} against {expected:.3f} in the baseline")
+            report[f"{metric}_ratio"] = ratios
+        return report, regressions
@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+import json
+import os
+from pathlib import PurePosixPath
+
+from manager import defaults, profiling
+
+
+class StaticBundle:
+    # Content hashed copies of the frontend files, with gzip and brotli variants of the text ones, and a manifest from
+    # the path of each file in static to its copy. A hashed name never changes content, so browsers can keep it for
+    # good and only download what a new bundle changed.
+    manifest_file = "manifest.json"
+    # Directory in static -> glob patterns of its frontend files, and of the files left out
+    sources = {
+        "data": (["*.csv", "*.json", "shards/**/*.json", "race_shards/**/*.json"], [defaults.SCHEDULE_STATE_FILE]),
+        "images": (["**/*"], ["*/manifest.json", "**/*.tmp"]),
+    }
+    compressed_extensions = [".csv", ".json"]
+    hash_length = 16
+
+    def __init__(self, directories: dict[str, str], directory: str):
+        try:
+            import brotli
+        except ImportError:
+            brotli = None
+            print("brotli is not installed, only gzip variants are written. Install it with `uv sync --extra bundle`.")
+        self.brotli = brotli
+        self.directories = directories
+        self.directory = directory
+
+    def files(self) -> dict[str, str]:
+        # Logical path, like data/drivers.csv, -> path of the file to bundle
+        files = {}
+        for name, source_directory in self.directories.items():
+            patterns, excluded = self.sources[name]
+            for root, _, file_names in os.walk(source_directory):
+                for file_name in file_names:
+                    relative = PurePosixPath(os.path.relpath(os.path.join(root, file_name), source_directory).replace(os.sep, "/"))
+                    if any(relative.full_match(x) for x in patterns) and not any(relative.full_match(x) for x in excluded):
+                        files[f"{name}/{relative}"] = os.path.join(root, file_name)
+        return dict(sorted(files.items()))
+
+    def _hashed_path(self, logical_path: str, digest: str) -> str:
+        stem, extension = os.path.splitext(logical_path)
+        return f"{stem}.{digest[: self.hash_length]}{extension}"
+
+    def _write(self, path: str, content: bytes):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(content)
+        os.replace(tmp_path, path)
+
+    def _bundle_file(self, logical_path: str, source_path: str, previous: dict | None) -> dict:
+        with open(source_path, "rb") as file:
+            content = file.read()
+        digest = hashlib.sha256(content).hexdigest()
+        hashed_path = self._hashed_path(logical_path, digest)
+        item = {"path": hashed_path, "bytes": len(content)}
+        compress = os.path.splitext(logical_path)[1] in self.compressed_extensions
+
+        # Same content as in the previous bundle, its copies are already written
+        if previous is not None and previous["path"] == hashed_path and os.path.exists(os.path.join(self.directory, hashed_path)):
+            if not compress or all(os.path.exists(os.path.join(self.directory, f"{hashed_path}.{x}")) for x in self._encodings()):
+                return previous
+
+        with profiling.stage("bundle.file") as counters:
+            self._write(os.path.join(self.directory, hashed_path), content)
+            counters["bytes"] = len(content)
+            if compress:
+                # mtime 0 keeps the gzip bytes of the same content the same
+                variants = {"gz": gzip.compress(content, compresslevel=9, mtime=0)}
+                if self.brotli is not None:
+                    variants["br"] = self.brotli.compress(content, quality=11)
+                for encoding, compressed in variants.items():
+                    self._write(os.path.join(self.directory, f"{hashed_path}.{encoding}"), compressed)
+                    item[encoding] = len(compressed)
+        return item
+
+    def _encodings(self) -> list[str]:
+        return ["gz"] if self.brotli is None else ["gz", "br"]
+
+    def build(self) -> dict:
+        previous = self.load_manifest().get("files", {})
+        files = {logical_path: self._bundle_file(logical_path, source_path, previous.get(logical_path)) for logical_path, source_path in self.files().items()}
+        manifest = {"files": files}
+        self._prune(files, previous)
+        self._write(os.path.join(self.directory, self.manifest_file), json.dumps(manifest, separators=(",", ":")).encode())
+
+        report = self.report(previous, files)
+        print(
+            f"Bundle of {len(files)} files, {report['bytes']} bytes: {report['added']} added, {report['changed']} changed, "
+            f"{report['removed']} removed, {report['changedBytes']} bytes to download again ({report['changedGzipBytes']} gzipped)"
+        )
+        return report
+
+    def _prune(self, files: dict[str, dict], previous: dict[str, dict]):
+        # Copies of the previous bundle are kept for pages loaded with its manifest, older ones are removed
+        kept = set()
+        for item in [*files.values(), *previous.values()]:
+            kept.update([item["path"], *(f"{item['path']}.{x}" for x in ["gz", "br"])])
+        for root, _, file_names in os.walk(self.directory):
+            for file_name in file_names:
+                relative = os.path.relpath(os.path.join(root, file_name), self.directory).replace(os.sep, "/")
+                if relative != self.manifest_file and relative not in kept:
+                    os.remove(os.path.join(root, file_name))
+
+    def report(self, previous: dict[str, dict], files: dict[str, dict]) -> dict:
+        added = [x for x in files if x not in previous]
+        changed = [x for x in files if x in previous and previous[x]["path"] != files[x]["path"]]
+        downloaded = [files[x] for x in [*added, *changed]]
+        return {
+            "files": len(files),
+            "bytes": sum(x["bytes"] for x in files.values()),
+            "added": len(added),
+            "changed": len(changed),
+            "removed": len([x for x in previous if x not in files]),
+            "unchanged": len(files) - len(added) - len(changed),
+            "changedBytes": sum(x["bytes"] for x in downloaded),
+            "changedGzipBytes": sum(x.get("gz", x["bytes"]) for x in downloaded),
+        }
+
+    def load_manifest(self) -> dict:
+        path = os.path.join(self.directory, self.manifest_file)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as file:
+            return json.load(file)
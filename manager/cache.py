@@ -0,0 +1,142 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from manager import defaults
+
+
+class CacheMissError(LookupError):
+    pass
+
+
+class ResponseCache:
+    DEFAULT_DIRECTORY = defaults.CACHE_DIRECTORY
+    DEFAULT_MAX_BYTES = 256 * 1024**2
+    # Seconds before a response of a season still running is fetched again
+    DEFAULT_TTLS = {
+        "races": 24 * 3600,
+        "driverstandings": 3600,
+        "constructorstandings": 3600,
+        "drivers": 24 * 3600,
+        "constructors": 24 * 3600,
+        "circuits": 7 * 24 * 3600,
+        "results": 3600,
+        "sprint": 3600,
+        "laps": 3600,
+        "pitstops": 3600,
+    }
+    DEFAULT_TTL = 3600
+
+    def __init__(self, directory: str = DEFAULT_DIRECTORY, ttls: dict[str, int] = None, max_bytes: int = DEFAULT_MAX_BYTES, offline: bool = False):
+        self.directory = directory
+        self.ttls = {**self.DEFAULT_TTLS, **(ttls or {})}
+        self.max_bytes = max_bytes
+        self.offline = offline
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._size = 0
+        self._scan()
+
+    def _scan(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".json"):
+                stat = entry.stat()
+                self._entries[entry.name[:-5]] = (stat.st_mtime, stat.st_size)
+                self._size += stat.st_size
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    @staticmethod
+    def key(endpoint: str, season: int = None, round: int = None, limit: int = None, offset: int = None) -> str:
+        endpoint = endpoint.strip("/").removesuffix(".json")
+        parts = [endpoint, season, round, limit, offset or 0]
+        parts = [None if part is None else str(part) for part in parts]
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def _ttl(self, endpoint: str, season: int = None) -> int | None:
+        # Finished seasons never change upstream, so they never expire
+        if season is not None and int(season) < time.gmtime().tm_year:
+            return None
+        return self.ttls.get(endpoint.strip("/").removesuffix(".json"), self.DEFAULT_TTL)
+
+    def get(self, endpoint: str, season: int = None, round: int = None, limit: int = None, offset: int = None) -> dict | None:
+        key = self.key(endpoint, season, round, limit, offset)
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as file:
+                entry = json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            entry = None
+
+        ttl = self._ttl(endpoint, season)
+        if entry is not None and not self.offline and ttl is not None and time.time() - entry["stored"] > ttl:
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            if self.offline:
+                raise CacheMissError(f"Response for {endpoint} (season={season}, round={round}, limit={limit}, offset={offset}) is not cached.")
+            return None
+
+        self.hits += 1
+        self._touch(key)
+        return entry["data"]
+
+    def put(self, endpoint: str, data: dict, season: int = None, round: int = None, limit: int = None, offset: int = None):
+        key = self.key(endpoint, season, round, limit, offset)
+        path = self._path(key)
+        season, round, limit, offset = [None if value is None else int(value) for value in (season, round, limit, offset)]
+        entry = {"endpoint": endpoint, "season": season, "round": round, "limit": limit, "offset": offset, "stored": time.time(), "data": data}
+
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(entry, file, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            _, old_size = self._entries.pop(key, (None, 0))
+            size = os.path.getsize(path)
+            self._entries[key] = (time.time(), size)
+            self._size += size - old_size
+            self._evict()
+
+    def entries(self):
+        # Every stored response, as written by put, expired or not
+        for key in list(self._entries):
+            try:
+                with open(self._path(key), encoding="utf-8") as file:
+                    yield json.load(file)
+            except (FileNotFoundError, json.JSONDecodeError):
+                continue
+
+    def _touch(self, key: str):
+        with self._lock:
+            if key in self._entries:
+                _, size = self._entries[key]
+                now = time.time()
+                self._entries[key] = (now, size)
+                try:
+                    os.utime(self._path(key), (now, now))
+                except FileNotFoundError:
+                    pass
+
+    def _evict(self):
+        if self._size <= self.max_bytes:
+            return
+        for key, (_, size) in sorted(self._entries.items(), key=lambda item: item[1][0]):
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            del self._entries[key]
+            self._size -= size
@@ -0,0 +1,303 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from manager import defaults
+from manager.standings import StandingsEngine
+
+
+class ChampionshipOutlook:
+    # When each title was mathematically decided, when every entity was out of it and the best position it could
+    # still reach after every round. An entity can still finish ahead of another one when its points plus the most
+    # points it can still add reach the other's points, which can only grow. Equal points are decided by countback,
+    # which starts with wins.
+    default_file = defaults.CHAMPIONSHIP_FILE
+    # Frontend mode -> (standings table, id column, championship of StandingsEngine)
+    modes = {
+        "driver": ("drivers_standings", "driverId", "drivers"),
+        "constructor": ("constructors_standings", "constructorId", "constructors"),
+    }
+    # First season of each points system -> most points one entity can score in a race, as (driver, constructor).
+    # Until 1978 constructors only scored with their best placed car, and fastest laps never counted for them.
+    # Shared drives of the 1950s, which could score a little more, are ignored.
+    max_race_points = {
+        1950: (9, 0),
+        1958: (9, 8),
+        1960: (8, 8),
+        1961: (9, 9),
+        1979: (9, 15),
+        1991: (10, 16),
+        2003: (10, 18),
+        2010: (25, 43),
+        2019: (26, 44),
+        2025: (25, 43),
+    }
+    # First season -> most points of a sprint, as (driver, constructor)
+    max_sprint_points = {
+        2021: (3, 5),
+        2022: (8, 15),
+    }
+    # Rounds with a sprint. Later seasons not listed may have one on any round, which only delays a clinch
+    sprint_rounds = {
+        2021: [10, 14, 19],
+        2022: [4, 11, 21],
+        2023: [4, 9, 12, 17, 18, 20],
+        2024: [5, 6, 11, 19, 21, 23],
+        2025: [2, 6, 13, 19, 21, 23],
+    }
+    # Races whose points were doubled
+    double_points_races = {
+        2014: ["Abu Dhabi Grand Prix"],
+    }
+
+    def __init__(self, jolpica_db, path: str, cache_directory: str = defaults.CHAMPIONSHIP_CACHE):
+        self.jolpica_db = jolpica_db
+        self.path = path
+        self.cache_directory = cache_directory
+
+    def _era_value(self, eras: dict[int, tuple[int, int]], season: int, column: int) -> int:
+        first_seasons = [x for x in eras if x <= season]
+        return eras[max(first_seasons)][column] if first_seasons else 0
+
+    def _round_max_points(self, mode: str, season: int, races: pd.DataFrame) -> np.ndarray:
+        # Most points one entity can score in each scheduled round of the season, sprints included
+        _, _, championship = self.modes[mode]
+        column = 0 if mode == "driver" else 1
+        race_names = races["raceName"].to_numpy(dtype=object)
+        points = np.full(len(races), float(self._era_value(self.max_race_points, season, column)))
+        points[np.isin(race_names, self.double_points_races.get(season, []))] *= 2
+        if championship == "constructors":
+            points[np.isin(race_names, StandingsEngine.drivers_only_races)] = 0
+
+        sprint_points = self._era_value(self.max_sprint_points, season, column)
+        if sprint_points:
+            rounds = races["round"].to_numpy(dtype=np.int64)
+            has_sprint = np.isin(rounds, self.sprint_rounds[season]) if season in self.sprint_rounds else np.ones(len(rounds), dtype=bool)
+            points += np.where(has_sprint, sprint_points, 0)
+        return points
+
+    def _remaining_wins(self, mode: str, seasons: np.ndarray, n_rounds: int, races: pd.DataFrame) -> np.ndarray:
+        # Season x round -> most wins one entity can still add after that round, one per race it scores in
+        _, _, championship = self.modes[mode]
+        remaining = np.zeros((len(seasons), n_rounds))
+        for i, season in enumerate(seasons):
+            season_races = races[races["season"] == season].sort_values("round")
+            can_win = np.ones(len(season_races))
+            if championship == "constructors":
+                can_win[season_races["raceName"].isin(StandingsEngine.drivers_only_races).to_numpy()] = 0
+            left = np.append(np.cumsum(can_win[::-1])[::-1], 0)[1:]
+            remaining[i, : len(left)] = left[:n_rounds]
+        return remaining
+
+    def _remaining_points(self, mode: str, seasons: np.ndarray, points: np.ndarray, races: pd.DataFrame) -> np.ndarray:
+        # Season x round x slot -> most points each entity can still add after that round. With dropped scores only the
+        # best results of each block count: the rounds left can only replace the entity's lowest counted results, an
+        # unused one counting as 0. Counted results are rebuilt from how the points grew, as a new result that counts
+        # replaces the lowest one.
+        _, _, championship = self.modes[mode]
+        n_seasons, n_rounds, n_slots = points.shape
+        remaining = np.zeros(points.shape)
+        for i, season in enumerate(seasons):
+            season_races = races[races["season"] == season].sort_values("round")
+            round_points = self._round_max_points(mode, int(season), season_races)
+            n = min(len(round_points), n_rounds)
+            blocks = StandingsEngine.dropped_scores.get(int(season))
+            if championship == "constructors" and season > StandingsEngine.last_best_car_season:
+                blocks = None
+            if blocks is None:
+                remaining[i, :n] = np.append(np.cumsum(round_points[::-1])[::-1], 0)[1 : n + 1, None]
+                continue
+
+            gains = np.diff(points[i, :n], axis=0, prepend=0.0)
+            rows = np.arange(n_slots)
+            start = 0
+            for length, best in blocks:
+                end = len(round_points) if length is None else min(start + length, len(round_points))
+                counted = np.zeros((n_slots, best))
+                for r in range(n):
+                    if start <= r < end:
+                        lowest = counted.argmin(axis=1)
+                        counted[rows, lowest] += gains[r]
+                    # The most points of the rounds left in the block, best first, against the lowest counted results
+                    left = np.sort(round_points[max(start, r + 1) : end])[::-1][:best]
+                    left = np.pad(left, (0, best - len(left)))
+                    remaining[i, r] += np.maximum(left[None, :] - np.sort(counted, axis=1), 0).sum(axis=1)
+                start = end
+        return remaining
+
+    def _digest(self, *dfs: pd.DataFrame) -> str:
+        return format(int(sum(int(pd.util.hash_pandas_object(df, index=False).to_numpy().sum()) for df in dfs) % 2**64), "016x")
+
+    def points_tensor(self, mode: str) -> tuple[np.ndarray, dict]:
+        # Season x round x entity x (points, wins) of the standings, NaN where the entity has no standing, memory mapped from
+        # the cache while the standings and races are unchanged. Entities are indexed per season, see meta["entities"].
+        db = self.jolpica_db
+        table, id_column, _ = self.modes[mode]
+        standings = db.to_storage_dtypes(table, db.db[table])[["season", "round", "points", "wins", id_column]]
+        races = db.to_storage_dtypes("races", db.db["races"])[["season", "round", "raceName"]]
+        digest = self._digest(standings, races)
+
+        tensor_path = os.path.join(self.cache_directory, f"{mode}_points.npy")
+        meta_path = os.path.join(self.cache_directory, f"{mode}_points.json")
+        if os.path.exists(tensor_path) and os.path.exists(meta_path):
+            with open(meta_path) as file:
+                meta = json.load(file)
+            if meta["digest"] == digest:
+                return np.load(tensor_path, mmap_mode="r"), meta
+
+        seasons = np.sort(standings["season"].unique())
+        scheduled = races[races["season"].isin(seasons)].groupby("season")["round"].max().reindex(seasons)
+        scheduled = scheduled.fillna(standings.groupby("season")["round"].max()).astype(int)
+        n_rounds = int(max(scheduled.max(), standings["round"].max())) if len(seasons) else 0
+
+        # Entities of each season take the first slots of that season, in id order
+        pairs = standings[["season", id_column]].drop_duplicates().sort_values(["season", id_column])
+        pairs["slot"] = pairs.groupby("season").cumcount()
+        n_slots = int(pairs["slot"].max()) + 1 if len(pairs) else 0
+        slots = standings.merge(pairs, on=["season", id_column], how="left")
+
+        tensor = np.full((len(seasons), n_rounds, n_slots, 2), np.nan)
+        season_index = np.searchsorted(seasons, slots["season"].to_numpy())
+        tensor[season_index, slots["round"].to_numpy() - 1, slots["slot"].to_numpy()] = slots[["points", "wins"]].to_numpy(dtype=float)
+
+        meta = {
+            "digest": digest,
+            "seasons": [int(x) for x in seasons],
+            "scheduled": [int(x) for x in scheduled],
+            "entities": [group[id_column].tolist() for _, group in pairs.groupby("season", sort=True)],
+        }
+        os.makedirs(self.cache_directory, exist_ok=True)
+        with open(f"{tensor_path}.tmp", "wb") as file:
+            np.save(file, tensor)
+        os.replace(f"{tensor_path}.tmp", tensor_path)
+        with open(f"{meta_path}.tmp", "w") as file:
+            json.dump(meta, file)
+        os.replace(f"{meta_path}.tmp", meta_path)
+        return np.load(tensor_path, mmap_mode="r"), meta
+
+    def compute(self, mode: str) -> dict[str, np.ndarray]:
+        # Every season, round and entity at once. Arrays are season x round (x slot), rounds past the last one
+        # with standings are not played yet.
+        _, _, championship = self.modes[mode]
+        tensor, meta = self.points_tensor(mode)
+        seasons = np.array(meta["seasons"], dtype=np.int64)
+        n_seasons, n_rounds, n_slots, _ = tensor.shape
+        races = self.jolpica_db.to_storage_dtypes("races", self.jolpica_db.db["races"])
+
+        exists = np.zeros((n_seasons, n_slots), dtype=bool)
+        for i, entities in enumerate(meta["entities"]):
+            exists[i, : len(entities)] = True
+        has_standings = ~np.isnan(tensor[:, :, :, 0])
+        played = has_standings.any(axis=2)
+
+        # Counted points and wins never decrease, so a missing standing keeps the last one, and is 0 before the first
+        points, wins = np.moveaxis(np.nan_to_num(np.fmax.accumulate(tensor, axis=1), nan=0.0), 3, 0)
+        excluded = np.zeros(points.shape, dtype=bool)
+        for (season, entity), from_round in StandingsEngine.exclusions[championship].items():
+            i = np.searchsorted(seasons, season)
+            if i < n_seasons and seasons[i] == season and entity in meta["entities"][i]:
+                excluded[i, from_round - 1 :, meta["entities"][i].index(entity)] = True
+        contender = exists[:, None, :] & ~excluded
+
+        remaining = self._remaining_points(mode, seasons, points, races)
+        reachable_wins = wins + self._remaining_wins(mode, seasons, n_rounds, races)[:, :, None]
+        current = np.where(contender, points, -np.inf)
+        reachable = np.where(contender, points + remaining, -np.inf)
+
+        # Ties on points are decided by countback, which starts with wins
+        leader_points = current.max(axis=2)
+        leader = np.where(current == leader_points[:, :, None], wins, -1).argmax(axis=2)
+        leader_wins = np.take_along_axis(wins, leader[:, :, None], axis=2)[:, :, 0]
+        beaten = (reachable < leader_points[:, :, None]) | ((reachable == leader_points[:, :, None]) & (reachable_wins < leader_wins[:, :, None]))
+        eliminated = beaten | excluded
+        # Clinched once every other entity is beaten, whatever the leader still scores
+        others = beaten.copy()
+        np.put_along_axis(others, leader[:, :, None], True, axis=2)
+        clinched = played & others.all(axis=2)
+
+        # Best position still reachable: behind every entity that already has more points than it can reach
+        max_position = 1 + (current[:, :, None, :] > reachable[:, :, :, None]).sum(axis=3)
+        max_position = np.where(excluded, exists.sum(axis=1)[:, None, None], max_position)
+
+        return {
+            "seasons": seasons,
+            "scheduled": np.array(meta["scheduled"], dtype=np.int64),
+            "entities": meta["entities"],
+            "played": played,
+            "points": points,
+            "reachable": np.where(contender, reachable, np.nan),
+            "leader": leader,
+            "clinched": clinched,
+            "eliminated": eliminated & played[:, :, None],
+            "max_position": max_position,
+        }
+
+    def season_outlook(self, mode: str, season: int, round: int = None) -> pd.DataFrame:
+        # Points, most reachable points, best reachable position and whether each entity is still in contention
+        result = self.compute(mode)
+        i = int(np.searchsorted(result["seasons"], season))
+        if i >= len(result["seasons"]) or result["seasons"][i] != season:
+            raise KeyError(f"No standings for season {season}.")
+        played_rounds = np.flatnonzero(result["played"][i])
+        r = int(played_rounds[-1]) if round is None else round - 1
+        if r not in played_rounds:
+            raise KeyError(f"No standings for season {season}, round {round}.")
+
+        n = len(result["entities"][i])
+        df = pd.DataFrame(
+            {
+                "id": result["entities"][i],
+                "points": result["points"][i, r, :n],
+                "reachable": result["reachable"][i, r, :n],
+                "max_position": result["max_position"][i, r, :n],
+                "alive": ~result["eliminated"][i, r, :n],
+            }
+        )
+        return df.sort_values(["points", "reachable"], ascending=False).reset_index(drop=True)
+
+    def build(self) -> dict:
+        outlook = {}
+        for mode in self.modes:
+            result = self.compute(mode)
+            items = []
+            for i, season in enumerate(result["seasons"]):
+                n_played = int(result["played"][i].sum())
+                n = len(result["entities"][i])
+                clinch_rounds = np.flatnonzero(result["clinched"][i])
+                eliminated = result["eliminated"][i, :, :n]
+                eliminated_rounds = np.where(eliminated.any(axis=0), eliminated.argmax(axis=0) + 1, 0)
+                items.append(
+                    {
+                        "season": int(season),
+                        "rounds": n_played,
+                        "scheduled": int(result["scheduled"][i]),
+                        "clinchRound": int(clinch_rounds[0]) + 1 if len(clinch_rounds) else None,
+                        "champion": result["entities"][i][int(result["leader"][i, clinch_rounds[0]])] if len(clinch_rounds) else None,
+                        "entities": [
+                            {
+                                "id": result["entities"][i][slot],
+                                "eliminatedRound": int(eliminated_rounds[slot]) or None,
+                                "maxPosition": result["max_position"][i, :n_played, slot].tolist(),
+                            }
+                            for slot in range(n)
+                        ],
+                    }
+                )
+            outlook[mode] = items
+            decided = sum(item["clinchRound"] is not None for item in items)
+            print(f"Championship outlook for {mode}: {len(items)} seasons, {decided} decided")
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(outlook, file, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+        return outlook
+
+    def load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as file:
+            return json.load(file)
@@ -0,0 +1,25 @@
+import os
+
+# Defaults and choices of the CLI options, shared with the classes that use them. This module only imports
+# the standard library, so main.py can build every command without importing pandas, PIL or bs4.
+CACHE_DIRECTORY = os.path.join(".cache", "jolpica")
+STORAGES = ["csv", "parquet"]
+PARSER_MODES = ["schema", "pandas"]
+DTYPES = ["standard", "compact"]
+QUERY_MODES = ["driver", "constructor"]
+
+IMAGES_MAX_WORKERS = 16
+IMAGES_HOST_LIMIT = 4
+SPRITE_SIZE = 128
+
+START_SEASON = 2000
+VARIATION_FILE = "variation.json"
+CHAMPIONSHIP_FILE = "championship.json"
+CHAMPIONSHIP_CACHE = os.path.join(".cache", "championship")
+SCHEDULE_ARTIFACTS = ["shards", "metrics", "championship", "laps", "bundle"]
+SCHEDULE_WINDOW = 3600
+SCHEDULE_STATE_FILE = "schedule.json"
+
+BENCHMARK_CASES = ["startup", "update", "update_noop", "parser", "storage", "concat", "format_image", "images"]
+BENCHMARK_BASELINE = os.path.join("benchmarks", "baseline.json")
+BENCHMARK_WALL_TOLERANCE = 0.25
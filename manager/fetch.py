@@ -0,0 +1,101 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from manager import profiling
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self) -> float:
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    # Jolpica limits: 4 requests per second burst, 500 requests per hour sustained
+    DEFAULT_LIMITS = [(4.0, 4), (500 / 3600, 500)]
+
+    def __init__(self, limits: list[tuple[float, int]] = None):
+        limits = self.DEFAULT_LIMITS if limits is None else limits
+        self.buckets = [TokenBucket(rate, capacity) for rate, capacity in limits]
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        # Take one token from every bucket at once, so a blocked bucket never wastes the others
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                for bucket in self.buckets:
+                    bucket.refill(now)
+                wait = max((bucket.wait_time() for bucket in self.buckets), default=0.0)
+                if wait == 0:
+                    for bucket in self.buckets:
+                        bucket.tokens -= 1
+                    return
+            time.sleep(wait)
+
+
+class FetchEngine:
+    DEFAULT_MAX_WORKERS = 4
+    DEFAULT_TIMEOUT = 30
+    DEFAULT_MAX_RETRIES = 3
+
+    def __init__(self, max_workers: int = DEFAULT_MAX_WORKERS, rate_limiter: RateLimiter = None, max_retries: int = DEFAULT_MAX_RETRIES):
+        self.max_workers = max_workers
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.max_retries = max_retries
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._executor = None
+
+    def get_json(self, url: str, params: dict = None) -> dict:
+        with profiling.stage("jolpica.request") as counters:
+            for attempt in range(self.max_retries + 1):
+                self.rate_limiter.acquire()
+                response = self.session.get(url, params=params, timeout=self.DEFAULT_TIMEOUT)
+                counters["bytes"] = counters.get("bytes", 0) + len(response.content)
+                if response.status_code in (429, 503) and attempt < self.max_retries:
+                    counters["retries"] = counters.get("retries", 0) + 1
+                    time.sleep(self._retry_after(response, attempt))
+                    continue
+                response.raise_for_status()
+                return response.json()
+
+    def map(self, fn: callable, items: list) -> list:
+        # Results are returned in the same order as items, whatever order they finish in
+        items = list(items)
+        if len(items) <= 1 or self.max_workers <= 1:
+            return [fn(item) for item in items]
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="jolpica")
+        return list(self._executor.map(fn, items))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        self.session.close()
+
+    def _retry_after(self, response: requests.Response, attempt: int) -> float:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None and retry_after.isdigit():
+            return float(retry_after)
+        return float(2**attempt)
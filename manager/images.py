@@ -1,13 +1,25 @@
+import hashlib
 import io
+import json
+import math
 import os
+import random
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from email.utils import parsedate_to_datetime
+from functools import partial
+from urllib.parse import unquote, urljoin, urlsplit, urlunsplit
 
 import pandas as pd
 import requests
 from bs4 import BeautifulSoup
 from PIL import Image
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
+from manager import defaults, profiling
+
 
 class ImagesDB:
     default_image_size = (250, 250)
@@ -28,24 +40,187 @@ class ImagesDB:
         "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/142.0.0.0 Safari/537.36",
     }
 
+    seeklogo_search_url = "https://seeklogo.com/search"
+    # MediaWiki API of the wiki of each article, titles are resolved in batches of the API maximum
+    wikipedia_api_path = "/w/api.php"
+    wikipedia_batch_size = 50
+
     drivers_subdirectory = "drivers"
     constructors_subdirectory = "constructors"
+    sprites_subdirectory = "sprites"
+    unknown_image = "unknown.png"
+
+    # Variants of every PNG, written to <subdirectory>/<size>/<id>.<format>
+    variant_sizes = [64, 128]
+    variant_formats = ["webp", "avif"]
+    encode_options = {
+        "webp": {"quality": 80, "method": 6},
+        "avif": {"quality": 50, "speed": 6},
+    }
+    sprite_size = defaults.SPRITE_SIZE
+
+    default_max_workers = defaults.IMAGES_MAX_WORKERS
+    # Concurrent requests to the same host, wikipedia and upload.wikimedia.org are limited separately
+    default_host_limit = defaults.IMAGES_HOST_LIMIT
+    timeout = 30
+    max_retries = 5
+    backoff_base = 0.5
+    backoff_max = 30.0
+    retry_status = {429, 500, 502, 503, 504}
+    # Seconds before an image already in the manifest is checked upstream again
+    revalidate_after = 30 * 24 * 3600
 
-    def __init__(self, directory: str) -> None:
+    def __init__(self, directory: str, max_workers: int = default_max_workers, host_limit: int = default_host_limit) -> None:
         self.directory = directory
+        self.max_workers = max_workers
+        self.host_limit = host_limit
+
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=max(max_workers, host_limit))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._host_semaphores = {}
+        self._host_lock = threading.Lock()
+        self._manifests = {}
+
+    def close(self):
+        self.session.close()
+
+    def _host_semaphore(self, url: str) -> threading.BoundedSemaphore:
+        host = urlsplit(url).netloc
+        with self._host_lock:
+            if host not in self._host_semaphores:
+                self._host_semaphores[host] = threading.BoundedSemaphore(self.host_limit)
+            return self._host_semaphores[host]
+
+    def _get(self, url: str, params: dict = None, headers: dict = None) -> requests.Response | None:
+        # The host slot is only held during the request, never while backing off
+        response = None
+        with profiling.stage("images.request") as counters:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    with self._host_semaphore(url):
+                        response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+                    counters["bytes"] = counters.get("bytes", 0) + len(response.content)
+                    if response.status_code not in self.retry_status:
+                        return response
+                except requests.exceptions.RequestException:
+                    response = None
+                if attempt < self.max_retries:
+                    counters["retries"] = counters.get("retries", 0) + 1
+                    time.sleep(self._backoff(attempt, response))
+            return response
 
-    def _get_image_url_from_wikipedia(self, url: str) -> str:
-        response = requests.get(url, headers=self.headers)
+    def _backoff(self, attempt: int, response: requests.Response = None) -> float:
+        retry_after = None if response is None else response.headers.get("Retry-After")
+        if retry_after is not None:
+            if retry_after.strip().isdigit():
+                return min(float(retry_after), self.backoff_max)
+            try:
+                return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0), self.backoff_max)
+            except (TypeError, ValueError):
+                pass
+        # Full jitter, so the workers that failed together do not retry together
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    def _get_image_url_from_wikipedia(self, url: str) -> str | None:
+        response = self._get(url)
+        if response is None or response.status_code != 200:
+            return None
         soup = BeautifulSoup(response.text, features="html.parser")
         try:
-            img_url = "https:" + soup.find(class_="infobox-image").find("img")["src"]
+            img_url = urljoin(response.url, soup.find(class_="infobox-image").find("img")["src"])
         except AttributeError:
             img_url = None
         return img_url
 
+    def _wikipedia_article(self, url: str) -> tuple[str, str] | None:
+        # API url and title of a wiki article url, like http://en.wikipedia.org/wiki/Lewis_Hamilton
+        parts = urlsplit(url)
+        if not parts.path.startswith("/wiki/"):
+            return None
+        return urlunsplit((parts.scheme, parts.netloc, self.wikipedia_api_path, "", "")), unquote(parts.path[len("/wiki/") :])
+
+    def _wikipedia_query(self, api_url: str, titles: list[str], params: dict) -> dict[str, dict]:
+        # Pages of a query by their requested title, following the title normalizations and redirects of the API
+        params = {"action": "query", "format": "json", "formatversion": 2, "redirects": 1, "titles": "|".join(titles), **params}
+        response = self._get(api_url, params=params)
+        if response is None or response.status_code != 200:
+            return {}
+        query = response.json().get("query", {})
+
+        renames = {x["from"]: x["to"] for x in query.get("normalized", []) + query.get("redirects", [])}
+        pages = {page["title"]: page for page in query.get("pages", [])}
+        resolved = {}
+        for title in titles:
+            final_title = title
+            for _ in range(3):
+                final_title = renames.get(final_title, final_title)
+            if final_title in pages:
+                resolved[title] = pages[final_title]
+        return resolved
+
+    def _get_images_urls_from_wikipedia(self, urls: dict[str, str]) -> dict[str, str]:
+        # Image of each article through the pageimages and imageinfo APIs, 50 titles per request instead of one
+        # article per driver. Thumbnails are asked with their shorter side at the pipeline size, so they are only
+        # cropped, never upscaled. Articles missing here are left to the HTML scraper.
+        size = min(self.default_image_size)
+        articles = {}
+        for id, url in urls.items():
+            article = self._wikipedia_article(url) if isinstance(url, str) else None
+            if article is not None:
+                articles.setdefault(article[0], {})[id] = article[1]
+
+        def batches(items: list) -> list[list]:
+            return [items[i : i + self.wikipedia_batch_size] for i in range(0, len(items), self.wikipedia_batch_size)]
+
+        def page_images(api_url: str, titles: list[str]) -> dict[str, dict]:
+            return self._wikipedia_query(api_url, titles, {"prop": "pageimages", "piprop": "name|original"})
+
+        def thumbnails(api_url: str, files: list[str], params: dict) -> dict[str, dict]:
+            return self._wikipedia_query(api_url, [f"File:{x}" for x in files], {"prop": "imageinfo", "iiprop": "url|size", **params})
+
+        images_urls = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="wikipedia") as executor:
+            for api_url, titles in articles.items():
+                pages = {}
+                for result in executor.map(partial(page_images, api_url), batches(sorted(set(titles.values())))):
+                    pages.update(result)
+
+                # Portrait images are scaled by width and landscape ones by height, one request per orientation and batch
+                files = {}
+                for page in pages.values():
+                    original = page.get("original")
+                    if page.get("pageimage") and original:
+                        files[page["pageimage"]] = (original["width"], original["height"])
+                portrait = sorted(x for x, (width, height) in files.items() if width <= height)
+                landscape = sorted(x for x, (width, height) in files.items() if width > height)
+
+                requests_params = [(batch, {"iiurlwidth": size}) for batch in batches(portrait)]
+                for batch in batches(landscape):
+                    max_width = max(math.ceil(size * files[x][0] / files[x][1]) for x in batch)
+                    requests_params.append((batch, {"iiurlwidth": max_width, "iiurlheight": size}))
+
+                files_urls = {}
+                for result in executor.map(partial(thumbnails, api_url), [x for x, _ in requests_params], [x for _, x in requests_params]):
+                    for title, page in result.items():
+                        info = page.get("imageinfo", [{}])[0]
+                        if info.get("thumburl") or info.get("url"):
+                            files_urls[title.removeprefix("File:")] = info.get("thumburl") or info.get("url")
+
+                for id, title in titles.items():
+                    file_name = pages.get(title, {}).get("pageimage")
+                    if file_name in files_urls:
+                        images_urls[id] = files_urls[file_name]
+        return images_urls
+
     def _get_image_url_from_seeklogo(self, name: str) -> str | None:
         params = {"q": name}
-        response = requests.get("https://seeklogo.com/search", params=params, headers=self.headers)
+        response = self._get(self.seeklogo_search_url, params=params)
+        if response is None or response.status_code != 200:
+            return None
         soup = BeautifulSoup(response.content, "html.parser")
         img = soup.select_one("ul.logoGroupCt img.logoImage")
         return img["src"] if img and img.get("src") else None
@@ -65,61 +240,337 @@ class ImagesDB:
 
         return image_resized
 
-    def _save_image(self, image: Image.Image, id: str, subdirectory: str) -> None:
+    def manifest(self, subdirectory: str) -> "ImagesManifest":
+        with self._host_lock:
+            if subdirectory not in self._manifests:
+                manifest = ImagesManifest(os.path.join(self.directory, subdirectory))
+                if manifest.index():
+                    manifest.save()
+                self._manifests[subdirectory] = manifest
+            return self._manifests[subdirectory]
+
+    def _is_due(self, entity: dict | None, source: str, now: int, refresh: bool = False) -> bool:
+        # Entities are fetched again when new, when their source changed or once their last check is too old
+        if entity is None or entity.get("asset") is None or refresh:
+            return True
+        if entity.get("source") is not None and entity["source"] != source:
+            return True
+        return now - entity.get("checked", 0) > self.revalidate_after
+
+    def _fetch_image(self, manifest: "ImagesManifest", id: str, source: str, img_url: str, now: int) -> str:
+        entity = manifest.entities.get(id, {})
+        headers = {}
+        if entity.get("url") == img_url and entity.get("asset") is not None:
+            # Same image as last time, the server only sends it back when it changed
+            if entity.get("etag"):
+                headers["If-None-Match"] = entity["etag"]
+            if entity.get("last_modified"):
+                headers["If-Modified-Since"] = entity["last_modified"]
+
+        with profiling.stage("images.download"):
+            response = self._get(img_url, headers=headers)
+        if response is None or response.status_code not in (200, 304):
+            print(f"\tError downloading image {id}: {img_url}")
+            return "failed"
+
+        changes = {
+            "source": source,
+            "url": img_url,
+            "etag": response.headers.get("ETag", entity.get("etag") if response.status_code == 304 else None),
+            "last_modified": response.headers.get("Last-Modified", entity.get("last_modified") if response.status_code == 304 else None),
+            "checked": now,
+        }
+        if response.status_code == 304:
+            manifest.update(id, changes)
+            return "unchanged"
+
+        changes["source_sha256"] = hashlib.sha256(response.content).hexdigest()
+        if changes["source_sha256"] == entity.get("source_sha256") and entity.get("asset") is not None:
+            manifest.update(id, changes)
+            return "unchanged"
+
+        with profiling.stage("images.format"):
+            image = self._format_image(Image.open(io.BytesIO(response.content)))
+            buffer = io.BytesIO()
+            image.save(buffer, format="PNG")
+        with profiling.stage("images.store"):
+            changed = manifest.store(id, buffer.getvalue())
+            manifest.update(id, changes)
+        return "changed" if changed else "unchanged"
+
+    def _update_images(self, sources: dict[str, str], resolve: callable, subdirectory: str, desc: str, refresh: bool = False, resolve_many: callable = None) -> dict[str, int]:
+        # Each image goes through resolve, download, format and store in its own task, so the stages of
+        # different images overlap and only the requests to the same host are limited.
+        # resolve_many resolves the sources in batches first, resolve is only called for the ones it missed.
+        with profiling.stage(f"images.update.{subdirectory}") as stage_counters:
+            manifest = self.manifest(subdirectory)
+            now = int(time.time())
+            due = {id: source for id, source in sources.items() if self._is_due(manifest.entities.get(id), source, now, refresh)}
+
+            with profiling.stage("images.resolve_batch") as counters:
+                resolved = resolve_many(due) if resolve_many is not None and due else {}
+                counters.update(requested=len(due) if resolve_many is not None else 0, resolved=len(resolved))
+            if resolve_many is not None and due:
+                print(f"Images {subdirectory}: {len(resolved)} of {len(due)} urls resolved in batches")
+
+            def process(id: str, source: str) -> str:
+                img_url = resolved.get(id)
+                if img_url is None:
+                    with profiling.stage("images.resolve"):
+                        img_url = resolve(source)
+                if img_url is None:
+                    return "failed"
+                return self._fetch_image(manifest, id, source, img_url, now)
+
+            counts = {"changed": 0, "unchanged": 0, "failed": 0, "skipped": len(sources) - len(due)}
+            with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="images") as executor:
+                futures = [executor.submit(process, id, source) for id, source in due.items()]
+                for future in tqdm(as_completed(futures), total=len(futures), desc=desc):
+                    counts[future.result()] += 1
+
+            manifest.save()
+            stage_counters.update(counts)
+        print(f"Images {subdirectory}: {counts['changed']} changed, {counts['unchanged']} unchanged, {counts['failed']} failed, {counts['skipped']} skipped")
+        return counts
+
+    def update_images_constructors(self, constructors: pd.DataFrame, refresh: bool = False) -> dict[str, int]:
+        sources = dict(zip(constructors["constructorId"], constructors["name"], strict=True))
+        return self._update_images(sources, self._get_image_url_from_seeklogo, self.constructors_subdirectory, "Constructors images", refresh)
+
+    def update_images_drivers(self, drivers: pd.DataFrame, refresh: bool = False) -> dict[str, int]:
+        sources = dict(zip(drivers["driverId"], drivers["url"], strict=True))
+        return self._update_images(
+            sources,
+            self._get_image_url_from_wikipedia,
+            self.drivers_subdirectory,
+            "Drivers images",
+            refresh,
+            resolve_many=self._get_images_urls_from_wikipedia,
+        )
+
+    def _variants(self, subdirectory: str, id: str, sizes: list[int], formats: list[str]) -> dict[str, tuple[str, int, str]]:
         dir_path = os.path.join(self.directory, subdirectory)
-        os.makedirs(dir_path, exist_ok=True)
-        image_path = os.path.join(dir_path, f"{id}.png")
-        image.save(image_path, format="PNG")
+        return {f"{size}.{format}": (os.path.join(dir_path, str(size), f"{id}.{format}"), size, format) for size in sizes for format in formats}
 
-    def _download_image(self, url: str) -> Image.Image | None:
-        for _ in range(5):
-            try:
-                response = requests.get(url, headers=self.headers)
-                if response.status_code == 200:
-                    break
-            except requests.exceptions.RequestException:
-                pass
-            time.sleep(3)
-        if response.status_code != 200:
-            print(f"\tError downloading image for driver {id}: {url}")
-            return
-        image = Image.open(io.BytesIO(response.content))
-        return image
-
-    def _get_constructors_urls(self, constructors: pd.DataFrame) -> dict:
-        constructors_images = {}
-        existing_ids = set([x.replace(".png", "") for x in os.listdir(os.path.join(self.directory, self.constructors_subdirectory))])
-        constructors = constructors[~constructors["constructorId"].isin(existing_ids)].copy()
-        for _, constructor in tqdm(constructors.iterrows(), total=constructors.shape[0], desc="Urls constructors"):
-            img_url = self._get_image_url_from_seeklogo(constructor.name)
-            if img_url is not None:
-                constructors_images[constructor.constructorId] = img_url
-        return constructors_images
-
-    def update_images_constructors(self, constructors: pd.DataFrame):
-        constructors_images_urls = self._get_constructors_urls(constructors)
-        for constructor_id, img_url in tqdm(constructors_images_urls.items(), desc="Downloading constructors images"):
-            image = self._download_image(img_url)
-            if image is None:
-                continue
-            image_formatted = self._format_image(image)
-            self._save_image(image_formatted, constructor_id, self.constructors_subdirectory)
-
-    def _get_driver_images_urls(self, drivers: pd.DataFrame) -> dict:
-        drivers_images = {}
-        existing_ids = set([x.replace(".png", "") for x in os.listdir(os.path.join(self.directory, self.drivers_subdirectory))])
-        drivers = drivers[~drivers["driverId"].isin(existing_ids)].copy()
-        for _, driver in tqdm(drivers.iterrows(), total=drivers.shape[0], desc="Urls drivers"):
-            img_url = self._get_image_url_from_wikipedia(driver.url)
-            if img_url is not None:
-                drivers_images[driver.driverId] = img_url
-        return drivers_images
-
-    def update_images_drivers(self, drivers: pd.DataFrame):
-        drivers_images_urls = self._get_driver_images_urls(drivers)
-        for driver_id, img_url in tqdm(drivers_images_urls.items(), desc="Downloading drivers images"):
-            image = self._download_image(img_url)
-            if image is None:
-                continue
-            image_formatted = self._format_image(image)
-            self._save_image(image_formatted, driver_id, self.drivers_subdirectory)
+    def build_variants(self, subdirectory: str, sizes: list[int] = None, formats: list[str] = None, processes: int = None) -> int:
+        # Variants are encoded once per asset content, across processes since encoding is CPU bound
+        sizes = self.variant_sizes if sizes is None else sizes
+        formats = self.variant_formats if formats is None else formats
+        if not os.path.isdir(os.path.join(self.directory, subdirectory)):
+            return 0
+        manifest = self.manifest(subdirectory)
+
+        tasks = []
+        for asset_id, asset in sorted(manifest.assets.items()):
+            variants = self._variants(subdirectory, asset_id, sizes, formats)
+            if asset.get("encoded") == asset["sha256"]:
+                variants = {name: x for name, x in variants.items() if name not in asset["outputs"] or not os.path.exists(x[0])}
+            if variants:
+                tasks.append((asset_id, variants))
+
+        written = 0
+        with profiling.stage(f"images.variants.{subdirectory}") as counters, ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = {}
+            for asset_id, variants in tasks:
+                futures[executor.submit(_encode_variants, manifest.asset_path(asset_id), list(variants.values()), self.encode_options)] = (asset_id, variants)
+            for future in tqdm(as_completed(futures), total=len(futures), desc=f"Variants {subdirectory}"):
+                written += future.result()
+                asset_id, variants = futures[future]
+                manifest.set_outputs(asset_id, {name: os.path.relpath(path, manifest.directory) for name, (path, _, _) in variants.items()})
+            counters["written"] = written
+
+        manifest.save()
+        return written
+
+    def build_sprites(self, subdirectory: str, seasons: dict[int, list[str]], size: int = None, formats: list[str] = None, processes: int = None) -> list[int]:
+        # One atlas per season with every entity of the season, plus a JSON map of the cell of each entity.
+        # Atlases whose entities and images did not change are kept.
+        size = self.sprite_size if size is None else size
+        formats = self.variant_formats if formats is None else formats
+        manifest = self.manifest(subdirectory)
+        sprites_path = os.path.join(self.directory, self.sprites_subdirectory, subdirectory)
+        unknown_path = os.path.join(self.directory, self.unknown_image)
+        os.makedirs(sprites_path, exist_ok=True)
+
+        tasks = []
+        for season, ids in sorted(seasons.items()):
+            ids = sorted(set(ids))
+            # Aliases point to the file of their asset, so identical images also share a cell
+            sources = {id: manifest.asset_path(manifest.asset(id)) if manifest.asset(id) else unknown_path for id in ids}
+            map_path = os.path.join(sprites_path, f"{season}.json")
+            if os.path.exists(map_path):
+                with open(map_path) as file:
+                    sprite_map = json.load(file)
+                map_mtime = os.path.getmtime(map_path)
+                same_sources = all(os.path.getmtime(path) <= map_mtime for path in sources.values() if os.path.exists(path))
+                if sprite_map["size"] == size and sprite_map["formats"] == formats and list(sprite_map["entities"].keys()) == ids and same_sources:
+                    continue
+            tasks.append((season, sources))
+
+        with profiling.stage(f"images.sprites.{subdirectory}") as counters, ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [executor.submit(_build_sprite, sources, size, formats, os.path.join(sprites_path, str(season)), self.encode_options) for season, sources in tasks]
+            for future in tqdm(as_completed(futures), total=len(futures), desc=f"Sprites {subdirectory}"):
+                future.result()
+            counters["written"] = len(tasks)
+        return [season for season, _ in tasks]
+
+
+class ImagesManifest:
+    file_name = "manifest.json"
+    aliases_file_name = "aliases.json"
+
+    # entities: id -> source, url, etag, last_modified, source_sha256, checked and the asset holding its image
+    # assets: id -> sha256 of the stored PNG, derived outputs and the sha256 they were encoded from
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(directory, self.file_name)
+        self.entities = {}
+        self.assets = {}
+        self._lock = threading.RLock()
+
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                data = json.load(file)
+            self.entities = data["entities"]
+            self.assets = data["assets"]
+
+    def asset_path(self, asset_id: str) -> str:
+        return os.path.join(self.directory, f"{asset_id}.png")
+
+    def asset(self, id: str) -> str | None:
+        return self.entities.get(id, {}).get("asset")
+
+    def aliases(self) -> dict[str, str]:
+        return {id: entity["asset"] for id, entity in sorted(self.entities.items()) if entity.get("asset") not in (None, id)}
+
+    def index(self) -> int:
+        # PNGs not in the manifest yet are added, the ones identical to a stored asset are collapsed into it.
+        # Returns the number of PNGs added.
+        if not os.path.isdir(self.directory):
+            return 0
+        added = 0
+        with self._lock:
+            for file_name in sorted(os.listdir(self.directory)):
+                id = file_name[:-4]
+                if not file_name.endswith(".png") or id in self.assets:
+                    continue
+                with open(self.asset_path(id), "rb") as file:
+                    sha256 = hashlib.sha256(file.read()).hexdigest()
+                asset_id = self._find_asset(sha256)
+                if asset_id is None:
+                    self.assets[id] = {"sha256": sha256, "outputs": {"png": file_name}}
+                    asset_id = id
+                else:
+                    os.remove(self.asset_path(id))
+                self.entities.setdefault(id, {"checked": int(time.time())})["asset"] = asset_id
+                added += 1
+        return added
+
+    def update(self, id: str, changes: dict):
+        with self._lock:
+            self.entities.setdefault(id, {}).update(changes)
+
+    def store(self, id: str, png: bytes) -> bool:
+        # Stores the image of id, or points id to an identical asset. Returns whether the image of id changed.
+        sha256 = hashlib.sha256(png).hexdigest()
+        with self._lock:
+            current = self.asset(id)
+            if current is not None and self.assets.get(current, {}).get("sha256") == sha256:
+                return False
+            if current == id:
+                self._release(id)
+
+            asset_id = self._find_asset(sha256)
+            if asset_id is None:
+                os.makedirs(self.directory, exist_ok=True)
+                tmp_path = f"{self.asset_path(id)}.tmp"
+                with open(tmp_path, "wb") as file:
+                    file.write(png)
+                os.replace(tmp_path, self.asset_path(id))
+                self.assets[id] = {"sha256": sha256, "outputs": {"png": f"{id}.png"}}
+                asset_id = id
+            self.entities.setdefault(id, {})["asset"] = asset_id
+            return True
+
+    def set_outputs(self, asset_id: str, outputs: dict[str, str]):
+        with self._lock:
+            asset = self.assets[asset_id]
+            asset["outputs"].update(outputs)
+            asset["encoded"] = asset["sha256"]
+
+    def save(self):
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            data = {"entities": dict(sorted(self.entities.items())), "assets": dict(sorted(self.assets.items()))}
+            for path, content in [(self.path, data), (os.path.join(self.directory, self.aliases_file_name), self.aliases())]:
+                with open(f"{path}.tmp", "w") as file:
+                    json.dump(content, file, indent=1)
+                os.replace(f"{path}.tmp", path)
+
+    def _find_asset(self, sha256: str) -> str | None:
+        return next((asset_id for asset_id, asset in self.assets.items() if asset["sha256"] == sha256), None)
+
+    def _release(self, asset_id: str):
+        # The asset of id is about to change: its aliases keep the old image, moved to the first of them
+        asset = self.assets.pop(asset_id)
+        aliases = sorted(x for x, entity in self.entities.items() if x != asset_id and entity.get("asset") == asset_id)
+        for name, output in asset["outputs"].items():
+            path = os.path.join(self.directory, output)
+            if name == "png" and aliases:
+                os.replace(path, self.asset_path(aliases[0]))
+            elif os.path.exists(path):
+                os.remove(path)
+        if aliases:
+            self.assets[aliases[0]] = {"sha256": asset["sha256"], "outputs": {"png": f"{aliases[0]}.png"}}
+            for alias in aliases:
+                self.entities[alias]["asset"] = aliases[0]
+
+
+def _open_rgba(path: str) -> Image.Image:
+    image = Image.open(path)
+    return image.convert("RGBA") if image.mode != "RGBA" else image
+
+
+def _encode_variants(source: str, outputs: list[tuple[str, int, str]], encode_options: dict[str, dict]) -> int:
+    # Runs in a worker process, the PNG is decoded once for all its variants
+    image = _open_rgba(source)
+    for path, size, format in outputs:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        image.resize((size, size), Image.LANCZOS).save(tmp_path, format=format.upper(), **encode_options.get(format, {}))
+        os.replace(tmp_path, path)
+    return len(outputs)
+
+
+def _build_sprite(sources: dict[str, str], size: int, formats: list[str], path: str, encode_options: dict[str, dict]) -> dict:
+    # Runs in a worker process. Entities without an image share one cell with the unknown image.
+    cells = {}
+    for source in sources.values():
+        if source not in cells:
+            cells[source] = len(cells)
+    columns = math.ceil(math.sqrt(len(cells)))
+    rows = math.ceil(len(cells) / columns)
+
+    atlas = Image.new("RGBA", (columns * size, rows * size))
+    for source, index in cells.items():
+        atlas.paste(_open_rgba(source).resize((size, size), Image.LANCZOS), ((index % columns) * size, (index // columns) * size))
+
+    images = {}
+    for format in formats:
+        file_name = f"{os.path.basename(path)}.{format}"
+        atlas.save(f"{path}.{format}.tmp", format=format.upper(), **encode_options.get(format, {}))
+        os.replace(f"{path}.{format}.tmp", f"{path}.{format}")
+        images[format] = file_name
+
+    sprite_map = {
+        "size": size,
+        "width": atlas.width,
+        "height": atlas.height,
+        "formats": formats,
+        "images": images,
+        "entities": {id: [(cells[source] % columns) * size, (cells[source] // columns) * size] for id, source in sources.items()},
+    }
+    with open(f"{path}.json.tmp", "w") as file:
+        json.dump(sprite_map, file, separators=(",", ":"))
+    os.replace(f"{path}.json.tmp", f"{path}.json")
+    return sprite_map
@@ -1,14 +1,52 @@
+import json
 import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 
+import numpy as np
 import pandas as pd
-import requests
+
+from manager import defaults, profiling
+from manager.cache import ResponseCache
+from manager.fetch import FetchEngine
+from manager.query import JolpicaQuery
+from manager.schema import CompactSchema, key_values
+from manager.standings import StandingsEngine
+from manager.storage import CSVStorage, LazyTables
 
 
 class JolpicaAPI:
     BASE_URL = "https://api.jolpi.ca/ergast/f1"
     DEFAULT_LIMIT = 100
+    # Endpoint -> method, for the responses read back from the cache
+    METHODS = {
+        "races": "races",
+        "driverstandings": "drivers_standings",
+        "constructorstandings": "constructors_standings",
+        "drivers": "drivers",
+        "constructors": "constructors",
+        "circuits": "circuits",
+        "results": "results",
+        "sprint": "sprint",
+        "laps": "laps",
+        "pitstops": "pitstops",
+    }
+
+    def __init__(self, fetch_engine: FetchEngine = None, cache: ResponseCache = None):
+        self.fetch_engine = fetch_engine if fetch_engine is not None else FetchEngine()
+        self.cache = cache
+
+    def __requests_get(self, endpoint, season: int = None, round: int = None, limit: int = DEFAULT_LIMIT, offset: int = None, fresh: bool = False) -> dict:
+        # fresh skips reading the cache, to see the API as it is now, unless the cache is offline. The response is still cached.
+        if self.cache is not None and (not fresh or self.cache.offline):
+            data = self.cache.get(endpoint, season, round, limit, offset)
+            profiling.count("jolpica.cache", hits=int(data is not None), misses=int(data is None))
+            if data is not None:
+                return data
 
-    def __requests_get(self, endpoint, season: int = None, round: int = None, limit: int = DEFAULT_LIMIT, offset: int = None) -> dict:
         url = f"{self.BASE_URL}"
         if season:
             url += f"/{season}"
@@ -17,17 +55,20 @@ class JolpicaAPI:
 
         url += f"/{endpoint}"
         params = {"limit": limit, "offset": offset}
-        response = requests.get(url, params=params)
-        return response.json()
+        data = self.fetch_engine.get_json(url, params=params)
+
+        if self.cache is not None:
+            self.cache.put(endpoint, data, season, round, limit, offset)
+        return data
 
-    def constructors_standings(self, season: int, round: int = None, limit: int = DEFAULT_LIMIT, offset: int = None) -> dict:
-        return self.__requests_get("/constructorstandings.json", season, round, limit, offset)
+    def constructors_standings(self, season: int, round: int = None, limit: int = DEFAULT_LIMIT, offset: int = None, fresh: bool = False) -> dict:
+        return self.__requests_get("/constructorstandings.json", season, round, limit, offset, fresh)
 
-    def drivers_standings(self, season: int, round: int = None, limit: int = DEFAULT_LIMIT, offset: int = None) -> dict:
-        return self.__requests_get("/driverstandings.json", season, round, limit, offset)
+    def drivers_standings(self, season: int, round: int = None, limit: int = DEFAULT_LIMIT, offset: int = None, fresh: bool = False) -> dict:
+        return self.__requests_get("/driverstandings.json", season, round, limit, offset, fresh)
 
-    def races(self, season: int = None, round: int = None, limit: int = DEFAULT_LIMIT, offset: int = None) -> dict:
-        return self.__requests_get("/races.json", season, round, limit, offset)
+    def races(self, season: int = None, round: int = None, limit: int = DEFAULT_LIMIT, offset: int = None, fresh: bool = False) -> dict:
+        return self.__requests_get("/races.json", season, round, limit, offset, fresh)
 
     def drivers(self, season: int = None, round: int = None, limit: int = DEFAULT_LIMIT, offset: int = None) -> dict:
         return self.__requests_get("/drivers.json", season, round, limit, offset)
@@ -38,8 +79,207 @@ class JolpicaAPI:
     def circuits(self, season: int = None, round: int = None, limit: int = DEFAULT_LIMIT, offset: int = None) -> dict:
         return self.__requests_get("/circuits.json", season, round, limit, offset)
 
+    def results(self, season: int, round: int = None, limit: int = DEFAULT_LIMIT, offset: int = None) -> dict:
+        return self.__requests_get("/results.json", season, round, limit, offset)
+
+    def sprint(self, season: int, round: int = None, limit: int = DEFAULT_LIMIT, offset: int = None) -> dict:
+        return self.__requests_get("/sprint.json", season, round, limit, offset)
+
+    def laps(self, season: int, round: int, limit: int = DEFAULT_LIMIT, offset: int = None) -> dict:
+        return self.__requests_get("/laps.json", season, round, limit, offset)
+
+    def pitstops(self, season: int, round: int, limit: int = DEFAULT_LIMIT, offset: int = None) -> dict:
+        return self.__requests_get("/pitstops.json", season, round, limit, offset)
+
 
 class JolpicaParser:
+    results_columns = ["position", "positionText", "points", "grid", "laps", "status", "Driver", "Constructor"]
+    modes = defaults.PARSER_MODES
+    # Where the tables of each JolpicaAPI method are in a response: the list of rows, the keys of the nested lists
+    # flattened into items (rows are the items when empty) and, per table, the path of the table inside an item and the path of every
+    # column inside the table that is not a plain key. Paths that go through a list take its first element.
+    schemas = {
+        "races": {
+            "rows": ["RaceTable", "Races"],
+            "items": [],
+            "tables": {
+                "races": ([], {"circuitId": ["Circuit", "circuitId"]}),
+                "circuits": (
+                    ["Circuit"],
+                    {
+                        "locationLat": ["Location", "lat"],
+                        "locationLong": ["Location", "long"],
+                        "locationLocality": ["Location", "locality"],
+                        "locationCountry": ["Location", "country"],
+                    },
+                ),
+            },
+        },
+        "drivers_standings": {
+            "rows": ["StandingsTable", "StandingsLists"],
+            "items": ["DriverStandings"],
+            "tables": {
+                "drivers_standings": ([], {"driverId": ["Driver", "driverId"], "constructorId": ["Constructors", "constructorId"]}),
+                "drivers": (["Driver"], {}),
+                "constructors": (["Constructors"], {}),
+            },
+        },
+        "constructors_standings": {
+            "rows": ["StandingsTable", "StandingsLists"],
+            "items": ["ConstructorStandings"],
+            "tables": {
+                "constructors_standings": ([], {"constructorId": ["Constructor", "constructorId"]}),
+                "constructors": (["Constructor"], {}),
+            },
+        },
+        "results": {
+            "rows": ["RaceTable", "Races"],
+            "items": ["Results"],
+            "tables": {
+                "results": ([], {"driverId": ["Driver", "driverId"], "constructorId": ["Constructor", "constructorId"]}),
+                "drivers": (["Driver"], {}),
+                "constructors": (["Constructor"], {}),
+            },
+        },
+        "sprint": {
+            "rows": ["RaceTable", "Races"],
+            "items": ["SprintResults"],
+            "tables": {
+                "results": ([], {"driverId": ["Driver", "driverId"], "constructorId": ["Constructor", "constructorId"]}),
+                "drivers": (["Driver"], {}),
+                "constructors": (["Constructor"], {}),
+            },
+        },
+        "laps": {
+            "rows": ["RaceTable", "Races"],
+            "items": ["Laps", "Timings"],
+            "tables": {
+                "laps": ([], {"lap": ["number"]}),
+            },
+        },
+        "pitstops": {
+            "rows": ["RaceTable", "Races"],
+            "items": ["PitStops"],
+            "tables": {
+                "pitstops": ([], {}),
+            },
+        },
+    }
+
+    def __init__(self, dtypes: dict[str, dict] = None, mode: str = "schema"):
+        if mode not in self.modes:
+            raise ValueError(f"Unknown parser mode {mode}, expected one of {self.modes}.")
+        self.dtypes = dtypes if dtypes is not None else {}
+        self.mode = mode
+        self._columns = {}
+
+    def page_parser(self, endpoint: str) -> callable:
+        if self.mode == "schema":
+            parse = partial(self.schema_parser, endpoint)
+        elif endpoint in ["results", "sprint"]:
+            parse = self.results_parser
+        else:
+            parse = self.parser
+
+        def parse_page(json_data: dict) -> tuple[pd.DataFrame, int, int, int]:
+            with profiling.stage(f"parser.{endpoint}") as counters:
+                page = parse(json_data)
+                counters["rows"] = len(page[0])
+            return page
+
+        return parse_page
+
+    def tables(self, endpoint: str, df: pd.DataFrame) -> dict[str, pd.DataFrame]:
+        # Splits the pages of page_parser, concatenated, into the tables of the endpoint
+        with profiling.stage(f"parser.tables.{endpoint}") as counters:
+            tables = self.split_tables(endpoint, df) if self.mode == "schema" else self.extract_tables(endpoint, df)
+            counters["rows"] = sum(len(x) for x in tables.values())
+        return tables
+
+    def schema_parser(self, endpoint: str, json_data: dict) -> tuple[pd.DataFrame, int, int, int]:
+        # Reads only the paths of the schemas straight from the JSON, one list per path, into a single frame per page
+        data = json_data["MRData"]
+        schema = self.schemas[endpoint]
+        getters, _ = self._schema_columns(endpoint)
+
+        items = data
+        for key in schema["rows"]:
+            items = items[key]
+        for key in schema["items"]:
+            # Keys of the parent, like season and round of standings, are shared by all its items
+            items = [{**parent, **item} for parent in items for item in parent.get(key, [])]
+
+        # A single object block, the dtypes are only set once all pages are concatenated
+        values = np.empty((len(items), len(getters)), dtype=object)
+        for index, getter in enumerate(getters.values()):
+            values[:, index] = [getter(item) for item in items]
+        return pd.DataFrame(values, columns=list(getters.keys())), int(data["limit"]), int(data["offset"]), int(data["total"])
+
+    def split_tables(self, endpoint: str, df: pd.DataFrame) -> dict[str, pd.DataFrame]:
+        _, columns = self._schema_columns(endpoint)
+        tables = {}
+        for table, (table_path, _) in self.schemas[endpoint]["tables"].items():
+            dtypes = self.dtypes[table]
+            new_table = df[list(columns[table].values())]
+            new_table.columns = list(columns[table].keys())
+            new_table = new_table.astype(dtypes)
+            if table_path:
+                new_table = new_table.drop_duplicates(subset=[self._id_column(table)])
+            tables[table] = new_table.reset_index(drop=True)
+        return tables
+
+    def extract_tables(self, endpoint: str, df: pd.DataFrame) -> dict[str, pd.DataFrame]:
+        # Same tables as split_tables, from the frames of parser and results_parser
+        schema_tables = self.schemas[endpoint]["tables"]
+        if df.empty:
+            return {table: pd.DataFrame(columns=list(self.dtypes[table].keys())).astype(self.dtypes[table]) for table in schema_tables}
+
+        df, other_tables = self.extract_other_tables(df)
+        return {table: df if not table_path else other_tables[table_path[0]] for table, (table_path, _) in schema_tables.items()}
+
+    def _schema_columns(self, endpoint: str) -> tuple[dict[str, callable], dict[str, dict[str, str]]]:
+        # Getter of every distinct path of the endpoint, and the path of each column of its tables
+        if endpoint not in self._columns:
+            getters, columns = {}, {}
+            for table, (table_path, paths) in self.schemas[endpoint]["tables"].items():
+                columns[table] = {}
+                for column in self.dtypes[table]:
+                    path = [*table_path, *paths.get(column, [column])]
+                    name = ".".join(path)
+                    getters.setdefault(name, self._getter(path))
+                    columns[table][column] = name
+            self._columns[endpoint] = getters, columns
+        return self._columns[endpoint]
+
+    def _getter(self, path: list[str]) -> callable:
+        if len(path) == 1:
+            key = path[0]
+            return lambda item: item.get(key, np.nan)
+        if len(path) == 2:
+            # Fast path of the id and attributes of the nested tables, like Driver.driverId
+            table_key, key = path
+
+            def get(item: dict):
+                node = item.get(table_key)
+                if node.__class__ is list:
+                    node = node[0] if node else None
+                return node.get(key, np.nan) if node.__class__ is dict else np.nan
+
+            return get
+        return lambda item: self._path_value(item, path)
+
+    def _path_value(self, node, path: list[str]):
+        for key in path:
+            if isinstance(node, list):
+                node = node[0] if node else None
+            if not isinstance(node, dict) or key not in node:
+                return np.nan
+            node = node[key]
+        return node
+
+    def _id_column(self, table: str) -> str:
+        return [x for x in self.dtypes[table] if x.endswith("Id")][0]
+
     def parser(self, json_data: dict) -> tuple[pd.DataFrame, int, int, int]:
         data = json_data["MRData"]
 
@@ -71,6 +311,21 @@ class JolpicaParser:
 
         return df, int(limit), int(offset), int(total)
 
+    def results_parser(self, json_data: dict) -> tuple[pd.DataFrame, int, int, int]:
+        # Pages of results split races at any row, so every race of the page is flattened
+        data = json_data["MRData"]
+
+        rows = []
+        for race in data["RaceTable"]["Races"]:
+            results_key = [x for x in race.keys() if x.endswith("Results")][0]
+            for result in race[results_key]:
+                row = {"season": race["season"], "round": race["round"]}
+                row.update({k: result.get(k) for k in self.results_columns})
+                rows.append(row)
+
+        df = pd.DataFrame(rows, columns=["season", "round", *self.results_columns])
+        return df, int(data["limit"]), int(data["offset"]), int(data["total"])
+
     def extract_other_tables(self, df: pd.DataFrame) -> tuple[pd.DataFrame, dict[str, pd.DataFrame]]:
         other_tables = {}
         df = df.copy()
@@ -221,79 +476,234 @@ class JolpicaDB:
         },
     }
 
-    def __init__(self, directory: str):
-        self.jolpica_api = JolpicaAPI()
-        self.jolpica_parser = JolpicaParser()
+    create_workspace = ".create"
+
+    def __init__(self, directory: str, jolpica_api: JolpicaAPI = None, storage=None, parser_mode: str = "schema", dtypes: str = "standard"):
+        self.jolpica_api = jolpica_api if jolpica_api is not None else JolpicaAPI()
+        self.jolpica_parser = JolpicaParser(self.parser_dtypes(), mode=parser_mode)
+        self.standings_engine = StandingsEngine()
+        self.storage = storage if storage is not None else CSVStorage(directory)
         self.directory = directory
         self._loaded = False
+        # Compact in-memory dtypes, tables are still saved with the standard ones of map_dtypes
+        self.schema = CompactSchema() if dtypes == "compact" else None
 
-        self.db = {key: None for key in self.map_dtypes.keys()}
+        # Tables are only read when first used, see _load_table
+        self.db = LazyTables(self.map_dtypes.keys(), self._load_table)
+        # Seasons changed since the last save, so partitioned storages only rewrite those
+        self._touched_seasons = {key: set() for key in self.map_dtypes.keys()}
+        # Rows inserted, updated and unchanged by _concat_and_clean, per table
+        self.changes = {key: {"inserted": 0, "updated": 0, "unchanged": 0} for key in self.map_dtypes.keys()}
+        # Tables whose contents changed since the last save, the only ones _save_db writes
+        self._dirty = set()
+        self._query = JolpicaQuery(self.db)
+
+    @property
+    def query(self) -> JolpicaQuery:
+        # Indexes over the loaded tables, each one is rebuilt only after its table changed
+        if not self._loaded:
+            self._load_db()
+        return self._query
+
+    @classmethod
+    def parser_dtypes(cls) -> dict[str, dict]:
+        dtypes = {table: schema["dtypes"] for table, schema in cls.map_dtypes.items()}
+        dtypes["results"] = StandingsEngine.results_dtypes
+        return dtypes
 
     def _load_db(self):
-        for table in self.db.keys():
-            file_path = os.path.join(self.directory, f"{table}.csv")
-            if os.path.exists(file_path):
-                df = pd.read_csv(file_path)
-                df = self._convert_dtypes(table, df)
-                self.db[table] = df
-            else:
-                print(f"File {file_path} does not exist. Skipping load for table {table}.")
+        # Forgets the tables read so far, each table is read again from the storage on its next access
+        self.db.reset()
         self._loaded = True
 
-    def _save_db(self):
+    def _load_table(self, table: str, columns: list[str] = None) -> pd.DataFrame | None:
+        if not self.storage.exists(table):
+            print(f"Table {table} does not exist in {self.directory}. Skipping load for table {table}.")
+            return None
+        with profiling.stage(f"load_db.{table}") as counters:
+            df = self._convert_dtypes(table, self.storage.load(table)) if columns is None else self.load_table(table, columns)
+            counters["rows"] = len(df)
+        return df
+
+    def _save_db(self, tables: list[str] = None) -> list[str]:
+        # Only the dirty tables are written by default, returns the tables saved
+        tables = sorted(self._dirty) if tables is None else tables
+        saved = []
+        with profiling.stage("save_db"):
+            for table in tables:
+                df = self.db.loaded().get(table)
+                if df is not None:
+                    seasons = None
+                    if "season" in df.columns and self.storage.exists(table) and table in self._dirty:
+                        seasons = sorted(self._touched_seasons[table])
+                    with profiling.stage(f"save_db.{table}") as counters:
+                        self.storage.save(table, self.to_storage_dtypes(table, df), seasons=seasons)
+                        counters["rows"] = len(df)
+                    self._touched_seasons[table].clear()
+                    saved.append(table)
+                self._dirty.discard(table)
+        return saved
+
+    def load_table(self, table: str, columns: list[str] = None, seasons: list[int] = None) -> pd.DataFrame:
+        # Reads only the requested columns and seasons, without loading the whole database
+        df = self.storage.load(table, columns=columns, seasons=seasons)
+        return self._convert_dtypes(table, df, columns if columns is not None else [x for x in self.map_dtypes[table]["dtypes"] if x in df.columns])
+
+    def to_storage_dtypes(self, table: str, df: pd.DataFrame) -> pd.DataFrame:
+        # Standard dtypes of a table, the ones written to the storage
+        return df if self.schema is None else self.schema.decode(df, self.map_dtypes[table]["dtypes"])
+
+    def memory_usage(self) -> pd.DataFrame:
+        # Rows and bytes of every loaded table, with the shared categories of the compact dtypes as a row of their own
+        rows = []
+        for table, df in self.db.loaded().items():
+            nbytes = int(df.memory_usage(index=False, deep=True).sum()) if self.schema is None else self.schema.memory_usage(df)
+            rows.append({"table": table, "rows": len(df), "bytes": nbytes})
+        if self.schema is not None:
+            rows.append({"table": "categories", "rows": sum(len(x) for x in self.schema.categories.values()), "bytes": self.schema.categories_memory_usage()})
+        return pd.DataFrame(rows, columns=["table", "rows", "bytes"])
+
+    def export_csv(self, directory: str):
+        if not self._loaded:
+            self._load_db()
+        csv_storage = CSVStorage(directory)
         for table, df in self.db.items():
             if df is not None:
-                file_path = os.path.join(self.directory, f"{table}.csv")
-                df.to_csv(file_path, index=False)
+                csv_storage.save(table, self.to_storage_dtypes(table, df))
 
     def _request_with_pagination(self, method: callable, *args, **kwargs) -> pd.DataFrame:
+        return self._request_many_with_pagination(method, [(args, kwargs)])[0]
+
+    def _request_many_with_pagination(self, method: callable, calls: list[tuple[tuple, dict]], parser: callable = None) -> list[pd.DataFrame]:
         limite = 100
-        total = limite
-        offset = 0
-        all_data = []
-        while offset < total:
-            kwargs.update({"limit": limite, "offset": offset})
-            json_data = method(*args, **kwargs)
-            df, _, _, total = self.jolpica_parser.parser(json_data)
-            all_data.append(df)
-            offset += limite
-        return pd.concat(all_data, ignore_index=True)
-
-    def _convert_dtypes(self, table: str, df: pd.DataFrame) -> pd.DataFrame:
+        fetch_engine = self.jolpica_api.fetch_engine
+        parser = parser if parser is not None else self.jolpica_parser.parser
+
+        def fetch_page(page: tuple[tuple, dict, int]) -> tuple[pd.DataFrame, int, int, int]:
+            args, kwargs, offset = page
+            json_data = method(*args, **{**kwargs, "limit": limite, "offset": offset})
+            return parser(json_data)
+
+        with profiling.stage(f"pagination.{method.__name__}") as counters:
+            # First pages tell the total of each call, then every remaining page is fetched at once
+            first_pages = fetch_engine.map(fetch_page, [(args, kwargs, 0) for args, kwargs in calls])
+
+            next_pages = []
+            for index, ((args, kwargs), (_, _, _, total)) in enumerate(zip(calls, first_pages, strict=True)):
+                for offset in range(limite, total, limite):
+                    next_pages.append((index, (args, kwargs, offset)))
+            next_results = fetch_engine.map(fetch_page, [page for _, page in next_pages])
+
+            all_data = [[df] for df, _, _, _ in first_pages]
+            for (index, _), (df, _, _, _) in zip(next_pages, next_results, strict=True):
+                all_data[index].append(df)
+            counters["pages"] = len(first_pages) + len(next_results)
+            return [pd.concat(data, ignore_index=True) for data in all_data]
+
+    def _request_tables(self, method: callable, calls: list[tuple[tuple, dict]]) -> dict[str, pd.DataFrame]:
+        endpoint = method.__name__
+        pages = self._request_many_with_pagination(method, calls, self.jolpica_parser.page_parser(endpoint))
+        return self.jolpica_parser.tables(endpoint, pd.concat(pages, ignore_index=True))
+
+    def _parse_tables(self, method: callable, json_data: dict) -> dict[str, pd.DataFrame]:
+        endpoint = method.__name__
+        return self.jolpica_parser.tables(endpoint, self.jolpica_parser.page_parser(endpoint)(json_data)[0])
+
+    def _convert_dtypes(self, table: str, df: pd.DataFrame, columns: list[str] = None) -> pd.DataFrame:
         dtypes = self.map_dtypes[table]["dtypes"]
-        return df.astype(dtypes)[dtypes.keys()]
+        if columns is not None:
+            dtypes = {column: dtypes[column] for column in columns}
+        if self.schema is not None:
+            return self.schema.encode(df, dtypes)
+        return df.astype(dtypes)[list(dtypes.keys())]
 
-    def _concat_and_clean(self, table: str, new_data: pd.DataFrame):
-        if self.db[table] is not None:
-            combined_df = pd.concat([self.db[table], new_data], ignore_index=True)
-        else:
-            combined_df = new_data
+    def _clean(self, table: str, df: pd.DataFrame) -> pd.DataFrame:
+        df = self._convert_dtypes(table, df)
+        df = df.drop_duplicates(subset=self.map_dtypes[table]["duplicates"], keep="last").reset_index(drop=True)
+        df = df.sort_values(by=self.map_dtypes[table]["sort"]).reset_index(drop=True)
+        return df
 
-        combined_df = self._convert_dtypes(table, combined_df)
-        combined_df = combined_df.drop_duplicates(subset=self.map_dtypes[table]["duplicates"], keep="last").reset_index(drop=True)
-        combined_df = combined_df.sort_values(by=self.map_dtypes[table]["sort"]).reset_index(drop=True)
+    def _search_keys(self, df: pd.DataFrame, keys: list[str], new_keys: pd.DataFrame) -> tuple[np.ndarray, np.ndarray]:
+        # Binary search of every new key over df, which is sorted by keys: one searchsorted per key column,
+        # each narrowed to the rows sharing the previous key columns
+        columns = [key_values(df[key]) for key in keys]
+        new_columns = [key_values(new_keys[key]) for key in keys]
+        positions = np.empty(len(new_keys), dtype=np.int64)
+        found = np.ones(len(new_keys), dtype=bool)
+        for i in range(len(new_keys)):
+            lo, hi = 0, len(df)
+            for column, new_column in zip(columns, new_columns, strict=True):
+                segment = column[lo:hi]
+                left = lo + int(np.searchsorted(segment, new_column[i], side="left"))
+                right = lo + int(np.searchsorted(segment, new_column[i], side="right"))
+                if left == right:
+                    lo = left
+                    found[i] = False
+                    break
+                lo, hi = left, right
+            positions[i] = lo
+        return positions, found
 
-        self.db[table] = combined_df
+    def _upsert(self, table: str, new_data: pd.DataFrame) -> tuple[dict[str, int], pd.DataFrame]:
+        # The table is read before new_data is encoded, since reading it can extend the shared categories
+        df = self.db[table]
+        keys = self.map_dtypes[table]["sort"]
+        new_data = self._convert_dtypes(table, new_data)
+        new_data = new_data.drop_duplicates(subset=self.map_dtypes[table]["duplicates"], keep="last")
+        new_data = new_data.sort_values(by=keys).reset_index(drop=True)
 
-    # Aux functions to update tables
-    def _get_races_between_races(self, start_race: tuple[int, int] = None, end_race: tuple[int, int] = None, n_backward: int = 0, n_forward: int = 0) -> pd.DataFrame:
-        if start_race is None and end_race is None:
-            raise ValueError("At least one of start_race or end_race must be provided.")
+        if df is not None and self.schema is not None:
+            df = self.schema.align(df)
+        if df is None or df.empty or keys != self.map_dtypes[table]["duplicates"]:
+            self.db[table] = self._clean(table, new_data if df is None else pd.concat([df, new_data], ignore_index=True))
+            return {"inserted": len(new_data), "updated": 0, "unchanged": 0}, new_data
 
-        races = self.db["races"]
+        positions, found = self._search_keys(df, keys, new_data)
 
-        if start_race is not None:
-            start_index = races[(races["season"] == start_race[0]) & (races["round"] == start_race[1])].index[0]
+        # Matched rows are only rewritten when some value actually changed
+        matched = new_data[found]
+        current = df.iloc[positions[found]].reset_index(drop=True)
+        matched = matched.reset_index(drop=True)
+        # Comparisons with a missing nullable integer are missing, not False
+        same = (current == matched).fillna(False).astype(bool) | (current.isna() & matched.isna())
+        changed = ~same.all(axis=1).to_numpy()
 
-        if end_race is not None:
-            end_index = races[(races["season"] == end_race[0]) & (races["round"] == end_race[1])].index[0]
+        if changed.any():
+            df = df.copy()
+            for column in df.columns.difference(keys):
+                # The arrays keep the dtype of the column, categorical and nullable ones included
+                values = df[column].array.copy()
+                values[positions[found][changed]] = matched.loc[changed, column].array
+                df[column] = values
 
-        if start_race is not None and end_race is not None:
-            return races.iloc[start_index - n_backward : end_index + n_forward + 1]
-        elif start_race is not None:
-            return races.iloc[start_index - n_backward :]
-        else:
-            return races.iloc[: end_index + n_forward + 1]
+        # New rows are already sorted, so they are inserted in order before their lower bound
+        inserted = new_data[~found]
+        order = np.insert(np.arange(len(df)), positions[~found], len(df) + np.arange(len(inserted)))
+        combined_df = pd.concat([df, inserted], ignore_index=True)
+        self.db[table] = combined_df.iloc[order].reset_index(drop=True)
+
+        changed_rows = pd.concat([matched[changed], inserted], ignore_index=True)
+        return {"inserted": len(inserted), "updated": int(changed.sum()), "unchanged": int((~changed).sum())}, changed_rows
+
+    def _concat_and_clean(self, table: str, new_data: pd.DataFrame) -> dict[str, int]:
+        with profiling.stage(f"concat_and_clean.{table}") as counters:
+            counts, changed_rows = self._upsert(table, new_data)
+            counters.update(rows=len(new_data), **counts)
+        if counts["inserted"] or counts["updated"]:
+            self._dirty.add(table)
+        if "season" in changed_rows.columns:
+            self._touched_seasons[table].update(int(x) for x in changed_rows["season"].unique())
+
+        for key, value in counts.items():
+            self.changes[table][key] += value
+        print(f"Table {table}: {counts['inserted']} inserted, {counts['updated']} updated, {counts['unchanged']} unchanged")
+        return counts
+
+    # Aux functions to update tables
+    def _get_races_between_races(self, start_race: tuple[int, int] = None, end_race: tuple[int, int] = None, n_backward: int = 0, n_forward: int = 0) -> pd.DataFrame:
+        if start_race is None and end_race is None:
+            raise ValueError("At least one of start_race or end_race must be provided.")
+        return self.query.races_between(start_race, end_race, n_backward, n_forward)
 
     # Functions to update tables
     def _update_races(self, last_race_year: int = None):
@@ -303,16 +713,14 @@ class JolpicaDB:
         else:
             last_race_year -= 2
 
-        all_races = []
+        calls = []
         for year in range(last_race_year, current_year + 1):
             print(f"Updating races for season {year}")
-            races = self._request_with_pagination(self.jolpica_api.races, season=year)
-            all_races.append(races)
-        races = pd.concat(all_races, ignore_index=True)
-        races, other_tables = self.jolpica_parser.extract_other_tables(races)
+            calls.append(((), {"season": year}))
+        tables = self._request_tables(self.jolpica_api.races, calls)
 
-        self._concat_and_clean("races", races)
-        self._concat_and_clean("circuits", other_tables["Circuit"])
+        self._concat_and_clean("races", tables["races"])
+        self._concat_and_clean("circuits", tables["circuits"])
 
     def _update_drivers_standings(self, last_season: int = None, last_round: int = None, n_backward: int = 0):
         if last_season is not None and last_round is not None:
@@ -322,9 +730,8 @@ class JolpicaDB:
             last_drivers_standings_season = df_drivers_standings["season"].max()
             last_drivers_standings_round = df_drivers_standings[df_drivers_standings["season"] == last_drivers_standings_season]["round"].max()
 
-            df = self.jolpica_api.drivers_standings(self.db["races"]["season"].max())
-            df = self.jolpica_parser.parser(df)[0]
-            df, _ = self.jolpica_parser.extract_other_tables(df)
+            json_data = self.jolpica_api.drivers_standings(self.db["races"]["season"].max())
+            df = self._parse_tables(self.jolpica_api.drivers_standings, json_data)["drivers_standings"]
             df = self._convert_dtypes("drivers_standings", df)
             last_available_drivers_standings_season = df["season"].max()
             last_available_drivers_standings_round = df["round"].max()
@@ -335,20 +742,18 @@ class JolpicaDB:
                 n_backward=n_backward,
             )
 
-        all_drivers_standings = []
+        calls = []
         for _, race in races_to_update_drivers_standings.iterrows():
             season = race["season"]
             round = race["round"]
             print(f"Updating drivers_standings for season {season}, round {round}")
-            drivers_standings = self._request_with_pagination(self.jolpica_api.drivers_standings, season, round)
-            all_drivers_standings.append(drivers_standings)
+            calls.append(((season, round), {}))
 
-        drivers_standings = pd.concat(all_drivers_standings, ignore_index=True)
-        drivers_standings, other_tables = self.jolpica_parser.extract_other_tables(drivers_standings)
+        tables = self._request_tables(self.jolpica_api.drivers_standings, calls)
 
-        self._concat_and_clean("drivers_standings", drivers_standings)
-        self._concat_and_clean("drivers", other_tables["Driver"])
-        self._concat_and_clean("constructors", other_tables["Constructors"])
+        self._concat_and_clean("drivers_standings", tables["drivers_standings"])
+        self._concat_and_clean("drivers", tables["drivers"])
+        self._concat_and_clean("constructors", tables["constructors"])
 
     def _update_constructors_standings(self, last_season: int = None, last_round: int = None, n_backward: int = 0):
         if last_season is not None and last_round is not None:
@@ -358,9 +763,8 @@ class JolpicaDB:
             last_constructors_standings_season = df_constructors_standings["season"].max()
             last_constructors_standings_round = df_constructors_standings[df_constructors_standings["season"] == last_constructors_standings_season]["round"].max()
 
-            df = self.jolpica_api.constructors_standings(self.db["races"]["season"].max())
-            df = self.jolpica_parser.parser(df)[0]
-            df, _ = self.jolpica_parser.extract_other_tables(df)
+            json_data = self.jolpica_api.constructors_standings(self.db["races"]["season"].max())
+            df = self._parse_tables(self.jolpica_api.constructors_standings, json_data)["constructors_standings"]
             df = self._convert_dtypes("constructors_standings", df)
             last_available_constructors_standings_season = df["season"].max()
             last_available_constructors_standings_round = df["round"].max()
@@ -371,44 +775,302 @@ class JolpicaDB:
                 n_backward=n_backward,
             )
 
-        all_constructors_standings = []
+        calls = []
         for _, race in races_to_update_constructors_standings.iterrows():
             season = race["season"]
             round = race["round"]
             print(f"Updating constructors_standings for season {season}, round {round}")
-            constructors_standings = self._request_with_pagination(self.jolpica_api.constructors_standings, season, round)
-            all_constructors_standings.append(constructors_standings)
+            calls.append(((season, round), {}))
+
+        tables = self._request_tables(self.jolpica_api.constructors_standings, calls)
+
+        self._concat_and_clean("constructors_standings", tables["constructors_standings"])
+        self._concat_and_clean("constructors", tables["constructors"])
 
-        constructors_standings = pd.concat(all_constructors_standings, ignore_index=True)
-        constructors_standings, other_tables = self.jolpica_parser.extract_other_tables(constructors_standings)
+    def _fetch_results(self, seasons: list[int]) -> tuple[pd.DataFrame, pd.DataFrame, dict[str, pd.DataFrame]]:
+        seasons = [int(season) for season in seasons]
 
+        print(f"Fetching results for seasons {seasons[0]}-{seasons[-1]}")
+        calls = [((season,), {}) for season in seasons]
+        tables = self._request_tables(self.jolpica_api.results, calls)
+        results = tables.pop("results")
+
+        calls = [((season,), {}) for season in seasons if season >= self.standings_engine.first_sprint_season]
+        sprints = self._request_tables(self.jolpica_api.sprint, calls)["results"] if calls else results.iloc[:0]
+        if sprints.empty:
+            sprints = results.iloc[:0]
+        return results, sprints, tables
+
+    def _compute_standings(self, seasons: list[int]) -> tuple[pd.DataFrame, pd.DataFrame, dict[str, pd.DataFrame]]:
+        results, sprints, other_tables = self._fetch_results(seasons)
+        if results.empty:
+            return None, None, other_tables
+
+        drivers_standings = self.standings_engine.drivers_standings(results, sprints, self.db["races"])
+        constructors_standings = self.standings_engine.constructors_standings(results, sprints, self.db["races"])
+        return drivers_standings, constructors_standings, other_tables
+
+    def _update_standings_from_results(self, first_season: int = None):
+        if first_season is None:
+            first_season = min(self.db["drivers_standings"]["season"].max(), self.db["constructors_standings"]["season"].max())
+        seasons = list(range(first_season, self.db["races"]["season"].max() + 1))
+
+        drivers_standings, constructors_standings, other_tables = self._compute_standings(seasons)
+        if drivers_standings is None:
+            print(f"No results available for seasons {seasons[0]}-{seasons[-1]}")
+            return
+
+        self._concat_and_clean("drivers_standings", drivers_standings)
         self._concat_and_clean("constructors_standings", constructors_standings)
-        self._concat_and_clean("constructors", other_tables["Constructor"])
+        self._concat_and_clean("drivers", other_tables["drivers"])
+        self._concat_and_clean("constructors", other_tables["constructors"])
+
+    def verify_local_standings(self, seasons: list[int]) -> dict[str, pd.DataFrame]:
+        if not self._loaded:
+            self._load_db()
+
+        drivers_standings, constructors_standings, _ = self._compute_standings(seasons)
+        if drivers_standings is None:
+            raise ValueError(f"No results available for seasons {seasons[0]}-{seasons[-1]}.")
+
+        reports = {}
+        for table, computed in [("drivers_standings", drivers_standings), ("constructors_standings", constructors_standings)]:
+            existing = self.db[table][self.db[table]["season"].isin(seasons)]
+            computed = self._convert_dtypes(table, computed)
+            if self.schema is not None:
+                existing = self.schema.align(existing)
+            reports[table] = self.standings_engine.verify(computed, existing, self.map_dtypes[table]["duplicates"])
+        return reports
+
+    # Aux functions to create tables
+    def _fetch_season_standings(self, method: callable, season: int, races: pd.DataFrame) -> tuple[pd.DataFrame, dict[str, pd.DataFrame]]:
+        json_data = method(season)
+        if int(json_data["MRData"]["total"]) == 0:
+            return None, {}
+        last_round = int(self._parse_tables(method, json_data)[method.__name__]["round"].astype(int).max())
+
+        calls = [((season, round), {}) for round in races.loc[races["round"] <= last_round, "round"]]
+        tables = self._request_tables(method, calls)
+        return tables.pop(method.__name__), tables
+
+    def _fetch_season(self, season: int, standings_source: str = "api") -> dict[str, pd.DataFrame]:
+        tables = {}
+        races_tables = self._request_tables(self.jolpica_api.races, [((), {"season": season})])
+        if races_tables["races"].empty:
+            return tables
+
+        races = self._convert_dtypes("races", races_tables["races"])
+        tables["races"] = races
+        tables["circuits"] = races_tables["circuits"]
+
+        if standings_source == "local":
+            results, sprints, other_tables = self._fetch_results([season])
+            if results.empty:
+                return tables
+            tables["drivers_standings"] = self.standings_engine.drivers_standings(results, sprints, races)
+            if season >= self.standings_engine.first_constructors_season:
+                tables["constructors_standings"] = self.standings_engine.constructors_standings(results, sprints, races)
+            tables["drivers"] = other_tables["drivers"]
+            tables["constructors"] = other_tables["constructors"]
+            return tables
+
+        drivers_standings, other_tables = self._fetch_season_standings(self.jolpica_api.drivers_standings, season, races)
+        if drivers_standings is not None:
+            tables["drivers_standings"] = drivers_standings
+            tables["drivers"] = other_tables["drivers"]
+            tables["constructors"] = other_tables["constructors"]
 
-    def create(self):
-        raise NotImplementedError("The create method is not implemented yet.")
+        if season >= self.standings_engine.first_constructors_season:
+            constructors_standings, other_tables = self._fetch_season_standings(self.jolpica_api.constructors_standings, season, races)
+            if constructors_standings is not None:
+                tables["constructors_standings"] = constructors_standings
+                tables["constructors"] = pd.concat([tables.get("constructors"), other_tables["constructors"]], ignore_index=True)
 
-    def update(self):
+        return tables
+
+    def _merge_seasons(self, workspace: str, seasons: list[int]):
+        # Seasons are merged one at a time, so only dimension tables are ever fully in memory
+        for table, schema in self.map_dtypes.items():
+            season_files = [os.path.join(workspace, str(season), f"{table}.csv") for season in seasons]
+            season_files = [x for x in season_files if os.path.exists(x)]
+            if not season_files:
+                continue
+
+            if "season" in schema["sort"]:
+                chunks = (self.to_storage_dtypes(table, self._convert_dtypes(table, pd.read_csv(x))) for x in season_files)
+                self.storage.save_chunks(table, chunks)
+            else:
+                df = pd.concat([pd.read_csv(x) for x in season_files], ignore_index=True)
+                self.storage.save(table, self.to_storage_dtypes(table, self._clean(table, df)))
+
+    def create(self, start_season: int = 1950, end_season: int = None, jobs: int = 1, standings_source: str = "api"):
+        if end_season is None:
+            end_season = pd.to_datetime("now").year
+        seasons = list(range(start_season, end_season + 1))
+
+        workspace = os.path.join(self.directory, self.create_workspace)
+        journal_path = os.path.join(workspace, "journal.jsonl")
+        os.makedirs(workspace, exist_ok=True)
+
+        completed = set()
+        if os.path.exists(journal_path):
+            with open(journal_path) as file:
+                completed = {json.loads(line)["season"] for line in file if line.strip()}
+        pending = [season for season in seasons if season not in completed]
+        if completed:
+            print(f"Resuming create, {len(seasons) - len(pending)} of {len(seasons)} seasons already done")
+
+        journal_lock = threading.Lock()
+
+        def backfill_season(season: int) -> int:
+            print(f"Creating tables for season {season}")
+            tables = self._fetch_season(season, standings_source)
+
+            season_directory = os.path.join(workspace, str(season))
+            os.makedirs(season_directory, exist_ok=True)
+            rows = {}
+            for table, df in tables.items():
+                df = self._clean(table, df)
+                self.to_storage_dtypes(table, df).to_csv(os.path.join(season_directory, f"{table}.csv"), index=False)
+                rows[table] = len(df)
+
+            # A season is only journaled once all its tables are on disk
+            with journal_lock, open(journal_path, "a") as file:
+                file.write(json.dumps({"season": season, "rows": rows, "finished_at": time.time()}) + "\n")
+            return season
+
+        with ThreadPoolExecutor(max_workers=max(jobs, 1), thread_name_prefix="create") as executor:
+            futures = [executor.submit(backfill_season, season) for season in pending]
+            try:
+                for future in as_completed(futures):
+                    future.result()
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+        print(f"Merging {len(seasons)} seasons into {self.directory}")
+        self._merge_seasons(workspace, seasons)
+        shutil.rmtree(workspace)
+        self.db.reset()
+        self._loaded = False
+
+    def probe(self) -> dict:
+        # Cheap check for news upstream, one single row request per season of races and per standings table:
+        # number of races of the seasons since the last local one, last round and size of the last standings. The
+        # requests skip the cache, a cached total would hide a round published since.
+        races = self.db.projection("races", ["season", "round"])
+        if races is None or races.empty:
+            return {"changed": True, "differences": {"races": {"local": None, "remote": None}}}
+        last_season = int(races["season"].max())
+        current_year = pd.to_datetime("now").year
+
+        differences = {}
+        with profiling.stage("update.probe") as counters:
+            for season in range(last_season, max(last_season, current_year) + 1):
+                local = int((races["season"] == season).sum())
+                remote = int(self.jolpica_api.races(season, limit=1, fresh=True)["MRData"]["total"])
+                counters["requests"] = counters.get("requests", 0) + 1
+                if local != remote:
+                    differences[f"races.{season}"] = {"local": local, "remote": remote}
+
+            for table, method in [("drivers_standings", self.jolpica_api.drivers_standings), ("constructors_standings", self.jolpica_api.constructors_standings)]:
+                df = self.db.projection(table, ["season", "round"])
+                local = None
+                if df is not None:
+                    season_rounds = df.loc[df["season"] == last_season, "round"]
+                    if not season_rounds.empty:
+                        last_round = int(season_rounds.max())
+                        local = [last_season, last_round, int((season_rounds == last_round).sum())]
+
+                data = method(last_season, limit=1, fresh=True)["MRData"]
+                counters["requests"] += 1
+                lists = data["StandingsTable"]["StandingsLists"]
+                remote = [int(lists[0]["season"]), int(lists[0]["round"]), int(data["total"])] if lists else None
+                if local != remote:
+                    differences[table] = {"local": local, "remote": remote}
+        return {"changed": bool(differences), "differences": differences}
+
+    def update(self, standings_source: str = "api", force: bool = False) -> dict:
+        # Returns a summary of the update: the probe, the rows changed per table and the tables saved
         self._load_db()
-        self._update_races()
-        self._update_drivers_standings(n_backward=2)
-        self._update_constructors_standings(n_backward=2)
-        self._save_db()
-        self._save_db()
+        probe = None
+        if not force:
+            probe = self.probe()
+            if not probe["changed"]:
+                print("Nothing new upstream, skipping update")
+                return {"changed": False, "probe": probe, "tables": {}, "saved": []}
+
+        with profiling.stage("update.races"):
+            self._update_races()
+        with profiling.stage("update.standings"):
+            if standings_source == "local":
+                self._update_standings_from_results()
+            else:
+                self._update_drivers_standings(n_backward=2)
+                self._update_constructors_standings(n_backward=2)
+        tables = {table: dict(counts) for table, counts in self.changes.items() if any(counts.values())}
+        saved = self._save_db()
+        return {"changed": bool(saved), "probe": probe, "tables": tables, "saved": saved}
+
+    def update_rounds(self, rounds: list[tuple[int, int]]) -> dict:
+        # Standings of only these rounds, like the ones just held, with the same summary as update
+        self._load_db()
+        calls = [((season, round), {}) for season, round in rounds]
+        with profiling.stage("update.rounds"):
+            for season, round in rounds:
+                print(f"Updating standings for season {season}, round {round}")
+            tables = self._request_tables(self.jolpica_api.drivers_standings, calls)
+            self._concat_and_clean("drivers_standings", tables["drivers_standings"])
+            self._concat_and_clean("drivers", tables["drivers"])
+            self._concat_and_clean("constructors", tables["constructors"])
+            tables = self._request_tables(self.jolpica_api.constructors_standings, calls)
+            self._concat_and_clean("constructors_standings", tables["constructors_standings"])
+            self._concat_and_clean("constructors", tables["constructors"])
+        tables = {table: dict(counts) for table, counts in self.changes.items() if any(counts.values())}
+        saved = self._save_db()
+        return {"changed": bool(saved), "probe": None, "tables": tables, "saved": saved}
 
     # Functions to retrive data
     def get_drivers(self, start_season: int = 2000) -> pd.DataFrame:
-        if not self._loaded:
-            self._load_db()
-        df_drivers = self.db["drivers"]
-        df_drivers_standings = self.db["drivers_standings"]
-        seasons_with_standings = df_drivers_standings[df_drivers_standings["season"] >= start_season]["driverId"].unique()
-        return df_drivers[df_drivers["driverId"].isin(seasons_with_standings)].reset_index(drop=True)
-    
+        return self.query.entities("driver", start_season)
+
     def get_constructors(self, start_season: int = 2000) -> pd.DataFrame:
-        if not self._loaded:
-            self._load_db()
-        df_constructors = self.db["constructors"]
-        df_constructors_standings = self.db["constructors_standings"]
-        seasons_with_standings = df_constructors_standings[df_constructors_standings["season"] >= start_season]["constructorId"].unique()
-        return df_constructors[df_constructors["constructorId"].isin(seasons_with_standings)].reset_index(drop=True)
\ No newline at end of file
+        return self.query.entities("constructor", start_season)
+
+    def get_season_entities(self, table: str, start_season: int = 2000) -> dict[int, list[str]]:
+        return self.query.season_entities(table, start_season)
+
+
+def compare_parsers(cache: ResponseCache, repeat: int = 3) -> pd.DataFrame:
+    # Parses the same recorded pages of every endpoint with both modes, checks the typed tables are equal and times them
+    # Laps and pit stops are only read with the schemas, see LapsDB, so only the endpoints of JolpicaDB are compared
+    dtypes = JolpicaDB.parser_dtypes()
+    responses = {}
+    for entry in cache.entries():
+        endpoint = JolpicaAPI.METHODS.get(entry["endpoint"].strip("/").removesuffix(".json"))
+        if endpoint in JolpicaParser.schemas and all(table in dtypes for table in JolpicaParser.schemas[endpoint]["tables"]):
+            responses.setdefault(endpoint, []).append(entry["data"])
+
+    rows = []
+    parsers = {mode: JolpicaParser(dtypes, mode=mode) for mode in JolpicaParser.modes}
+    for endpoint, pages in sorted(responses.items()):
+        timings = {mode: [] for mode in parsers}
+        tables = {}
+        for mode, parser in parsers.items():
+            page_parser = parser.page_parser(endpoint)
+            for _ in range(repeat):
+                start = time.perf_counter()
+                tables[mode] = parser.tables(endpoint, pd.concat([page_parser(json_data)[0] for json_data in pages], ignore_index=True))
+                timings[mode].append(time.perf_counter() - start)
+
+        equal = True
+        for table, df in tables["schema"].items():
+            expected = tables["pandas"][table].astype(dtypes[table])[list(dtypes[table].keys())].reset_index(drop=True)
+            equal &= df.equals(expected)
+
+        row = {"endpoint": endpoint, "pages": len(pages), "rows": len(next(iter(tables["schema"].values()))), "equal": equal}
+        row.update({f"{mode}_ms": min(values) * 1000 for mode, values in timings.items()})
+        row["speedup"] = row["pandas_ms"] / row["schema_ms"]
+        rows.append(row)
+    return pd.DataFrame(rows)
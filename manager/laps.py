@@ -0,0 +1,244 @@
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from manager import defaults, profiling
+from manager.jolpica import JolpicaParser
+
+
+class LapsDB:
+    # Lap by lap positions and pit stops of every race, with one partition per race in
+    # <directory>/<table>/season=<season>/round=<round>, written with the storage of the JolpicaDB. Season and round
+    # are the partition, they are not stored in it. Races are fetched a window at a time, so memory is bounded by the
+    # window whatever the number of races, and only the races missing a partition are fetched.
+    # Table -> first season with data upstream and dtypes of the stored columns
+    tables = {
+        "laps": (1996, {"lap": "int16", "driverId": "category", "position": "int8", "milliseconds": "Int32"}),
+        "pitstops": (2011, {"lap": "int16", "driverId": "category", "stop": "int8", "time": str, "milliseconds": "Int32"}),
+    }
+    # Derived from laps and pitstops, see race_positions
+    positions_table = "lap_positions"
+    positions_dtypes = {
+        "lap": "int16",
+        "driverId": "category",
+        "position": "int8",
+        "delta": "Int8",
+        "pit": bool,
+        "overtakes": "int8",
+        "overtaken": "int8",
+    }
+    # Columns of the responses, before the times are converted to milliseconds
+    parser_dtypes = {
+        "laps": {"season": int, "round": int, "lap": int, "driverId": str, "position": int, "time": str},
+        "pitstops": {"season": int, "round": int, "lap": int, "driverId": str, "stop": int, "time": str, "duration": str},
+    }
+    index_file = "index.json"
+
+    def __init__(self, jolpica_db, directory: str, output_directory: str):
+        self.jolpica_db = jolpica_db
+        self.directory = directory
+        self.output_directory = output_directory
+        self.storage_class = type(jolpica_db.storage)
+        self.parser = JolpicaParser(self.parser_dtypes)
+
+    def _storage(self, table: str, season: int):
+        return self.storage_class(os.path.join(self.directory, table, f"season={season}"))
+
+    def _dtypes(self, table: str) -> dict:
+        return self.positions_dtypes if table == self.positions_table else self.tables[table][1]
+
+    def stored_races(self, table: str) -> set[tuple[int, int]]:
+        table_path = os.path.join(self.directory, table)
+        if not os.path.isdir(table_path):
+            return set()
+        races = set()
+        for season_dir in os.listdir(table_path):
+            if not season_dir.startswith("season="):
+                continue
+            for name in os.listdir(os.path.join(table_path, season_dir)):
+                if name.startswith("round=") and name.endswith(self.storage_class.extension):
+                    races.add((int(season_dir[len("season=") :]), int(name[len("round=") : -len(self.storage_class.extension)])))
+        return races
+
+    def load_race(self, table: str, season: int, round: int) -> pd.DataFrame:
+        storage = self._storage(table, season)
+        dtypes = self._dtypes(table)
+        if not storage.exists(f"round={round}"):
+            return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in dtypes.items()})
+        return storage.load(f"round={round}").astype(dtypes)[list(dtypes.keys())]
+
+    def iter_races(self, table: str, seasons: list[int] = None):
+        # Stored races of the table one at a time, in season and round order, with season and round columns
+        for season, round in sorted(self.stored_races(table)):
+            if seasons is None or season in seasons:
+                yield self.load_race(table, season, round).assign(season=season, round=round)
+
+    def _save_race(self, table: str, season: int, round: int, df: pd.DataFrame):
+        with profiling.stage(f"laps.save.{table}") as counters:
+            self._storage(table, season).save(f"round={round}", df)
+            counters["rows"] = len(df)
+
+    def _milliseconds(self, values: pd.Series) -> pd.Series:
+        # "1:32.123" or "23.456" -> 92123 or 23456, missing when the value is not a duration
+        parts = values.astype("string").str.extract(r"^(?:(\d+):)?(\d+(?:\.\d+)?)$")
+        minutes = pd.to_numeric(parts[0]).fillna(0)
+        seconds = pd.to_numeric(parts[1])
+        return (minutes * 60000 + seconds * 1000).round().astype("Int32")
+
+    def _to_stored(self, table: str, df: pd.DataFrame) -> pd.DataFrame:
+        if table == "laps":
+            df = df.assign(milliseconds=self._milliseconds(df["time"])).sort_values(["lap", "position"])
+        else:
+            df = df.assign(milliseconds=self._milliseconds(df["duration"])).sort_values(["lap", "driverId"])
+        dtypes = self._dtypes(table)
+        return df[list(dtypes.keys())].astype(dtypes).reset_index(drop=True)
+
+    def held_races(self, start_season: int, end_season: int = None) -> list[tuple[int, int]]:
+        # Races of the races table already held, newest first
+        races = self.jolpica_db.load_table("races", ["season", "round", "date"])
+        today = time.strftime("%Y-%m-%d", time.gmtime())
+        season = races["season"].to_numpy(dtype=np.int64)
+        held = (season >= start_season) & (races["date"].astype(str).to_numpy() <= today)
+        if end_season is not None:
+            held &= season <= end_season
+        races = races[held]
+        return sorted(zip(races["season"].to_numpy(dtype=np.int64).tolist(), races["round"].to_numpy(dtype=np.int64).tolist(), strict=True), reverse=True)
+
+    def update(self, start_season: int = defaults.START_SEASON, end_season: int = None, window: int = 8, max_races: int = None, rebuild: bool = False) -> dict:
+        # Fetches the tables of the held races that miss them, newest race first and at most max_races of them, then
+        # derives the positions of every race whose laps or pit stops were written. Races with no data upstream yet
+        # write nothing, so they are fetched again on the next update.
+        held = self.held_races(start_season, end_season)
+        stored = {table: self.stored_races(table) for table in self.tables}
+        missing = {table: {x for x in held if x[0] >= first_season and x not in stored[table]} for table, (first_season, _) in self.tables.items()}
+        pending = [x for x in held if any(x in races for races in missing.values())]
+        fetched = pending if max_races is None else pending[:max_races]
+
+        api = self.jolpica_db.jolpica_api
+        written = {table: 0 for table in [*self.tables, self.positions_table]}
+        changed = set()
+        for start in range(0, len(fetched), window):
+            races = fetched[start : start + window]
+            for table in self.tables:
+                calls = [((season, round), {}) for season, round in races if (season, round) in missing[table]]
+                if not calls:
+                    continue
+                method = getattr(api, table)
+                pages = self.jolpica_db._request_many_with_pagination(method, calls, self.parser.page_parser(table))
+                for ((season, round), _), df in zip(calls, pages, strict=True):
+                    df = self.parser.tables(table, df)[table]
+                    if df.empty:
+                        continue
+                    self._save_race(table, season, round, self._to_stored(table, df))
+                    written[table] += 1
+                    changed.add((season, round))
+            print(f"Laps of {min(start + window, len(fetched))}/{len(fetched)} races fetched")
+
+        # Races with laps but no positions yet, like the ones of an interrupted update, are derived too
+        laps_races = self.stored_races("laps")
+        derive = laps_races if rebuild else (changed & laps_races) | (laps_races - self.stored_races(self.positions_table))
+        for season, round in sorted(derive):
+            positions = self.race_positions(self.load_race("laps", season, round), self.load_race("pitstops", season, round))
+            self._save_race(self.positions_table, season, round, positions)
+            self._write_race_shard(season, round, positions)
+            written[self.positions_table] += 1
+        if derive or not os.path.exists(os.path.join(self.output_directory, self.index_file)):
+            self._write_index(laps_races)
+
+        return {"races": len(fetched), "pending": len(pending) - len(fetched), "written": written}
+
+    def race_positions(self, laps: pd.DataFrame, pitstops: pd.DataFrame) -> pd.DataFrame:
+        # Position of every driver after every lap, positions gained since the previous lap and the passes made and
+        # suffered on track: a driver passes another when it was behind it after the previous lap and is ahead of it
+        # now, unless the other one pitted on this lap or the previous one.
+        drivers = np.sort(laps["driverId"].astype(str).unique())
+        n_laps = int(laps["lap"].max()) if len(laps) else 0
+        lap_index = laps["lap"].to_numpy(dtype=np.int64) - 1
+        driver_index = np.searchsorted(drivers, laps["driverId"].astype(str).to_numpy())
+        positions = np.full((n_laps, len(drivers)), np.nan)
+        positions[lap_index, driver_index] = laps["position"].to_numpy(dtype=float)
+
+        pit = np.zeros(positions.shape, dtype=bool)
+        stops = pitstops[pitstops["driverId"].astype(str).isin(drivers) & (pitstops["lap"] <= n_laps)]
+        pit[stops["lap"].to_numpy(dtype=np.int64) - 1, np.searchsorted(drivers, stops["driverId"].astype(str).to_numpy())] = True
+
+        delta = np.full(positions.shape, np.nan)
+        delta[1:] = positions[:-1] - positions[1:]
+        boxed = pit.copy()
+        boxed[1:] |= pit[:-1]
+        # Lap x passing driver x passed driver, comparisons with a missing position are always False
+        passes = np.zeros((n_laps, len(drivers), len(drivers)), dtype=bool)
+        passes[1:] = (positions[:-1, :, None] > positions[:-1, None, :]) & (positions[1:, :, None] < positions[1:, None, :]) & ~boxed[1:, None, :]
+
+        lap, driver = np.nonzero(~np.isnan(positions))
+        df = pd.DataFrame(
+            {
+                "lap": lap + 1,
+                "driverId": drivers[driver],
+                "position": positions[lap, driver],
+                "delta": delta[lap, driver],
+                "pit": pit[lap, driver],
+                "overtakes": passes.sum(axis=2)[lap, driver],
+                "overtaken": passes.sum(axis=1)[lap, driver],
+            }
+        )
+        return df.sort_values(["lap", "position"]).astype(self.positions_dtypes).reset_index(drop=True)
+
+    def _write_race_shard(self, season: int, round: int, positions: pd.DataFrame):
+        # Lap x driver matrices of a race for the frontend, drivers in their order after their last lap
+        last = positions.sort_values("lap").drop_duplicates(subset=["driverId"], keep="last")
+        drivers = last.sort_values(["lap", "position"], ascending=[False, True])["driverId"].astype(str).tolist()
+        laps = np.arange(1, int(positions["lap"].max()) + 1) if len(positions) else np.array([], dtype=np.int64)
+        codes = self.jolpica_db.db["drivers"].set_index("driverId")["code"].astype(str)
+        races = self.jolpica_db.db["races"]
+        race_name = races.loc[(races["season"] == season) & (races["round"] == round), "raceName"].astype(str)
+
+        matrices = {}
+        for column in ["position", "delta", "overtakes"]:
+            matrix = positions.pivot(index="lap", columns="driverId", values=column).reindex(index=laps, columns=drivers)
+            matrices[column] = self._to_list(matrix.to_numpy(dtype=float, na_value=np.nan))
+
+        totals = positions.groupby("driverId", observed=True)[["overtakes", "overtaken"]].sum()
+        pit_laps = positions[positions["pit"]].groupby("driverId", observed=True)["lap"].apply(list)
+        shard = {
+            "season": int(season),
+            "round": int(round),
+            "raceName": race_name.iloc[0] if len(race_name) else None,
+            "laps": len(laps),
+            "drivers": [
+                {
+                    "id": driver,
+                    "code": None if codes.get(driver, "nan") == "nan" else codes.get(driver),
+                    "overtakes": int(totals.loc[driver, "overtakes"]),
+                    "overtaken": int(totals.loc[driver, "overtaken"]),
+                    "pitLaps": [int(x) for x in pit_laps.get(driver, [])],
+                }
+                for driver in drivers
+            ],
+            **matrices,
+        }
+        self._write_json(os.path.join(self.output_directory, str(season), f"{round}.json"), shard)
+
+    def _write_index(self, races: set[tuple[int, int]]):
+        # Season -> rounds with a shard, seasons newest first like the shards index
+        files = {}
+        for season, round in sorted(races):
+            files.setdefault(str(season), []).append(round)
+        index = {"seasons": sorted((int(x) for x in files), reverse=True), "rounds": files}
+        self._write_json(os.path.join(self.output_directory, self.index_file), index)
+
+    def _to_list(self, matrix: np.ndarray) -> list[list]:
+        values = matrix.astype(object)
+        values[~np.isnan(matrix)] = matrix[~np.isnan(matrix)].astype(int)
+        values[np.isnan(matrix)] = None
+        return values.tolist()
+
+    def _write_json(self, path: str, data: dict):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(data, file, separators=(",", ":"))
+        os.replace(tmp_path, path)
@@ -0,0 +1,107 @@
+import cProfile
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+
+class StageProfiler:
+    # Wall time, calls and counters (bytes, retries, rows...) of every named stage. Stages nest, and stages
+    # running in parallel threads are all counted, so the totals of a stage can add up to more than the run.
+    def __init__(self, cprofile: bool = False):
+        self.cprofile = cprofile
+        self.started = time.time()
+        self.stages = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # Outermost stage -> cProfile of its calls
+        self._profiles = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        # Outermost stages are the ones of the main thread not nested in another stage, they never overlap
+        depth = getattr(self._local, "depth", 0)
+        outermost = depth == 0 and threading.current_thread() is threading.main_thread()
+        profile = self._profiles.setdefault(name, cProfile.Profile()) if self.cprofile and outermost else None
+
+        counters = {}
+        self._local.depth = depth + 1
+        start = time.perf_counter()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield counters
+        finally:
+            if profile is not None:
+                profile.disable()
+            elapsed = time.perf_counter() - start
+            self._local.depth = depth
+            self._record(name, elapsed, counters, outermost=outermost)
+
+    def count(self, name: str, **counters):
+        self._record(name, None, counters)
+
+    def _record(self, name: str, elapsed: float | None, counters: dict, outermost: bool = False):
+        with self._lock:
+            stage = self.stages.setdefault(name, {"calls": 0, "total_s": 0.0, "max_s": 0.0, "outermost": False})
+            if elapsed is not None:
+                stage["calls"] += 1
+                stage["total_s"] += elapsed
+                stage["max_s"] = max(stage["max_s"], elapsed)
+                stage["outermost"] |= outermost
+            for key, value in counters.items():
+                stage[key] = stage.get(key, 0) + value
+
+    def slowest_stage(self) -> str | None:
+        outermost = {name: stage["total_s"] for name, stage in self.stages.items() if stage["outermost"]}
+        return max(outermost, key=outermost.get) if outermost else None
+
+    def report(self, command: str = None) -> dict:
+        with self._lock:
+            stages = {name: dict(stage) for name, stage in sorted(self.stages.items())}
+        return {
+            "command": command,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "elapsed_s": time.time() - self.started,
+            "slowest_stage": self.slowest_stage(),
+            "stages": stages,
+        }
+
+    def write(self, path: str, command: str = None):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.report(command), file, indent=2)
+        os.replace(tmp_path, path)
+
+    def dump_slowest(self, path: str) -> str | None:
+        # cProfile dump of the slowest outermost stage, readable with pstats or snakeviz
+        name = self.slowest_stage()
+        if name is None or name not in self._profiles:
+            return None
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._profiles[name].dump_stats(path)
+        return name
+
+
+# Profiler of the running command, stages are free no-ops while it is not set
+_profiler = None
+
+
+def set_profiler(profiler: StageProfiler | None):
+    global _profiler
+    _profiler = profiler
+
+
+def get_profiler() -> StageProfiler | None:
+    return _profiler
+
+
+def stage(name: str):
+    return _profiler.stage(name) if _profiler is not None else nullcontext({})
+
+
+def count(name: str, **counters):
+    if _profiler is not None:
+        _profiler.count(name, **counters)
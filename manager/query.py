@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+
+from manager.storage import LazyTables
+
+
+class TableIndex:
+    # Indexes of a table sorted by season and round: (season, round) -> row range, season -> row range and,
+    # with an id column, id -> rows and season -> ids. Built once per DataFrame, lookups never scan the table.
+    round_span = 1000
+
+    def __init__(self, df: pd.DataFrame, id_column: str = None):
+        keys = df["season"].to_numpy(dtype=np.int64) * self.round_span + df["round"].to_numpy(dtype=np.int64)
+        if len(keys) > 1 and (keys[1:] < keys[:-1]).any():
+            order = np.argsort(keys, kind="stable")
+            df, keys = df.iloc[order].reset_index(drop=True), keys[order]
+        self.df = df
+        self.id_column = id_column
+        self.keys = keys
+
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.array([], dtype=np.int64)
+        stops = np.r_[starts[1:], len(keys)].astype(np.int64)
+        self.race_keys = keys[starts]
+        self.ranges = {divmod(int(key), self.round_span): (int(start), int(stop)) for key, start, stop in zip(self.race_keys, starts, stops, strict=True)}
+
+        self.seasons = {}
+        self.last_rounds = {}
+        for (season, round), (start, stop) in self.ranges.items():
+            first, _ = self.seasons.get(season, (start, stop))
+            self.seasons[season] = (first, stop)
+            self.last_rounds[season] = round
+
+        self.rows = {}
+        self.entities = {}
+        if id_column is not None:
+            codes, uniques = pd.factorize(df[id_column], sort=True)
+            order = np.argsort(codes, kind="stable")
+            bounds = np.searchsorted(codes[order], np.arange(len(uniques) + 1))
+            # Rows of every id stay in table order, so they are sorted by season and round too
+            self.rows = {id: order[bounds[i] : bounds[i + 1]] for i, id in enumerate(uniques)}
+            for season, (start, stop) in self.seasons.items():
+                season_codes = np.unique(codes[start:stop])
+                self.entities[season] = [uniques[code] for code in season_codes[season_codes >= 0]]
+
+    def round_rows(self, season: int, round: int = None) -> pd.DataFrame:
+        # Rows of a round, the last round of the season when round is None
+        round = self.last_rounds.get(season) if round is None else round
+        start, stop = self.ranges.get((season, round), (0, 0))
+        return self.df.iloc[start:stop]
+
+    def position(self, season: int, round: int) -> int:
+        if (season, round) not in self.ranges:
+            raise KeyError(f"No row for season {season}, round {round}.")
+        return self.ranges[(season, round)][0]
+
+    def entity_rows(self, id: str, season: int = None) -> np.ndarray:
+        rows = self.rows.get(id, np.array([], dtype=np.int64))
+        if season is None:
+            return rows
+        season_keys = self.keys[rows] // self.round_span
+        return rows[np.searchsorted(season_keys, season, side="left") : np.searchsorted(season_keys, season, side="right")]
+
+
+class JolpicaQuery:
+    # Frontend mode -> (standings table, id column, entities table)
+    modes = {
+        "driver": ("drivers_standings", "driverId", "drivers"),
+        "constructor": ("constructors_standings", "constructorId", "constructors"),
+    }
+    # Table -> id column of its index, races are only indexed by season and round
+    indexed = {"races": None, "drivers_standings": "driverId", "constructors_standings": "constructorId"}
+    standings_columns = ["season", "round", "position", "points", "wins"]
+
+    def __init__(self, db: LazyTables):
+        # The tables are read from db at every call, indexes are rebuilt only when a table was replaced
+        self.db = db
+        self._indexes = {}
+        self._positions = {}
+
+    def index(self, table: str, columns: list[str] = None) -> TableIndex:
+        # Lookups that only need the keys index a projection, so the other columns are never read
+        df = self.db[table] if columns is None else self.db.projection(table, columns)
+        key = (table, None if columns is None else tuple(columns))
+        cached = self._indexes.get(key)
+        if cached is None or cached[0] is not df:
+            cached = (df, TableIndex(df, self.indexed[table]))
+            self._indexes[key] = cached
+        return cached[1]
+
+    def _key_columns(self, table: str) -> list[str]:
+        return ["season", "round", self.indexed[table]]
+
+    def _entity_positions(self, table: str, id_column: str) -> dict[str, int]:
+        df = self.db[table]
+        cached = self._positions.get(table)
+        if cached is None or cached[0] is not df:
+            cached = (df, {id: position for position, id in enumerate(df[id_column])})
+            self._positions[table] = cached
+        return cached[1]
+
+    def races_between(self, start_race: tuple[int, int] = None, end_race: tuple[int, int] = None, n_backward: int = 0, n_forward: int = 0) -> pd.DataFrame:
+        index = self.index("races")
+        if start_race is not None and end_race is not None:
+            return index.df.iloc[index.position(*start_race) - n_backward : index.position(*end_race) + n_forward + 1]
+        if start_race is not None:
+            return index.df.iloc[index.position(*start_race) - n_backward :]
+        return index.df.iloc[: index.position(*end_race) + n_forward + 1]
+
+    def season_entities(self, table: str, start_season: int = None) -> dict[int, list[str]]:
+        index = self.index(table, self._key_columns(table))
+        return {season: list(ids) for season, ids in sorted(index.entities.items()) if start_season is None or season >= start_season}
+
+    def entities(self, mode: str, start_season: int = None) -> pd.DataFrame:
+        # Rows of the entities table with standings since start_season, in the order of the table
+        table, id_column, entities_table = self.modes[mode]
+        positions = self._entity_positions(entities_table, id_column)
+        ids = set().union(*self.season_entities(table, start_season).values())
+        return self.db[entities_table].iloc[sorted(positions[id] for id in ids if id in positions)].reset_index(drop=True)
+
+    def standings(self, mode: str, season: int, round: int = None) -> pd.DataFrame:
+        table, id_column, _ = self.modes[mode]
+        rows = self.index(table).round_rows(season, round)
+        return rows.sort_values("position", na_position="last")[[*self.standings_columns, id_column]].reset_index(drop=True)
+
+    def trajectory(self, mode: str, id: str, season: int = None) -> pd.DataFrame:
+        table, _, _ = self.modes[mode]
+        index = self.index(table)
+        return index.df.iloc[index.entity_rows(id, season)][self.standings_columns].reset_index(drop=True)
+
+    def head_to_head(self, mode: str, a: str, b: str, season: int = None) -> pd.DataFrame:
+        # Rounds where both entities are classified, side by side
+        table, _, _ = self.modes[mode]
+        index = self.index(table)
+        rows_a, rows_b = index.entity_rows(a, season), index.entity_rows(b, season)
+        _, common_a, common_b = np.intersect1d(index.keys[rows_a], index.keys[rows_b], assume_unique=True, return_indices=True)
+        df_a = index.df.iloc[rows_a[common_a]].reset_index(drop=True)
+        df_b = index.df.iloc[rows_b[common_b]].reset_index(drop=True)
+        return pd.DataFrame(
+            {
+                "season": df_a["season"],
+                "round": df_a["round"],
+                f"position_{a}": df_a["position"],
+                f"position_{b}": df_b["position"],
+                f"points_{a}": df_a["points"],
+                f"points_{b}": df_b["points"],
+            }
+        )
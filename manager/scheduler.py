@@ -0,0 +1,189 @@
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+from manager import defaults
+
+
+class RefreshScheduler:
+    # Plans the refreshes from the race calendar: after each race the standings upstream are polled with backoff until
+    # its round appears, then only the new rounds and the artifacts of their season are refreshed. A weekly full update
+    # still catches corrections upstream and the calendars of new seasons.
+    # The races table only has dates, standings are first polled this long after midnight UTC of the race day
+    first_poll = timedelta(hours=18)
+    # Delays between polls, the last one repeats until the race is given up and left to the weekly update
+    backoff = [timedelta(minutes=30), timedelta(hours=1), timedelta(hours=2), timedelta(hours=4), timedelta(hours=8), timedelta(hours=12)]
+    give_up = timedelta(days=4)
+    # Weekday (Monday is 0) and hour UTC of the weekly full update
+    calendar_trigger = (0, 8)
+    # Derived artifacts of new standings, the bundle comes last as it hashes the others
+    artifacts = defaults.SCHEDULE_ARTIFACTS
+    # Most races whose laps are fetched in one run, the weekly updates fill the history
+    max_laps_races = 25
+    # Time of the last run with a trigger due, in the directory. The next run covers every trigger since then, so a
+    # cron that runs late or skips a run does not lose them.
+    state_file = defaults.SCHEDULE_STATE_FILE
+
+    def __init__(self, jolpica_db, directory: str, images_directory: str = os.path.join("static", "images"), bundle_directory: str = os.path.join("static", "bundle")):
+        # Polls must see the API as it is now, so jolpica_db should not read the responses cache
+        self.jolpica_db = jolpica_db
+        self.directory = directory
+        self.images_directory = images_directory
+        self.bundle_directory = bundle_directory
+
+    def _race_dates(self) -> list[tuple[int, int, str, datetime]]:
+        races = self.jolpica_db.load_table("races", ["season", "round", "raceName", "date"])
+        dates = [datetime.strptime(x, "%Y-%m-%d").replace(tzinfo=timezone.utc) for x in races["date"].astype(str)]
+        return list(zip(races["season"].to_numpy(dtype=np.int64).tolist(), races["round"].to_numpy(dtype=np.int64).tolist(), races["raceName"].astype(str), dates, strict=True))
+
+    def _last_standings(self) -> tuple[int, int]:
+        standings = self.jolpica_db.load_table("drivers_standings", ["season", "round"])
+        if standings.empty:
+            return (0, 0)
+        keys = standings["season"].to_numpy(dtype=np.int64) * 1000 + standings["round"].to_numpy(dtype=np.int64)
+        return divmod(int(keys.max()), 1000)
+
+    def race_triggers(self, date: datetime) -> list[datetime]:
+        triggers = [date + self.first_poll]
+        delays = iter(self.backoff)
+        delay = next(delays)
+        while triggers[-1] + delay <= date + self.first_poll + self.give_up:
+            triggers.append(triggers[-1] + delay)
+            delay = next(delays, delay)
+        return triggers
+
+    def triggers(self, start: datetime, end: datetime) -> list[dict]:
+        # Every trigger in [start, end): polls of the races after the last round with standings, and weekly updates
+        last_standings = self._last_standings()
+        triggers = []
+        for season, round, race_name, date in self._race_dates():
+            if (season, round) <= last_standings:
+                continue
+            for trigger in self.race_triggers(date):
+                if start <= trigger < end:
+                    triggers.append({"time": trigger, "kind": "race", "season": season, "round": round, "raceName": race_name})
+
+        weekday, hour = self.calendar_trigger
+        day = start.replace(hour=hour, minute=0, second=0, microsecond=0) + timedelta(days=(weekday - start.weekday()) % 7)
+        day = day if day >= start else day + timedelta(days=7)
+        while day < end:
+            triggers.append({"time": day, "kind": "calendar"})
+            day += timedelta(days=7)
+        return sorted(triggers, key=lambda x: x["time"])
+
+    def plan(self, now: datetime, count: int = 10) -> list[dict]:
+        # Next triggers from now, the weekly ones bound how far the plan looks ahead
+        triggers = []
+        end = now
+        while len(triggers) < count:
+            start, end = end, end + timedelta(days=7)
+            triggers.extend(self.triggers(start, end))
+        return triggers[:count]
+
+    def pending_rounds(self, now: datetime) -> list[tuple[int, int]]:
+        last_standings = self._last_standings()
+        return [(season, round) for season, round, _, date in self._race_dates() if (season, round) > last_standings and date + self.first_poll <= now]
+
+    def poll(self, rounds: list[tuple[int, int]]) -> list[tuple[int, int]]:
+        # Pending rounds already upstream, one single row request per season: its last round with standings
+        available = []
+        api = self.jolpica_db.jolpica_api
+        for season in sorted({season for season, _ in rounds}):
+            lists = api.drivers_standings(season, limit=1)["MRData"]["StandingsTable"]["StandingsLists"]
+            last_round = int(lists[0]["round"]) if lists else 0
+            available.extend(x for x in rounds if x[0] == season and x[1] <= last_round)
+        return available
+
+    def last_run(self) -> datetime | None:
+        path = os.path.join(self.directory, self.state_file)
+        if not os.path.exists(path):
+            return None
+        with open(path) as file:
+            return datetime.fromisoformat(json.load(file)["lastRun"])
+
+    def _save_last_run(self, now: datetime):
+        path = os.path.join(self.directory, self.state_file)
+        with open(f"{path}.tmp", "w") as file:
+            json.dump({"lastRun": now.isoformat()}, file, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    def due(self, now: datetime, window: timedelta = None) -> list[dict]:
+        # Triggers in the window before now, by default since the last run, or in the last SCHEDULE_WINDOW without one
+        if window is None:
+            last_run = self.last_run()
+            window = now - last_run if last_run is not None else timedelta(seconds=defaults.SCHEDULE_WINDOW)
+        return self.triggers(now - window + timedelta(seconds=1), now + timedelta(seconds=1))
+
+    def run(self, now: datetime, window: timedelta = None, artifacts: list[str] = None) -> dict:
+        # Runs the due triggers, see due. Returns a summary with changed true when a table was written, like update.
+        due = self.due(now, window)
+        summary = {"due": [{**x, "time": x["time"].isoformat()} for x in due], "rounds": [], "update": None, "artifacts": [], "changed": False}
+        if not due:
+            print(f"No trigger due at {now.isoformat()}, next one at {self.plan(now, 1)[0]['time'].isoformat()}")
+            return summary
+
+        seasons = None
+        if any(x["kind"] == "calendar" for x in due):
+            update = self.jolpica_db.update()
+            seasons = sorted({int(x) for x in self.jolpica_db.load_table("drivers_standings", ["season"])["season"].unique()})
+        else:
+            rounds = self.poll(self.pending_rounds(now))
+            if not rounds:
+                print("Standings of the pending rounds are not upstream yet")
+                self._save_last_run(now)
+                return summary
+            update = self.jolpica_db.update_rounds(rounds)
+            summary["rounds"] = [list(x) for x in rounds]
+            seasons = sorted({season for season, _ in rounds})
+
+        summary["update"] = update
+        summary["changed"] = update["changed"]
+        if update["changed"]:
+            summary["artifacts"] = self.build_artifacts(seasons, self.artifacts if artifacts is None else artifacts)
+        # Only runs with a trigger due move the last run, the others would change the state every hour for nothing
+        self._save_last_run(now)
+        return summary
+
+    def watch(self, once: bool = False):
+        # Sleeps until each trigger and runs it, for a local runner instead of a cron
+        while True:
+            now = datetime.now(timezone.utc)
+            trigger = self.plan(now, 1)[0]
+            print(f"Next trigger at {trigger['time'].isoformat()}, {trigger.get('raceName', trigger['kind'])}")
+            time.sleep(max(0.0, (trigger["time"] - now).total_seconds()))
+            # The window starts at the trigger, so it runs even when the sleep ended late
+            now = datetime.now(timezone.utc)
+            summary = self.run(now, max(now - trigger["time"], timedelta(0)) + timedelta(seconds=1))
+            if once:
+                return summary
+
+    def build_artifacts(self, seasons: list[int], artifacts: list[str]) -> list[str]:
+        db = self.jolpica_db
+        for artifact in artifacts:
+            print(f"Building {artifact} of seasons {seasons}")
+            if artifact == "shards":
+                from manager.shards import ShardsBuilder
+
+                ShardsBuilder(db, os.path.join(self.directory, "shards")).build(seasons=seasons)
+            elif artifact == "metrics":
+                from manager.variation import VariationMetrics
+
+                VariationMetrics(db, os.path.join(self.directory, VariationMetrics.default_file)).build(incremental=True)
+            elif artifact == "championship":
+                from manager.championship import ChampionshipOutlook
+
+                ChampionshipOutlook(db, os.path.join(self.directory, ChampionshipOutlook.default_file)).build()
+            elif artifact == "laps":
+                from manager.laps import LapsDB
+
+                LapsDB(db, self.directory, os.path.join(self.directory, "race_shards")).update(min(seasons), max(seasons), max_races=self.max_laps_races)
+            elif artifact == "bundle":
+                from manager.bundle import StaticBundle
+
+                StaticBundle({"data": self.directory, "images": self.images_directory}, self.bundle_directory).build()
+            else:
+                raise ValueError(f"Unknown artifact {artifact}, expected one of {self.artifacts}.")
+        return list(artifacts)
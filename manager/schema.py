@@ -0,0 +1,93 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+
+class CompactSchema:
+    # Compact in-memory dtypes of the JolpicaDB tables: ids are categoricals whose categories are shared by every
+    # table of the same domain, small integers are nullable and narrow. Storage keeps the standard dtypes.
+    categorical_domains = {
+        "driverId": "driverId",
+        "constructorId": "constructorId",
+        "circuitId": "circuitId",
+        "nationality": "nationality",
+    }
+    integer_dtypes = {
+        "season": "Int16",
+        "round": "Int8",
+        "position": "Int16",
+        "wins": "Int16",
+    }
+
+    def __init__(self):
+        # Domain -> sorted categories, so sorting by a categorical keeps the order of its strings
+        self.categories = {domain: pd.Index([], dtype=object) for domain in set(self.categorical_domains.values())}
+        # Seasons are created in parallel threads, which all extend the same domains
+        self._lock = threading.Lock()
+
+    def dtype(self, column: str) -> pd.CategoricalDtype:
+        return pd.CategoricalDtype(self.categories[self.categorical_domains[column]])
+
+    def _strings(self, values: pd.Series) -> pd.Series:
+        # Like astype(str), but missing values, and the "nan" left by an earlier astype(str), stay missing
+        strings = values.astype(str)
+        return strings.where(values.notna() & (strings != "nan"))
+
+    def _extend(self, column: str, values: pd.Series) -> pd.CategoricalDtype:
+        # Adds the values missing from the domain of the column, returns its categorical dtype with them
+        domain = self.categorical_domains[column]
+        unique = pd.Index(np.asarray(values.dropna().unique(), dtype=object))
+        with self._lock:
+            new = unique.difference(self.categories[domain])
+            if len(new) > 0:
+                self.categories[domain] = self.categories[domain].append(new).sort_values()
+            return pd.CategoricalDtype(self.categories[domain])
+
+    def encode(self, df: pd.DataFrame, dtypes: dict[str, type]) -> pd.DataFrame:
+        # Standard dtypes of the table -> compact columns, in the order of dtypes
+        columns = {}
+        for column, dtype in dtypes.items():
+            values = df[column]
+            if column in self.categorical_domains:
+                if not isinstance(values.dtype, pd.CategoricalDtype):
+                    values = self._strings(values)
+                columns[column] = values.astype(self._extend(column, values))
+            elif column in self.integer_dtypes:
+                columns[column] = values.astype(dtype).astype(self.integer_dtypes[column])
+            else:
+                columns[column] = values.astype(dtype)
+        return pd.DataFrame(columns, index=df.index)
+
+    def align(self, df: pd.DataFrame) -> pd.DataFrame:
+        # Categoricals encoded before their domain grew are recoded to the current categories, so they compare and concat
+        stale = [x for x in df.columns if x in self.categorical_domains and not df[x].dtype.categories.equals(self.dtype(x).categories)]
+        if not stale:
+            return df
+        return df.assign(**{column: df[column].cat.set_categories(self.dtype(column).categories) for column in stale})
+
+    def decode(self, df: pd.DataFrame, dtypes: dict[str, type]) -> pd.DataFrame:
+        # Compact columns -> standard dtypes, missing ids are written as "nan" like astype(str) does
+        columns = {}
+        for column in df.columns:
+            values = df[column]
+            columns[column] = values.astype(str) if column in self.categorical_domains else values.astype(dtypes[column])
+        return pd.DataFrame(columns, index=df.index)
+
+    def memory_usage(self, df: pd.DataFrame) -> int:
+        # Categories are shared, so only the codes of a categorical are counted, see categories_memory_usage
+        nbytes = 0
+        for column in df.columns:
+            values = df[column]
+            nbytes += values.cat.codes.nbytes if isinstance(values.dtype, pd.CategoricalDtype) else int(values.memory_usage(index=False, deep=True))
+        return nbytes
+
+    def categories_memory_usage(self) -> int:
+        return sum(int(categories.memory_usage(deep=True)) for categories in self.categories.values())
+
+
+def key_values(values: pd.Series) -> np.ndarray:
+    # Sortable array of a key column: codes of a categorical, whose categories are sorted, or the values
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.to_numpy()
+    return values.to_numpy()
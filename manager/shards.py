@@ -0,0 +1,138 @@
+import json
+import os
+
+import numpy as np
+
+from manager import defaults
+
+
+class ShardsBuilder:
+    default_start_season = defaults.START_SEASON
+    index_file = "index.json"
+    # Frontend mode -> (standings table, id column, entities table)
+    modes = {
+        "driver": ("drivers_standings", "driverId", "drivers"),
+        "constructor": ("constructors_standings", "constructorId", "constructors"),
+    }
+
+    def __init__(self, jolpica_db, directory: str):
+        self.jolpica_db = jolpica_db
+        self.directory = directory
+
+    def build(self, start_season: int = default_start_season, seasons: list[int] = None) -> dict:
+        db = self.jolpica_db
+        if not db._loaded:
+            db._load_db()
+
+        available = sorted(set(db.db["drivers_standings"]["season"]) | set(db.db["constructors_standings"]["season"]))
+        available = [int(season) for season in available if season >= start_season]
+        seasons = available if seasons is None else [season for season in seasons if season in available]
+
+        files = {}
+        for season in seasons:
+            for mode in self.modes:
+                shard = self._season_shard(season, mode)
+                if shard is None:
+                    continue
+                file_name = f"{season}/{mode}.json"
+                self._write_json(os.path.join(self.directory, file_name), shard)
+                files.setdefault(str(season), {})[mode] = file_name
+
+        # Seasons built in an earlier run are kept in the index
+        index = self.load_index()
+        index_files = {season: modes for season, modes in index.get("files", {}).items() if int(season) in available}
+        index_files.update(files)
+        index = {
+            "seasons": sorted((int(season) for season in index_files), reverse=True),
+            "modes": list(self.modes.keys()),
+            "files": dict(sorted(index_files.items())),
+        }
+        self._write_json(os.path.join(self.directory, self.index_file), index)
+        return index
+
+    def load_index(self) -> dict:
+        path = os.path.join(self.directory, self.index_file)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as file:
+            return json.load(file)
+
+    def _season_shard(self, season: int, mode: str) -> dict | None:
+        db = self.jolpica_db.db
+        table, id_column, entities_table = self.modes[mode]
+        standings = db[table][db[table]["season"] == season]
+        if standings.empty:
+            return None
+
+        races = db["races"][db["races"]["season"] == season].sort_values("round")
+        rounds = np.sort(standings["round"].unique())
+        entities = np.sort(standings[id_column].unique())
+
+        # Dense round x entity matrices, null where the entity is not classified yet
+        matrices = {}
+        for column in ["position", "points", "wins"]:
+            matrix = standings.pivot(index="round", columns=id_column, values=column).reindex(index=rounds, columns=entities)
+            matrices[column] = self._to_list(matrix.to_numpy(dtype=float), integer=column != "points")
+
+        last_rows = standings.sort_values("round").drop_duplicates(subset=[id_column], keep="last").set_index(id_column)
+        metadata = db[entities_table].set_index(id_column)
+        constructors_names = db["constructors"].set_index("constructorId")["name"]
+
+        entities_metadata = []
+        for entity in entities:
+            info = metadata.loc[entity] if entity in metadata.index else None
+            if mode == "driver":
+                item = {
+                    "id": entity,
+                    "name": None if info is None else f"{info['givenName']} {info['familyName']}",
+                    "code": None if info is None else self._to_value(info["code"]),
+                    "url": None if info is None else info["url"],
+                    "dateOfBirth": None if info is None else info["dateOfBirth"],
+                    "nationality": None if info is None else info["nationality"],
+                    "constructor": self._to_value(constructors_names.get(last_rows.loc[entity, "constructorId"])),
+                }
+            else:
+                item = {
+                    "id": entity,
+                    "name": None if info is None else info["name"],
+                    "url": None if info is None else info["url"],
+                    "nationality": None if info is None else info["nationality"],
+                }
+            entities_metadata.append(item)
+
+        return {
+            "season": int(season),
+            "mode": mode,
+            "rounds": [int(x) for x in rounds],
+            # The whole calendar, rounds not run yet have no row in the matrices
+            "races": [
+                {
+                    "round": int(race["round"]),
+                    "raceName": self._to_value(race["raceName"]),
+                    "circuitId": self._to_value(race["circuitId"]),
+                    "date": self._to_value(race["date"]),
+                }
+                for race in races.to_dict("records")
+            ],
+            "entities": entities_metadata,
+            **matrices,
+        }
+
+    def _to_list(self, matrix: np.ndarray, integer: bool) -> list[list]:
+        values = matrix.astype(object)
+        if integer:
+            values[~np.isnan(matrix)] = matrix[~np.isnan(matrix)].astype(int)
+        values[np.isnan(matrix)] = None
+        return values.tolist()
+
+    def _to_value(self, value):
+        if value is None or (isinstance(value, float) and np.isnan(value)) or value == "nan":
+            return None
+        return value
+
+    def _write_json(self, path: str, data: dict):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(data, file, separators=(",", ":"))
+        os.replace(tmp_path, path)
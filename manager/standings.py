@@ -0,0 +1,223 @@
+import numpy as np
+import pandas as pd
+
+
+class StandingsEngine:
+    # Best results counted per season, as (rounds in block, results counted in block).
+    # A block of None rounds runs until the end of the season. Seasons not listed count every result.
+    dropped_scores = {
+        1950: [(None, 4)],
+        1951: [(None, 4)],
+        1952: [(None, 4)],
+        1953: [(None, 4)],
+        1954: [(None, 5)],
+        1955: [(None, 5)],
+        1956: [(None, 5)],
+        1957: [(None, 5)],
+        1958: [(None, 6)],
+        1959: [(None, 5)],
+        1960: [(None, 6)],
+        1961: [(None, 5)],
+        1962: [(None, 5)],
+        1963: [(None, 6)],
+        1964: [(None, 6)],
+        1965: [(None, 6)],
+        1966: [(None, 5)],
+        1967: [(6, 5), (None, 4)],
+        1968: [(6, 5), (None, 5)],
+        1969: [(6, 5), (None, 4)],
+        1970: [(7, 6), (None, 5)],
+        1971: [(6, 5), (None, 4)],
+        1972: [(6, 5), (None, 5)],
+        1973: [(8, 7), (None, 6)],
+        1974: [(8, 7), (None, 6)],
+        1975: [(7, 6), (None, 6)],
+        1976: [(8, 7), (None, 7)],
+        1977: [(9, 8), (None, 7)],
+        1978: [(8, 7), (None, 7)],
+        1979: [(7, 4), (None, 4)],
+        1980: [(7, 5), (None, 5)],
+        1981: [(None, 11)],
+        1982: [(None, 11)],
+        1983: [(None, 11)],
+        1984: [(None, 11)],
+        1985: [(None, 11)],
+        1986: [(None, 11)],
+        1987: [(None, 11)],
+        1988: [(None, 11)],
+        1989: [(None, 11)],
+        1990: [(None, 11)],
+    }
+    first_constructors_season = 1958
+    first_sprint_season = 2021
+    # Until 1978 only the best placed car of each constructor scored, with the drivers' dropped scores
+    last_best_car_season = 1978
+    # Races that counted for the drivers' championship only
+    drivers_only_races = ["Indianapolis 500"]
+    # Entities excluded from a championship keep their points but are classified last, from the given round on
+    exclusions = {
+        "drivers": {(1997, "michael_schumacher"): 17},
+        "constructors": {(2007, "mclaren"): 1},
+    }
+
+    results_dtypes = {
+        "season": int,
+        "round": int,
+        "position": int,
+        "points": float,
+        "driverId": str,
+        "constructorId": str,
+    }
+
+    def drivers_standings(self, results: pd.DataFrame, sprints: pd.DataFrame = None, races: pd.DataFrame = None) -> pd.DataFrame:
+        results, sprints = self._convert_dtypes(results, sprints)
+        return self._standings("drivers", "driverId", results, sprints, races)
+
+    def constructors_standings(self, results: pd.DataFrame, sprints: pd.DataFrame = None, races: pd.DataFrame = None) -> pd.DataFrame:
+        results, sprints = self._convert_dtypes(results, sprints)
+        results = results[results["season"] >= self.first_constructors_season]
+        sprints = sprints[sprints["season"] >= self.first_constructors_season]
+        return self._standings("constructors", "constructorId", results, sprints, races)
+
+    def _convert_dtypes(self, results: pd.DataFrame, sprints: pd.DataFrame = None) -> tuple[pd.DataFrame, pd.DataFrame]:
+        results = results.astype(self.results_dtypes)[self.results_dtypes.keys()]
+        if sprints is None:
+            sprints = results.iloc[:0]
+        sprints = sprints.astype(self.results_dtypes)[self.results_dtypes.keys()]
+        return results, sprints
+
+    def _standings(self, championship: str, id_column: str, results: pd.DataFrame, sprints: pd.DataFrame, races: pd.DataFrame) -> pd.DataFrame:
+        all_standings = []
+        for season, season_results in results.groupby("season", sort=True):
+            season_races = None if races is None else races[races["season"] == season]
+            season_sprints = sprints[sprints["season"] == season]
+            all_standings.append(self._season_standings(championship, id_column, season, season_results, season_sprints, season_races))
+
+        columns = ["round", "season", "position", "points", "wins", id_column]
+        if championship == "drivers":
+            columns.append("constructorId")
+        if not all_standings:
+            return pd.DataFrame(columns=columns)
+        return pd.concat(all_standings, ignore_index=True)[columns]
+
+    def _season_standings(self, championship: str, id_column: str, season: int, results: pd.DataFrame, sprints: pd.DataFrame, races: pd.DataFrame) -> pd.DataFrame:
+        rounds = np.sort(results["round"].unique())
+        entities = np.sort(pd.concat([results[id_column], sprints[id_column]]).unique())
+        n_rounds, n_entities = len(rounds), len(entities)
+
+        if championship == "constructors" and races is not None:
+            # Constructors are still classified on those rounds, they just do not score
+            excluded_rounds = races.loc[races["raceName"].isin(self.drivers_only_races), "round"]
+            results = results[~results["round"].isin(excluded_rounds)]
+
+        round_index = pd.Index(rounds)
+        entity_index = pd.Index(entities)
+        result_round = round_index.get_indexer(results["round"])
+        result_entity = entity_index.get_indexer(results[id_column])
+        sprint_round = round_index.get_indexer(sprints["round"])
+        sprint_entity = entity_index.get_indexer(sprints[id_column])
+
+        # Points scored in each round, before dropped scores
+        race_points = np.zeros((n_entities, n_rounds))
+        if championship == "constructors" and season <= self.last_best_car_season:
+            np.maximum.at(race_points, (result_entity, result_round), results["points"].to_numpy())
+        else:
+            np.add.at(race_points, (result_entity, result_round), results["points"].to_numpy())
+        sprint_points = np.zeros((n_entities, n_rounds))
+        np.add.at(sprint_points, (sprint_entity, sprint_round), sprints["points"].to_numpy())
+
+        blocks = self.dropped_scores.get(season)
+        if championship == "constructors" and season > self.last_best_car_season:
+            blocks = None
+        points = self._counted_points(race_points, blocks) + np.cumsum(sprint_points, axis=1)
+
+        # Finishing positions of every round, used for wins and countback
+        positions = results["position"].to_numpy()
+        n_positions = max(int(positions.max()) if len(positions) else 0, 1)
+        finishes = np.zeros((n_entities, n_rounds, n_positions), dtype=np.int32)
+        np.add.at(finishes, (result_entity, result_round, positions - 1), 1)
+        if championship == "constructors":
+            # A constructor wins a race once, whatever the number of its cars on the podium
+            finishes[:, :, 0] = np.minimum(finishes[:, :, 0], 1)
+        finishes = np.cumsum(finishes, axis=1)
+        wins = finishes[:, :, 0]
+
+        # An entity is classified from the first round it took part in
+        participations = pd.concat([results[[id_column, "round"]], sprints[[id_column, "round"]]])
+        took_part = np.zeros((n_entities, n_rounds), dtype=bool)
+        took_part[entity_index.get_indexer(participations[id_column]), round_index.get_indexer(participations["round"])] = True
+        classified = np.logical_or.accumulate(took_part, axis=1)
+
+        excluded = np.zeros((n_entities, n_rounds), dtype=bool)
+        for (excluded_season, entity), from_round in self.exclusions[championship].items():
+            if excluded_season == season and entity in entity_index:
+                excluded[entity_index.get_loc(entity), rounds >= from_round] = True
+
+        entity_grid, round_grid = np.nonzero(classified)
+        keys = [entity_grid]
+        keys += [-finishes[entity_grid, round_grid, position] for position in reversed(range(n_positions))]
+        keys += [-points[entity_grid, round_grid], excluded[entity_grid, round_grid], round_grid]
+        order = np.lexsort(keys)
+        entity_grid, round_grid = entity_grid[order], round_grid[order]
+
+        first_of_round = np.searchsorted(round_grid, round_grid, side="left")
+        standings = pd.DataFrame(
+            {
+                "round": rounds[round_grid],
+                "season": season,
+                "position": (np.arange(len(order)) - first_of_round + 1).astype(float),
+                "points": points[entity_grid, round_grid],
+                "wins": wins[entity_grid, round_grid],
+                id_column: entities[entity_grid],
+            }
+        )
+
+        if championship == "drivers":
+            # Drivers are listed with the first constructor they drove for in the season
+            first_constructor = results.sort_values(["round", "position"]).drop_duplicates(subset=["driverId"]).set_index("driverId")["constructorId"]
+            standings["constructorId"] = standings["driverId"].map(first_constructor)
+
+        return standings
+
+    def _counted_points(self, race_points: np.ndarray, blocks: list[tuple[int, int]] = None) -> np.ndarray:
+        if blocks is None:
+            return np.cumsum(race_points, axis=1)
+
+        n_entities, n_rounds = race_points.shape
+        counted = np.zeros((n_entities, n_rounds))
+        start = 0
+        for length, best in blocks:
+            if start >= n_rounds:
+                break
+            end = n_rounds if length is None else min(start + length, n_rounds)
+            block = self._best_results_cumulative(race_points[:, start:end], best)
+            counted[:, start:end] += block
+            counted[:, end:] += block[:, -1:]
+            start = end
+        return counted
+
+    def _best_results_cumulative(self, race_points: np.ndarray, best: int) -> np.ndarray:
+        # Column r holds the sum of the best results among rounds 0..r
+        n_rounds = race_points.shape[1]
+        played = np.tril(np.ones((n_rounds, n_rounds), dtype=bool))
+        prefixes = np.where(played[None, :, :], race_points[:, None, :], 0.0)
+        prefixes = -np.sort(-prefixes, axis=2)[:, :, :best]
+        return prefixes.sum(axis=2)
+
+    def verify(self, computed: pd.DataFrame, existing: pd.DataFrame, keys: list[str], columns: list[str] = None) -> pd.DataFrame:
+        if columns is None:
+            columns = [column for column in computed.columns if column in existing.columns and column not in keys]
+
+        merged = existing.merge(computed, on=keys, how="outer", suffixes=("_existing", "_computed"), indicator=True)
+        report = pd.DataFrame({"season": merged["season"]})
+        report["missing"] = merged["_merge"] == "left_only"
+        report["extra"] = merged["_merge"] == "right_only"
+        both = merged["_merge"] == "both"
+        for column in columns:
+            existing_values = merged[f"{column}_existing"]
+            computed_values = merged[f"{column}_computed"]
+            # Comparisons with a missing nullable integer are missing, not False
+            same = (existing_values == computed_values).fillna(False).astype(bool) | (existing_values.isna() & computed_values.isna())
+            report[column] = both & ~same
+
+        return report.groupby("season").sum().astype(int).reset_index()
@@ -0,0 +1,234 @@
+import os
+import shutil
+import tempfile
+import time
+from collections.abc import MutableMapping
+from typing import Iterable
+
+import pandas as pd
+
+
+class CSVStorage:
+    extension = ".csv"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def _path(self, table: str) -> str:
+        return os.path.join(self.directory, f"{table}{self.extension}")
+
+    def exists(self, table: str) -> bool:
+        return os.path.exists(self._path(table))
+
+    def load(self, table: str, columns: list[str] = None, seasons: list[int] = None) -> pd.DataFrame:
+        # CSV has no partitions, seasons are filtered after the whole file is parsed
+        usecols = None if columns is None else list(dict.fromkeys([*columns, *(["season"] if seasons is not None else [])]))
+        df = pd.read_csv(self._path(table), usecols=usecols)
+        if seasons is not None:
+            df = df[df["season"].isin(seasons)].reset_index(drop=True)
+        if columns is not None:
+            df = df[columns]
+        return df
+
+    def nbytes(self, table: str) -> int:
+        return os.path.getsize(self._path(table))
+
+    def save(self, table: str, df: pd.DataFrame, seasons: list[int] = None):
+        # A CSV can not be partially rewritten, the whole table is saved whatever seasons were touched
+        self.save_chunks(table, [df])
+
+    def save_chunks(self, table: str, chunks: Iterable[pd.DataFrame]):
+        os.makedirs(self.directory, exist_ok=True)
+        file_path = self._path(table)
+        tmp_path = f"{file_path}.tmp"
+        with open(tmp_path, "w", newline="") as file:
+            for index, df in enumerate(chunks):
+                df.to_csv(file, header=index == 0, index=False)
+        os.replace(tmp_path, file_path)
+
+
+class ParquetStorage:
+    extension = ".parquet"
+    partition_column = "season"
+
+    def __init__(self, directory: str):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as e:
+            raise ImportError("ParquetStorage requires pyarrow, install it with `uv sync --extra parquet`.") from e
+        self.pa = pa
+        self.pq = pq
+        self.directory = directory
+
+    def _path(self, table: str) -> str:
+        return os.path.join(self.directory, f"{table}{self.extension}")
+
+    def _partitions_path(self, table: str) -> str:
+        return os.path.join(self.directory, table)
+
+    def _partition_path(self, table: str, season: int) -> str:
+        return os.path.join(self._partitions_path(table), f"{self.partition_column}={season}", f"part-0{self.extension}")
+
+    def _is_partitioned(self, table: str) -> bool:
+        return os.path.isdir(self._partitions_path(table))
+
+    def partitions(self, table: str) -> list[int]:
+        if not self._is_partitioned(table):
+            return []
+        prefix = f"{self.partition_column}="
+        return sorted(int(x[len(prefix) :]) for x in os.listdir(self._partitions_path(table)) if x.startswith(prefix))
+
+    def exists(self, table: str) -> bool:
+        return self._is_partitioned(table) or os.path.exists(self._path(table))
+
+    def nbytes(self, table: str) -> int:
+        if not self._is_partitioned(table):
+            return os.path.getsize(self._path(table))
+        return sum(os.path.getsize(self._partition_path(table, season)) for season in self.partitions(table))
+
+    def load(self, table: str, columns: list[str] = None, seasons: list[int] = None) -> pd.DataFrame:
+        if not self._is_partitioned(table):
+            df = self.pq.read_table(self._path(table), columns=columns).to_pandas()
+            if seasons is not None and self.partition_column in df.columns:
+                df = df[df[self.partition_column].isin(seasons)].reset_index(drop=True)
+            return df
+
+        # Partitions are read in season order, so the table keeps its sort order
+        available = self.partitions(table)
+        selected = available if seasons is None else [x for x in available if x in set(seasons)]
+        tables = [self.pq.read_table(self._partition_path(table, season), columns=columns) for season in selected]
+        if not tables:
+            schema = self.pq.read_schema(self._partition_path(table, available[0])) if available else None
+            if schema is None:
+                return pd.DataFrame(columns=columns)
+            return schema.empty_table().select(columns or schema.names).to_pandas()
+        return self.pa.concat_tables(tables).to_pandas()
+
+    def save(self, table: str, df: pd.DataFrame, seasons: list[int] = None):
+        if self.partition_column not in df.columns:
+            os.makedirs(self.directory, exist_ok=True)
+            self._write(self.pa.Table.from_pandas(df, preserve_index=False), self._path(table))
+            return
+
+        # df is the whole table, only the partitions of the given seasons are rewritten
+        if seasons is None:
+            # A full save also drops partitions that are no longer in the table
+            seasons = sorted(set(self.partitions(table)) | set(df[self.partition_column].unique().tolist()))
+        else:
+            df = df[df[self.partition_column].isin(seasons)]
+        groups = dict(list(df.groupby(self.partition_column, sort=True)))
+        for season in seasons:
+            if season in groups:
+                partition = self.pa.Table.from_pandas(groups[season], preserve_index=False)
+                self._write(partition, self._partition_path(table, season))
+            else:
+                shutil.rmtree(os.path.dirname(self._partition_path(table, season)), ignore_errors=True)
+
+    def save_chunks(self, table: str, chunks: Iterable[pd.DataFrame]):
+        written = set()
+        for df in chunks:
+            seasons = df[self.partition_column].unique().tolist()
+            self.save(table, df, seasons)
+            written.update(seasons)
+        for season in set(self.partitions(table)) - written:
+            shutil.rmtree(os.path.dirname(self._partition_path(table, season)), ignore_errors=True)
+
+    def _write(self, table, file_path: str):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        tmp_path = f"{file_path}.tmp"
+        self.pq.write_table(table, tmp_path)
+        os.replace(tmp_path, file_path)
+
+
+STORAGES = {
+    "csv": CSVStorage,
+    "parquet": ParquetStorage,
+}
+
+
+class LazyTables(MutableMapping):
+    # Tables read on first access with loader(table, columns), None for a table that does not exist.
+    # projection reads only some columns of a table not loaded yet, or slices the table once it is loaded.
+    def __init__(self, names: list[str], loader: callable):
+        self.names = list(names)
+        self.loader = loader
+        self._tables = {}
+        self._projections = {}
+
+    def __getitem__(self, table: str) -> pd.DataFrame | None:
+        if table not in self._tables:
+            if table not in self.names:
+                raise KeyError(table)
+            self._tables[table] = self.loader(table, None)
+        return self._tables[table]
+
+    def __setitem__(self, table: str, df: pd.DataFrame | None):
+        if table not in self.names:
+            self.names.append(table)
+        self._tables[table] = df
+
+    def __delitem__(self, table: str):
+        self.names.remove(table)
+        self._tables.pop(table, None)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def loaded(self) -> dict[str, pd.DataFrame]:
+        # Tables read or set so far, the others are unchanged in the storage
+        return {table: self._tables[table] for table in self.names if self._tables.get(table) is not None}
+
+    def projection(self, table: str, columns: list[str]) -> pd.DataFrame | None:
+        # The same DataFrame is returned until the table it comes from changes, so indexes over it stay valid
+        source = self._tables.get(table)
+        key = (table, tuple(columns))
+        cached = self._projections.get(key)
+        if cached is None or (table in self._tables and cached[0] is not source):
+            if table in self._tables:
+                cached = (source, None if source is None else source[columns])
+            else:
+                cached = (None, self.loader(table, columns))
+            self._projections[key] = cached
+        return cached[1]
+
+    def reset(self):
+        self._tables.clear()
+        self._projections.clear()
+
+
+def compare_storages(tables: dict[str, pd.DataFrame], repeat: int = 3) -> pd.DataFrame:
+    # Full load/save of every table, then a pruned read and a single partition rewrite of the last season
+    rows = []
+    for name, storage_class in STORAGES.items():
+        with tempfile.TemporaryDirectory() as directory:
+            storage = storage_class(directory)
+            for table, df in tables.items():
+                timings = {"save": [], "load": [], "load_last_season": [], "save_last_season": []}
+                last_season = [df["season"].max()] if "season" in df.columns else None
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    storage.save(table, df)
+                    timings["save"].append(time.perf_counter() - start)
+
+                    start = time.perf_counter()
+                    storage.load(table)
+                    timings["load"].append(time.perf_counter() - start)
+
+                    if last_season is None:
+                        continue
+                    start = time.perf_counter()
+                    storage.load(table, columns=[df.columns[-1]], seasons=last_season)
+                    timings["load_last_season"].append(time.perf_counter() - start)
+
+                    start = time.perf_counter()
+                    storage.save(table, df, seasons=last_season)
+                    timings["save_last_season"].append(time.perf_counter() - start)
+
+                row = {"storage": name, "table": table, "rows": len(df), "bytes": storage.nbytes(table)}
+                row.update({f"{operation}_ms": min(values) * 1000 if values else None for operation, values in timings.items()})
+                rows.append(row)
+    return pd.DataFrame(rows)
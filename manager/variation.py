@@ -0,0 +1,132 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from manager import defaults
+
+
+class VariationMetrics:
+    default_file = defaults.VARIATION_FILE
+    # Frontend mode -> (standings table, id column)
+    modes = {
+        "driver": ("drivers_standings", "driverId"),
+        "constructor": ("constructors_standings", "constructorId"),
+    }
+
+    def __init__(self, jolpica_db, path: str):
+        self.jolpica_db = jolpica_db
+        self.path = path
+
+    def build(self, incremental: bool = False) -> dict:
+        db = self.jolpica_db
+        if not db._loaded:
+            db._load_db()
+
+        previous = self.load() if incremental else {}
+        metrics = {}
+        for mode, (table, id_column) in self.modes.items():
+            standings = db.db[table]
+            # Digests of the stored dtypes, so they do not depend on the in-memory ones
+            digests = self._season_digests(db.to_storage_dtypes(table, standings))
+
+            # Only seasons whose standings changed since the last build are computed again
+            kept = {x["season"]: x for x in previous.get(mode, []) if digests.get(x["season"]) == x["digest"]}
+            changed = [season for season in digests if season not in kept]
+            computed = self.compute(standings[standings["season"].isin(changed)], id_column)
+            for item in computed:
+                item["digest"] = digests[item["season"]]
+                kept[item["season"]] = item
+
+            metrics[mode] = [kept[season] for season in sorted(kept)]
+            print(f"Variation metrics for {mode}: {len(changed)} seasons computed, {len(kept) - len(changed)} unchanged")
+
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(metrics, file, separators=(",", ":"))
+        os.replace(tmp_path, self.path)
+        return metrics
+
+    def load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as file:
+            return json.load(file)
+
+    def compute(self, standings: pd.DataFrame, id_column: str, window: int = None) -> list[dict]:
+        # Same series as VariationHeatmap.svelte, for every season in one pass over the dense season x round grid
+        if standings.empty:
+            return []
+
+        standings = standings.sort_values(["season", id_column, "round"])
+        season = standings["season"].to_numpy()
+        entity = standings[id_column].to_numpy()
+        round = standings["round"].to_numpy()
+        position = standings["position"].to_numpy(dtype=float, na_value=np.nan)
+
+        # A position change is counted on the round of each entity's appearance that differs from its previous one
+        same_entity = np.zeros(len(standings), dtype=bool)
+        same_entity[1:] = (season[1:] == season[:-1]) & (entity[1:] == entity[:-1])
+        moved = np.zeros(len(standings), dtype=bool)
+        moved[1:] = same_entity[1:] & (position[1:] != position[:-1])
+
+        seasons, season_index = np.unique(season, return_inverse=True)
+        lengths = np.zeros(len(seasons), dtype=np.int64)
+        np.maximum.at(lengths, season_index, round)
+        per = np.zeros((len(seasons), lengths.max()), dtype=np.int64)
+        np.add.at(per, (season_index[moved], round[moved] - 1), 1)
+
+        in_season = np.arange(per.shape[1])[None, :] < lengths[:, None]
+        cum = np.cumsum(per, axis=1)
+        std = self._rolling_std(per.astype(float), lengths, window) / 100
+        maxima = per.max(axis=1)
+        means = cum[np.arange(len(seasons)), lengths - 1] / lengths
+
+        metrics = []
+        for i, season_value in enumerate(seasons):
+            n = lengths[i]
+            metrics.append(
+                {
+                    "season": int(season_value),
+                    "per": per[i, :n].tolist(),
+                    "cum": cum[i, :n].tolist(),
+                    # The deviation of a single round is undefined, so the series starts on the second round
+                    "std": std[i, 1:n].tolist(),
+                    "total": int(cum[i, n - 1]),
+                    "avg": float(np.floor(means[i] * 10 + 0.5) / 10),
+                    "max": int(maxima[i]),
+                    "maxRound": int(np.argmax(np.where(in_season[i], per[i], -1)) + 1),
+                }
+            )
+        return metrics
+
+    def _rolling_std(self, per: np.ndarray, lengths: np.ndarray, window: int = None) -> np.ndarray:
+        # Sample deviation of the last `window` rounds at every round, the whole season so far by default
+        n_seasons, n_rounds = per.shape
+        windows = lengths if window is None else np.full(n_seasons, window)
+
+        padded = np.zeros((n_seasons, n_rounds + 1))
+        padded_squares = np.zeros((n_seasons, n_rounds + 1))
+        padded[:, 1:] = np.cumsum(per, axis=1)
+        padded_squares[:, 1:] = np.cumsum(per**2, axis=1)
+
+        ends = np.arange(1, n_rounds + 1)[None, :]
+        starts = np.maximum(0, ends - windows[:, None])
+        rows = np.arange(n_seasons)[:, None]
+        count = ends - starts
+        total = padded[rows, ends] - padded[rows, starts]
+        total_squares = padded_squares[rows, ends] - padded_squares[rows, starts]
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = (total_squares - total**2 / count) / (count - 1)
+        return np.sqrt(np.clip(variance, 0, None))
+
+    def _season_digests(self, standings: pd.DataFrame) -> dict[int, str]:
+        hashes = pd.util.hash_pandas_object(standings, index=False).to_numpy()
+        seasons = standings["season"].to_numpy()
+        digests = {}
+        for season in np.unique(seasons):
+            digests[int(season)] = format(int(hashes[seasons == season].sum()), "016x")
+        return digests
@@ -12,6 +12,33 @@ import * as d3 from 'd3';
 // static/data/**   (path absoluto na app)
 const DATA_PATH = '/data';
 
+/* -------------------------------------------------------------------------
+ * Bundle com nomes por hash do conteúdo (gerado por `python main.py bundle`)
+ * { files: { "data/drivers.csv": { path, bytes, gz, br } } }
+ * ------------------------------------------------------------------------- */
+
+const BUNDLE_PATH = '/bundle';
+
+// O manifest é sempre revalidado, já os arquivos com hash nunca mudam e podem ficar no cache do navegador
+let bundleManifest = null;
+
+export function loadBundleManifest(base) {
+  if (!bundleManifest) {
+    bundleManifest = d3.json(`${base}${BUNDLE_PATH}/manifest.json`, { cache: 'no-cache' }).catch(() => ({ files: {} }));
+  }
+  return bundleManifest;
+}
+
+// URL da cópia com hash de um arquivo de static, ou do próprio arquivo quando ele não está no bundle
+export function bundledUrl(manifest, base, path) {
+  const file = manifest?.files[path.replace(/^\//, '')];
+  return file ? `${base}${BUNDLE_PATH}/${file.path}` : `${base}${path}`;
+}
+
+async function assetUrl(base, path) {
+  return bundledUrl(await loadBundleManifest(base), base, path);
+}
+
 export async function loadData(base) {
   /* -----------------------------------------------------------------------
     * 1. Lê todos os CSVs em paralelo
@@ -22,13 +49,11 @@ export async function loadData(base) {
     constructors,
     constructorStandings,
     races
-  ] = await Promise.all([
-    d3.csv(`${base}${DATA_PATH}/drivers.csv`, d3.autoType),
-    d3.csv(`${base}${DATA_PATH}/drivers_standings.csv`, d3.autoType),
-    d3.csv(`${base}${DATA_PATH}/constructors.csv`, d3.autoType),
-    d3.csv(`${base}${DATA_PATH}/constructors_standings.csv`, d3.autoType),
-    d3.csv(`${base}${DATA_PATH}/races.csv`, d3.autoType)
-  ]);
+  ] = await Promise.all(
+    ['drivers', 'drivers_standings', 'constructors', 'constructors_standings', 'races'].map(async (name) =>
+      d3.csv(await assetUrl(base, `${DATA_PATH}/${name}.csv`), d3.autoType)
+    )
+  );
 
   /* -----------------------------------------------------------------------
     * 2. Pré‑processamentos úteis
@@ -70,3 +95,132 @@ export async function loadData(base) {
     constructorNames
   };
 }
+
+/* -------------------------------------------------------------------------
+ * Shards por temporada (gerados por `python main.py build-shards`)
+ * ------------------------------------------------------------------------- */
+
+const SHARDS_PATH = `${DATA_PATH}/shards`;
+
+// Cache de shards já baixados: "season-mode" → Promise do shard
+const shardCache = new Map();
+
+export async function loadShardIndex(base) {
+  return d3.json(await assetUrl(base, `${SHARDS_PATH}/index.json`));
+}
+
+export function loadSeasonShard(base, index, season, mode) {
+  const key = `${season}-${mode}`;
+  if (!shardCache.has(key)) {
+    const file = index.files[season]?.[mode];
+    if (!file) return Promise.resolve(null);
+    shardCache.set(key, assetUrl(base, `${SHARDS_PATH}/${file}`).then((url) => d3.json(url)).then(indexShard));
+  }
+  return shardCache.get(key);
+}
+
+// Mapas id → coluna da matriz e round → linha, para lookups O(1)
+function indexShard(shard) {
+  shard.entityIndex = new Map(shard.entities.map((d, i) => [d.id, i]));
+  shard.roundIndex = new Map(shard.rounds.map((d, i) => [d, i]));
+  return shard;
+}
+
+/* -------------------------------------------------------------------------
+ * Métricas de variação (geradas por `python main.py build-metrics`)
+ * { driver: [{ season, per, cum, std, total, avg, max, maxRound }], constructor: [...] }
+ * ------------------------------------------------------------------------- */
+
+export async function loadVariationMetrics(base) {
+  return d3.json(await assetUrl(base, `${DATA_PATH}/variation.json`));
+}
+
+/* -------------------------------------------------------------------------
+ * Decisão dos campeonatos (gerada por `python main.py build-championship`)
+ * { driver: [{ season, rounds, scheduled, clinchRound, champion,
+ *              entities: [{ id, eliminatedRound, maxPosition: [por round] }] }], constructor: [...] }
+ * ------------------------------------------------------------------------- */
+
+export async function loadChampionshipOutlook(base) {
+  return d3.json(await assetUrl(base, `${DATA_PATH}/championship.json`));
+}
+
+/* -------------------------------------------------------------------------
+ * Posições volta a volta por corrida (geradas por `python main.py update-laps`)
+ * { season, round, raceName, laps, drivers: [{ id, code, overtakes, overtaken, pitLaps }],
+ *   position, delta, overtakes: matrizes volta × piloto, null se o piloto não completou a volta }
+ * ------------------------------------------------------------------------- */
+
+const RACE_SHARDS_PATH = `${DATA_PATH}/race_shards`;
+
+// Cache de corridas já baixadas: "season-round" → Promise da corrida
+const raceShardCache = new Map();
+
+export async function loadRaceShardIndex(base) {
+  return d3.json(await assetUrl(base, `${RACE_SHARDS_PATH}/index.json`));
+}
+
+export function loadRacePositions(base, index, season, round) {
+  const key = `${season}-${round}`;
+  if (!raceShardCache.has(key)) {
+    if (!index.rounds[season]?.includes(round)) return Promise.resolve(null);
+    raceShardCache.set(key, assetUrl(base, `${RACE_SHARDS_PATH}/${season}/${round}.json`).then((url) => d3.json(url)));
+  }
+  return raceShardCache.get(key);
+}
+
+/* -------------------------------------------------------------------------
+ * Sprites por temporada (gerados por `python main.py build-sprites`)
+ * { size, width, height, images: { webp, avif }, entities: { id: [x, y] } }
+ * ------------------------------------------------------------------------- */
+
+const SPRITES_PATH = '/images/sprites';
+
+// Cache de mapas já baixados: "mode-season" → Promise do mapa (null se não existir)
+const spriteCache = new Map();
+
+export function loadSprite(base, mode, season) {
+  const key = `${mode}-${season}`;
+  if (!spriteCache.has(key)) {
+    const directory = `${SPRITES_PATH}/${mode}s`;
+    spriteCache.set(
+      key,
+      assetUrl(base, `${directory}/${season}.json`)
+        .then((url) => d3.json(url))
+        .then(async (sprite) => ({ ...sprite, url: await assetUrl(base, `${directory}/${sprite.images.webp}`) }))
+        .catch(() => null)
+    );
+  }
+  return spriteCache.get(key);
+}
+
+// Estilo CSS que recorta a célula da entidade do sprite, escalada para `side` px
+export function spriteStyle(sprite, id, side) {
+  const cell = sprite?.entities[id];
+  if (!cell) return null;
+  const scale = side / sprite.size;
+  return [
+    `background-image: url(${sprite.url})`,
+    `background-size: ${sprite.width * scale}px ${sprite.height * scale}px`,
+    `background-position: -${cell[0] * scale}px -${cell[1] * scale}px`,
+  ].join('; ');
+}
+
+/* -------------------------------------------------------------------------
+ * Aliases de imagens idênticas (gerados pelo manifest de `update-images`)
+ * { id: idDoArquivo }, ex.: marussia → manor
+ * ------------------------------------------------------------------------- */
+
+const aliasesCache = new Map();
+
+export function loadImageAliases(base, mode) {
+  if (!aliasesCache.has(mode)) {
+    aliasesCache.set(
+      mode,
+      assetUrl(base, `/images/${mode}s/aliases.json`)
+        .then((url) => d3.json(url))
+        .catch(() => ({}))
+    );
+  }
+  return aliasesCache.get(mode);
+}
@@ -1,76 +1,58 @@
 /*  ==========================================================================
 standingsUtils.js
 --------------------------------------------------------------------------
-Funções de conveniência que filtram/transformam os standings
-para um formato amigável ao gráfico.
+Funções de conveniência que transformam o shard de uma temporada
+(gerado por `python main.py build-shards`) para um formato amigável ao gráfico.
 ========================================================================== */
 
-function getDriverStandings(f1data, season) {
-  let standings = null;
-  standings = f1data.driverStandings.filter((d) => d.season === season);
-  return standings;
-}
-
-function getConstructorStandings(f1data, season) {
-  let standings = null;
-  standings = f1data.constructorStandings.filter((d) => d.season === season);
-  return standings;
+// Nome exibido da entidade, o id quando ela não está na tabela de pilotos/construtores
+function entityName(entity) {
+  return entity.name ?? entity.id;
 }
 
-export function getSeasons(f1data, firstSeason = 2000) {
-  return [...new Set(f1data.driverStandings.map((d) => d.season))]
-    .sort((a, b) => b - a)
-    .filter((d) => d >= firstSeason);
+export function getShardRounds(shard) {
+  // Todas as rodadas do calendário, inclusive as que ainda não foram disputadas
+  return shard.races.map((d) => d.round);
 }
 
-export function getRounds(f1data, season) {
-  return [...new Set(f1data.races.filter((d) => d.season === season).map((d) => d.round))]
-    .sort((a, b) => a - b);
+export function getShardStandings(shard) {
+  // Devolve array ordenado por round, já com
+  // { round, position, points, wins, [mode]: nome } pronto para plotagem.
+  let standings = [];
+  shard.rounds.forEach((round, row) => {
+    shard.entities.forEach((entity, column) => {
+      const position = shard.position[row][column];
+      if (position === null) return;
+      standings.push({
+        round,
+        position,
+        points: shard.points[row][column],
+        wins: shard.wins[row][column],
+        season: shard.season,
+        [shard.mode]: entityName(entity),
+      });
+    });
+  });
+  return standings;
 }
 
-export function getEntities(f1data, season, mode, round) {
-  let standings = standingsBySeason(f1data, season, mode);
+export function getShardEntities(shard, round) {
+  // Entidades classificadas no round, por nome, com os dados do tooltip
+  const row = shard.roundIndex.get(round);
   let entities = {};
-  [...new Set(standings.map((d) => d[mode]))].forEach((d) => {
-    let entity = standings.filter((e) => e[mode] === d && e.round == round)[0];
-    if (!entity) return;
-    entities[d] = {
-      name: entity[mode],
-      points: entity.points,
-      position: entity.position,
-      round: entity.round,
-      season: entity.season,
-      wins: entity.wins,
+  if (row === undefined) return entities;
+  shard.entities.forEach((entity, column) => {
+    const position = shard.position[row][column];
+    if (position === null) return;
+    entities[entityName(entity)] = {
+      ...entity,
+      name: entityName(entity),
+      points: shard.points[row][column],
+      position,
+      round,
+      season: shard.season,
+      wins: shard.wins[row][column],
     };
-  
-    let driver = f1data.drivers.filter((e) => e.driverId === entity.driverId)[0];
-    let constructor = f1data.constructors.filter((e) => e.constructorId === entity.constructorId)[0];
-    if (mode === 'driver') {
-      entities[d].id = driver.driverId;
-      entities[d].url = driver.url;
-      entities[d].dateOfBirth = driver.dateOfBirth;
-      entities[d].nationality = driver.nationality
-      entities[d].constructor = constructor.name;
-    } else if (mode === 'constructor') {
-      entities[d].id = constructor.constructorId;
-      entities[d].url = constructor.url;
-      entities[d].nationality = constructor.nationality;
-    }
   });
-  return entities
-}
-
-export function standingsBySeason(f1data, season, labelField) {
-  // Recebe (driver OR constructor) standings cru,
-  // devolve array ordenado por round, já com
-  // { round, position, key, points } pronto para plotagem.
-
-  let standings = [];
-  if (labelField === 'driver') {
-    standings = getDriverStandings(f1data, season);
-  } else if (labelField === 'constructor') {
-    standings = getConstructorStandings(f1data, season);
-  }
-
-  return standings;
+  return entities;
 }
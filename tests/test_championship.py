@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from manager.championship import ChampionshipOutlook
+from manager.jolpica import JolpicaDB
+
+
+@pytest.fixture(scope="module")
+def outlook(tmp_path_factory) -> ChampionshipOutlook:
+    cache_directory = tmp_path_factory.mktemp("championship")
+    return ChampionshipOutlook(JolpicaDB("static/data"), str(cache_directory / "championship.json"), cache_directory=str(cache_directory))
+
+
+@pytest.fixture(scope="module")
+def results(outlook: ChampionshipOutlook) -> dict[str, dict]:
+    return {mode: outlook.compute(mode) for mode in outlook.modes}
+
+
+def clinch(result: dict, season: int) -> tuple[int, str]:
+    i = int(np.searchsorted(result["seasons"], season))
+    rounds = np.flatnonzero(result["clinched"][i])
+    return int(rounds[0]) + 1, result["entities"][i][int(result["leader"][i, rounds[0]])]
+
+
+@pytest.mark.parametrize(
+    ("mode", "season", "expected"),
+    [
+        # Best 11 of 16 results: Prost could only tie Senna's points, and would lose the countback on wins
+        ("driver", 1988, (15, "senna")),
+        # Double points in the last race
+        ("driver", 2014, (19, "hamilton")),
+        ("driver", 2023, (17, "max_verstappen")),
+        # Best 6 of 11 results, with only the best placed car of each constructor scoring
+        ("constructor", 1958, (10, "vanwall")),
+        ("constructor", 2023, (16, "red_bull")),
+    ],
+)
+def test_clinch_round(results: dict[str, dict], mode: str, season: int, expected: tuple[int, str]):
+    assert clinch(results[mode], season) == expected
+
+
+def test_dropped_scores_only_replace_counted_results(outlook: ChampionshipOutlook):
+    # After 1988 R14 Prost counts 11 results already, so the 2 races left can only replace his lowest counted ones
+    df = outlook.season_outlook("driver", 1988, 14).set_index("id")
+    assert df.loc["prost", "points"] < df.loc["prost", "reachable"] < df.loc["prost", "points"] + 18
+    assert df.loc["senna", "alive"] and df.loc["prost", "alive"]
@@ -0,0 +1,137 @@
+import io
+import json
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+import pytest
+from PIL import Image
+
+from manager.images import ImagesDB
+
+# Article title -> (file of its image, original width and height), the stub wiki
+IMAGES = {f"Driver {i}": (f"Driver_{i}.jpg", 300, 400) for i in range(60)}
+IMAGES["Lewis Hamilton"] = ("Hamilton.jpg", 400, 600)
+IMAGES["Nelson Piquet Jr."] = ("Piquet.jpg", 300, 450)
+IMAGES["Juan Manuel Fangio"] = ("Fangio.jpg", 800, 400)
+IMAGES["No Image"] = (None, 0, 0)
+REDIRECTS = {"Nelson Piquet Junior": "Nelson Piquet Jr."}
+
+
+class WikiStub:
+    # MediaWiki API of pageimages and imageinfo, with underscores normalized to spaces and a few redirects, and the
+    # thumbnails it points to. Every API request is kept with its parameters.
+    def __init__(self):
+        self.requests = []
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}"
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def __enter__(self) -> "WikiStub":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def query(self, params: dict) -> dict:
+        titles = params["titles"].split("|")
+        normalized = [{"from": x, "to": x.replace("_", " ")} for x in titles if "_" in x]
+        titles = [x.replace("_", " ") for x in titles]
+        redirects = [{"from": x, "to": REDIRECTS[x]} for x in titles if x in REDIRECTS]
+        titles = [REDIRECTS.get(x, x) for x in titles]
+        pages = []
+        for title in titles:
+            if params["prop"] == "pageimages":
+                file_name, width, height = IMAGES.get(title, (None, 0, 0))
+                page = {"title": title}
+                if file_name:
+                    page.update(pageimage=file_name, original={"source": f"{self.url}/original/{file_name}", "width": width, "height": height})
+                pages.append(page)
+            else:
+                size = f"w={params['iiurlwidth']}" + (f"&h={params['iiurlheight']}" if "iiurlheight" in params else "")
+                file_name = title.removeprefix("File:").replace(" ", "_")
+                pages.append({"title": title, "imageinfo": [{"url": f"{self.url}/original/{file_name}", "thumburl": f"{self.url}/thumb/{file_name}?{size}"}]})
+        return {"batchcomplete": True, "query": {"normalized": normalized, "redirects": redirects, "pages": pages}}
+
+    def _handler(self) -> type:
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                parts = urlsplit(self.path)
+                if parts.path == ImagesDB.wikipedia_api_path:
+                    params = {key: values[0] for key, values in parse_qs(parts.query).items()}
+                    stub.requests.append(params)
+                    body, content_type = json.dumps(stub.query(params)).encode(), "application/json"
+                else:
+                    buffer = io.BytesIO()
+                    Image.new("RGB", (300, 300), "red").save(buffer, format="PNG")
+                    body, content_type = buffer.getvalue(), "image/png"
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+
+@pytest.fixture
+def wiki():
+    with WikiStub() as stub:
+        yield stub
+
+
+@pytest.fixture
+def urls(wiki: WikiStub) -> dict[str, str]:
+    urls = {f"driver_{i}": f"{wiki.url}/wiki/Driver_{i}" for i in range(60)}
+    urls.update(
+        hamilton=f"{wiki.url}/wiki/Lewis_Hamilton",
+        piquet_jr=f"{wiki.url}/wiki/Nelson_Piquet_Junior",
+        fangio=f"{wiki.url}/wiki/Juan_Manuel_Fangio",
+        no_image=f"{wiki.url}/wiki/No_Image",
+    )
+    return urls
+
+
+def test_wikipedia_batches(tmp_path, wiki: WikiStub, urls: dict[str, str]):
+    images_db = ImagesDB(str(tmp_path))
+    images_urls = images_db._get_images_urls_from_wikipedia(urls)
+    images_db.close()
+
+    size = min(ImagesDB.default_image_size)
+    # Titles normalized and redirected by the API are found under the requested ones, images without one are missed
+    assert images_urls["hamilton"] == f"{wiki.url}/thumb/Hamilton.jpg?w={size}"
+    assert images_urls["piquet_jr"] == f"{wiki.url}/thumb/Piquet.jpg?w={size}"
+    assert images_urls["driver_59"] == f"{wiki.url}/thumb/Driver_59.jpg?w={size}"
+    # Landscape images are scaled by height, so the shorter side is still the pipeline size
+    assert images_urls["fangio"] == f"{wiki.url}/thumb/Fangio.jpg?w={math.ceil(size * 800 / 400)}&h={size}"
+    assert set(images_urls) == set(urls) - {"no_image"}
+
+    page_images = [x for x in wiki.requests if x["prop"] == "pageimages"]
+    thumbnails = [x for x in wiki.requests if x["prop"] == "imageinfo"]
+    assert sorted(len(x["titles"].split("|")) for x in page_images) == [14, 50]
+    # One request per orientation and batch: 62 portrait files in 2 batches and 1 landscape one
+    assert sorted(len(x["titles"].split("|")) for x in thumbnails) == [1, 12, 50]
+    assert all(x["redirects"] == "1" for x in wiki.requests)
+
+
+def test_misses_left_to_scraper(tmp_path, wiki: WikiStub, urls: dict[str, str]):
+    images_db = ImagesDB(str(tmp_path))
+    scraped = []
+    images_db._get_image_url_from_wikipedia = lambda url: scraped.append(url)
+    drivers = pd.DataFrame({"driverId": list(urls), "url": list(urls.values())})
+    counts = images_db.update_images_drivers(drivers)
+    images_db.close()
+
+    assert scraped == [urls["no_image"]]
+    assert counts["changed"] + counts["unchanged"] == len(urls) - 1
+    assert counts["failed"] == 1
@@ -0,0 +1,33 @@
+from manager.cache import ResponseCache
+from manager.fetch import FetchEngine
+from manager.jolpica import JolpicaAPI
+
+
+class CountingEngine(FetchEngine):
+    # Answers every request with the number of requests made so far, as the total of the response
+    def __init__(self):
+        super().__init__()
+        self.requests = 0
+
+    def get_json(self, url: str, params: dict = None) -> dict:
+        self.requests += 1
+        return {"MRData": {"total": str(self.requests)}}
+
+
+def test_fresh_requests_skip_cache_reads(tmp_path):
+    engine = CountingEngine()
+    api = JolpicaAPI(engine, ResponseCache(str(tmp_path)))
+    assert api.races(2025, limit=1)["MRData"]["total"] == "1"
+    assert api.races(2025, limit=1)["MRData"]["total"] == "1"
+    # The probe must see a round published since the response was cached, and the new response is cached
+    assert api.races(2025, limit=1, fresh=True)["MRData"]["total"] == "2"
+    assert api.races(2025, limit=1)["MRData"]["total"] == "2"
+    assert engine.requests == 2
+
+
+def test_fresh_requests_read_offline_cache(tmp_path):
+    JolpicaAPI(CountingEngine(), ResponseCache(str(tmp_path))).drivers_standings(2025, limit=1)
+    engine = CountingEngine()
+    api = JolpicaAPI(engine, ResponseCache(str(tmp_path), offline=True))
+    assert api.drivers_standings(2025, limit=1, fresh=True)["MRData"]["total"] == "1"
+    assert engine.requests == 0
@@ -0,0 +1,36 @@
+import os
+
+import pandas as pd
+import pytest
+
+from manager.cache import ResponseCache
+from manager.jolpica import JolpicaAPI, JolpicaDB, JolpicaParser
+
+# Pages in the Jolpica format, read as a ResponseCache like compare_parsers does. The 1950 standings have drivers with
+# no constructor, and the 1958 ones the first season of the constructors championship.
+RESPONSES_DIRECTORY = os.path.join(os.path.dirname(__file__), "data", "responses")
+
+
+@pytest.fixture(scope="module")
+def pages() -> dict[str, list[dict]]:
+    pages = {}
+    for entry in ResponseCache(RESPONSES_DIRECTORY, offline=True).entries():
+        endpoint = JolpicaAPI.METHODS[entry["endpoint"].strip("/").removesuffix(".json")]
+        pages.setdefault(endpoint, []).append(entry["data"])
+    return pages
+
+
+@pytest.mark.parametrize("endpoint", ["races", "drivers_standings", "constructors_standings"])
+def test_parsers_match(pages: dict[str, list[dict]], endpoint: str):
+    dtypes = JolpicaDB.parser_dtypes()
+    tables = {}
+    for mode in JolpicaParser.modes:
+        parser = JolpicaParser(dtypes, mode=mode)
+        page_parser = parser.page_parser(endpoint)
+        tables[mode] = parser.tables(endpoint, pd.concat([page_parser(json_data)[0] for json_data in pages[endpoint]], ignore_index=True))
+
+    assert tables["schema"].keys() == tables["pandas"].keys()
+    for table, df in tables["schema"].items():
+        assert not df.empty
+        expected = tables["pandas"][table].astype(dtypes[table])[list(dtypes[table].keys())].reset_index(drop=True)
+        pd.testing.assert_frame_equal(df, expected, obj=table)
@@ -0,0 +1,67 @@
+import os
+
+import pandas as pd
+import pytest
+
+from manager.standings import StandingsEngine
+
+DATA_DIRECTORY = os.path.join("static", "data")
+# Results of the scorers of a few seasons, rebuilt from how their standings grew, with the real results of the rounds
+# where dropped scores hide them
+RESULTS_FILE = os.path.join(os.path.dirname(__file__), "data", "results.csv")
+
+
+@pytest.fixture(scope="module")
+def results() -> pd.DataFrame:
+    return pd.read_csv(RESULTS_FILE)
+
+
+@pytest.fixture(scope="module")
+def races() -> pd.DataFrame:
+    return pd.read_csv(os.path.join(DATA_DIRECTORY, "races.csv"))
+
+
+def final_scorers(standings: pd.DataFrame, season: int) -> pd.DataFrame:
+    # Standings of the last round, without the entities that never scored, which the results leave out
+    standings = standings[standings["season"] == season]
+    standings = standings[standings["round"] == standings["round"].max()]
+    return standings[(standings["points"] > 0) | (standings["wins"] > 0)]
+
+
+@pytest.mark.parametrize(
+    ("season", "championship", "id_column"),
+    [
+        # Best 11 of 16 results for the drivers, constructors count every result
+        (1988, "drivers", "driverId"),
+        (1988, "constructors", "constructorId"),
+        # Only the best placed car of a constructor scores. No driver dropped a result, see test_split_dropped_scores
+        (1972, "drivers", "driverId"),
+        (1972, "constructors", "constructorId"),
+        # Double points in the last race
+        (2014, "drivers", "driverId"),
+        (2014, "constructors", "constructorId"),
+    ],
+)
+def test_standings_match_stored(results: pd.DataFrame, races: pd.DataFrame, season: int, championship: str, id_column: str):
+    engine = StandingsEngine()
+    season_results = results[results["season"] == season]
+    computed = getattr(engine, f"{championship}_standings")(season_results, races=races[races["season"] == season])
+    stored = pd.read_csv(os.path.join(DATA_DIRECTORY, f"{championship}_standings.csv"))
+
+    report = engine.verify(final_scorers(computed, season), final_scorers(stored, season), ["season", id_column], ["points", "wins"])
+    assert report.drop(columns="season").to_numpy().sum() == 0, report
+
+
+def test_split_dropped_scores():
+    # 1972 counts the best 5 of the first 6 and of the last 6 results. Winning the first half and finishing sixth in
+    # the second drops a win in the first and a sixth place in the second, where the best 10 of 12 would drop two
+    # sixth places.
+    engine = StandingsEngine()
+    points = [9.0] * 6 + [1.0] * 6
+    results = pd.DataFrame({"season": 1972, "round": range(1, 13), "position": [1] * 6 + [6] * 6, "points": points, "driverId": "stewart", "constructorId": "tyrrell"})
+    standings = engine.drivers_standings(results).set_index("round")
+    assert standings.loc[5, "points"] == 45
+    assert standings.loc[6, "points"] == 45
+    assert standings.loc[7, "points"] == 46
+    assert standings.loc[12, "points"] == 50
+    assert standings.loc[12, "wins"] == 6